@@ -12,7 +12,15 @@ talkusb.talkusb(hf.INIT, None, 0);
 
 HRT = rate.HashRateTest(talkusb.talkusb, 600, print)
 
-while HRT.one_cycle():
-    pass
+result = HRT.run()
 
+print("Stopped: %s" % (result.reason))
+if result.error is not None:
+    print("Error: %s" % (result.error))
+print("%.1f s, %d good nonces, %d errors, %f Gh/s" % (result.elapsed, result.good_nonces,
+                                                      result.errors(), result.hash_rate / 10**9))
+for die in range(len(result.dies)):
+    stats = result.dies[die]
+    print("die %d: %d good nonces, %d bad nonces, %d jobs, %.1f idle slot seconds"
+          % (die, stats.good_nonces, stats.bad_nonces, stats.jobs, stats.idle_slot_seconds))
 print("All done!")
@@ -0,0 +1,200 @@
+import array
+import asyncio
+import collections
+
+from .hf import HF_Error
+from .hf import Send, HF_ChunkParse, HF_Frame
+from .hf import RECEIVE, RECEIVE_MAX, RECEIVE_INTO, RECEIVE_TIMEOUT, HF_BROADCAST_ADDRESS
+
+# asyncio front end for talkusb().
+#
+# The blocking talkusb() calls run on an executor: the loop's default
+# one unless another is given, which lets several boards share a pool.
+# One reader task per link reads, parses and hands out tokens.  If
+# talkusb() supports RECEIVE_INTO, each read is one packet with a
+# timeout of receive_timeout milliseconds, as in hf.Receive, so close()
+# gets the executor thread back within that long.  Otherwise reads are
+# RECEIVE, which may block until the device sends something.  A token
+# which answers an outstanding request() completes that request.
+# Everything else goes to the token queue, read with next_token() or
+# "async for token in link".
+#
+#     link = AsyncLink(talkusb.talkusb)
+#     await link.start()
+#     reply = await link.request(opcodes['OP_PING'])
+#     async for token in link:
+#         ...
+#
+# Requests are matched to replies by operation code, first come first
+# served.  Serial protocol requests to a single chip also match on the
+# chip address.  The USB interface operations (128 and up) answer for
+# the whole board, and put other things in the chip address, such as
+# the die count in the OP_USB_INIT reply.
+class AsyncLink():
+    def __init__(self, talkusb, executor=None, idle_sleep=0.0005, receive_timeout=10,
+                 **send_options):
+        self.talkusb = talkusb
+        self.executor = executor
+        self.idle_sleep = idle_sleep
+        self.receive_timeout = receive_timeout
+        self.send_options = send_options
+        self.max_receive = None
+        self.buffer = None
+        self.running = False
+        self.transmitter = None
+        self.send_lock = None
+        self.parser = HF_ChunkParse()
+        self.tokens = None
+        # operation code -> deque of (chip address, future)
+        self.requests = collections.defaultdict(collections.deque)
+        self.reader = None
+        self.error = None
+
+    async def call(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, function, *args)
+
+    async def start(self):
+        if self.reader is not None:
+            raise HF_Error("AsyncLink already started.")
+        self.max_receive = await self.call(self.talkusb, RECEIVE_MAX, None, 0)
+        if await self.call(self.talkusb, RECEIVE_TIMEOUT, None, self.receive_timeout) == 0:
+            self.buffer = array.array('B', bytes(self.max_receive))
+        self.transmitter = await self.call(self.make_transmitter)
+        self.send_lock = asyncio.Lock()
+        self.tokens = asyncio.Queue()
+        self.running = True
+        self.reader = asyncio.ensure_future(self.read_loop())
+
+    def make_transmitter(self):
+        return Send(self.talkusb, **self.send_options)
+
+    # A read already handed to the executor can't be cancelled, so
+    # close() lets the reader see running go false after its current
+    # read.  Without RECEIVE_INTO that read may block until the device
+    # sends something, so then the reader is cancelled instead, and its
+    # executor thread stays busy.
+    async def close(self):
+        self.running = False
+        if self.reader is not None:
+            if self.buffer is None:
+                self.reader.cancel()
+            try:
+                await self.reader
+            except asyncio.CancelledError:
+                pass
+            self.reader = None
+        self.fail(HF_Error("AsyncLink closed."))
+
+    # Runs on the executor.  Returns the bytes read, empty if nothing
+    # came.
+    def read(self):
+        if self.buffer is not None:
+            rslt = self.talkusb(RECEIVE_INTO, self.buffer, len(self.buffer))
+            if rslt < 0:
+                raise HF_Error("Bad call trying to receive using talkusb(): %d" % (rslt))
+            return self.buffer[0:rslt].tobytes()
+        rslt = self.talkusb(RECEIVE, None, self.max_receive)
+        if isinstance(rslt, int):
+            raise HF_Error("Bad call trying to receive using talkusb(): %d" % (rslt))
+        return bytes(rslt)
+
+    async def read_loop(self):
+        try:
+            while self.running:
+                data = await self.call(self.read)
+                if len(data) == 0:
+                    if self.buffer is None:
+                        await asyncio.sleep(self.idle_sleep)
+                    continue
+                self.parser.input(data)
+                while self.parser.has_token():
+                    self.deliver(self.parser.next_token())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.fail(e)
+
+    def deliver(self, token):
+        waiting = self.requests.get(getattr(token, 'operation_code', None))
+        if waiting:
+            for entry in waiting:
+                chip_address, future = entry
+                if future.done():
+                    continue
+                if chip_address is None or chip_address == token.chip_address:
+                    waiting.remove(entry)
+                    future.set_result(token)
+                    return
+        self.tokens.put_nowait(token)
+
+    # Wake up everybody waiting, with the error.
+    def fail(self, error):
+        if self.error is None:
+            self.error = error
+        for waiting in self.requests.values():
+            for chip_address, future in waiting:
+                if not future.done():
+                    future.set_exception(HF_Error("Link failed: %s" % (error)))
+            waiting.clear()
+        if self.tokens is not None:
+            self.tokens.put_nowait(None)
+
+    # frame is an HF_Frame or anything Send.send() takes.
+    async def send(self, frame):
+        if isinstance(frame, HF_Frame):
+            frame = frame.buffer
+        async with self.send_lock:
+            await self.call(self.transmitter.send, frame)
+
+    async def abort(self, chip_address=None):
+        async with self.send_lock:
+            await self.call(self.transmitter.abort, chip_address)
+
+    async def work_restart(self, hdata=0, die_bitmap=None):
+        async with self.send_lock:
+            await self.call(self.transmitter.work_restart, hdata, die_bitmap)
+
+    # Sends a frame and waits for the reply, a frame with operation code
+    # reply_code, by default the same one.  Raises asyncio.TimeoutError
+    # if nothing comes back within timeout seconds.
+    async def request(self, operation_code, chip_address=0, core_address=0, hdata=0,
+                      data=None, reply_code=None, timeout=1.0):
+        if self.error is not None:
+            raise HF_Error("Link failed: %s" % (self.error))
+        frame = {'operation_code': operation_code, 'chip_address': chip_address,
+                 'core_address': core_address, 'hdata': hdata}
+        if data is not None:
+            frame['data'] = data
+        if reply_code is None:
+            reply_code = operation_code
+        match_chip = None
+        if reply_code < 128 and chip_address != HF_BROADCAST_ADDRESS:
+            match_chip = chip_address
+        future = asyncio.get_running_loop().create_future()
+        entry = (match_chip, future)
+        self.requests[reply_code].append(entry)
+        try:
+            await self.send(HF_Frame(frame))
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            if entry in self.requests[reply_code]:
+                self.requests[reply_code].remove(entry)
+
+    # Returns the next token which isn't a reply to a request.
+    async def next_token(self):
+        if self.error is not None and self.tokens.empty():
+            raise HF_Error("Link failed: %s" % (self.error))
+        token = await self.tokens.get()
+        if token is None:
+            raise HF_Error("Link failed: %s" % (self.error))
+        return token
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.next_token()
+        except HF_Error:
+            raise StopAsyncIteration
@@ -0,0 +1,251 @@
+import hashlib
+import os
+import struct
+import threading
+import time
+
+from . import sha256
+from . import sha256_fast
+
+# Choice of SHA-256 implementation, per operation.
+#
+# Operations, all in cgminer's byte order, as in sha256.py:
+#   'midstate'      cgminer_calc_midstate(), 64 bytes in, 32 bytes out
+#   'regen_hash'    cgminer_regen_hash(), 80 bytes in, 32 bytes out
+#   'midstates'     'midstate' over a list, returns a list
+#   'regen_hashes'  'regen_hash' over a list, returns a list
+# Inputs may be lists of byte values or anything bytes-like.  Outputs
+# are bytes.
+#
+# Backends:
+#   'reference'  sha256.py
+#   'hashlib'    hashlib, and sha256_fast for midstates, which hashlib
+#                can't give
+#   'numpy'      sha256_np, if numpy is installed
+#
+# The first get() runs select(): every backend goes through the known
+# answer tests, and a short benchmark picks the fastest one that passed
+# for each operation.  That takes a second or so, so anything with a
+# loop which can't wait calls ready() before starting it; HashEngine
+# does.  HFLOAD_SHA256_BACKEND overrides the choice, either with one
+# backend name for everything, or per operation, like
+# "midstate=reference,regen_hashes=numpy".  A named backend which fails
+# its tests is an error, not silently replaced.
+
+class BackendError(Exception):
+    pass
+
+environment_variable = 'HFLOAD_SHA256_BACKEND'
+
+operations = ['midstate', 'regen_hash', 'midstates', 'regen_hashes']
+
+# name -> {operation: function}
+backends = {}
+
+# operation -> backend name, filled in by select()
+chosen = {}
+
+# name -> why it failed, filled in by select()
+failed = {}
+
+# name -> {operation: seconds per benchmark run}
+timings = {}
+
+# Held while choosing, so threads asking at once choose once.
+selecting = threading.Lock()
+
+def register(name, functions):
+    assert set(functions.keys()) == set(operations)
+    backends[name] = functions
+
+def reference_midstate(sixty_four):
+    return bytes(sha256.cgminer_calc_midstate(list(sixty_four)))
+
+def reference_regen_hash(eighty):
+    return sha256.cgminer_regen_hash(list(eighty))
+
+register('reference', {
+    'midstate': reference_midstate,
+    'regen_hash': reference_regen_hash,
+    'midstates': lambda blocks: [reference_midstate(x) for x in blocks],
+    'regen_hashes': lambda headers: [reference_regen_hash(x) for x in headers]})
+
+# Headers with the same first 64 bytes, such as nonces for one job,
+# share one hashed prefix, copied for each.
+def hashlib_regen_hashes(headers):
+    prefixes = {}
+    result = []
+    for header in headers:
+        swapped = sha256_fast.reverse_every_four_bytes(header)
+        prefix = prefixes.get(swapped[0:64])
+        if prefix is None:
+            prefix = hashlib.sha256(swapped[0:64])
+            prefixes[swapped[0:64]] = prefix
+        hash1 = prefix.copy()
+        hash1.update(swapped[64:80])
+        result.append(hashlib.sha256(hash1.digest()).digest())
+    return result
+
+register('hashlib', {
+    'midstate': sha256_fast.cgminer_calc_midstate,
+    'regen_hash': sha256_fast.cgminer_regen_hash,
+    'midstates': lambda blocks: [sha256_fast.cgminer_calc_midstate(x) for x in blocks],
+    'regen_hashes': hashlib_regen_hashes})
+
+# Fix: Keep results as arrays for callers which can use them.
+def register_numpy():
+    try:
+        from . import sha256_np
+    except ImportError:
+        return
+    def rows(items):
+        return b''.join(bytes(x) for x in items)
+    register('numpy', {
+        'midstate': lambda x: bytes(sha256_np.calc_midstates(rows([x]))[0]),
+        'regen_hash': lambda x: bytes(sha256_np.regen_hashes(rows([x]))[0]),
+        'midstates': lambda blocks: [bytes(x) for x in sha256_np.calc_midstates(rows(blocks))],
+        'regen_hashes': lambda headers: [bytes(x) for x in sha256_np.regen_hashes(rows(headers))]})
+
+# The Bitcoin genesis block header, and its hash as usually displayed.
+genesis_header = bytes.fromhex(
+    '01000000' +
+    '0000000000000000000000000000000000000000000000000000000000000000' +
+    '3ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a' +
+    '29ab5f49' + 'ffff001d' + '1dac2b7c')
+genesis_hash = '000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f'
+
+# cgminer works on headers with every four bytes swapped.
+def swap_words(data):
+    return sha256_fast.reverse_every_four_bytes(data)
+
+# Messages for the midstate tests, as in sha256.test_midstate(): the
+# hash of a message must come out the same when the first 64 bytes go
+# through a midstate.
+midstate_messages = [
+    b'abcdbcdecdefdefgefghfghighijhijkijkljklmklmnlmnomnopnopq' * 2,
+    bytes(range(80)),
+    bytes(range(255, 127, -1)),
+    genesis_header]
+
+def known_answer_tests(functions):
+    # The genesis block.
+    regen = functions['regen_hash'](swap_words(genesis_header))
+    if regen[::-1].hex() != genesis_hash:
+        raise BackendError("regen_hash gets the genesis block wrong")
+    if [x[::-1].hex() for x in functions['regen_hashes']([swap_words(genesis_header)] * 2)] != [genesis_hash] * 2:
+        raise BackendError("regen_hashes gets the genesis block wrong")
+    # Midstates.  cgminer_calc_midstate() swaps the words going in and
+    # coming out, so undo that, finish the hash with sha256_fast and
+    # compare with hashlib.
+    blocks = [swap_words(M[0:64]) for M in midstate_messages]
+    for M, midstate, midstate_batch in zip(midstate_messages,
+                                           [functions['midstate'](x) for x in blocks],
+                                           functions['midstates'](blocks)):
+        if midstate != midstate_batch:
+            raise BackendError("midstate and midstates disagree")
+        words = struct.unpack('<8I', midstate)
+        final = sha256_fast.sha256_with_midstate(M[64:], words, len(M))
+        if struct.pack('>8I', *final) != hashlib.sha256(M).digest():
+            raise BackendError("midstate gets a known answer wrong")
+
+def benchmark(functions, repeat=3):
+    headers = [bytes((i + j) % 256 for j in range(80)) for i in range(64)]
+    workloads = {
+        'midstate': (functions['midstate'], headers[0][0:64], 4),
+        'regen_hash': (functions['regen_hash'], headers[0], 64),
+        'midstates': (functions['midstates'], [x[0:64] for x in headers], 1),
+        'regen_hashes': (functions['regen_hashes'], headers, 1)}
+    result = {}
+    for operation, (function, argument, calls) in workloads.items():
+        best = None
+        for i in range(repeat):
+            start = time.perf_counter()
+            for j in range(calls):
+                function(argument)
+            elapsed = (time.perf_counter() - start) / calls
+            if best is None or elapsed < best:
+                best = elapsed
+        result[operation] = best
+    return result
+
+def parse_override(setting):
+    override = {}
+    if setting is None or setting.strip() == '':
+        return override
+    for part in setting.split(','):
+        part = part.strip()
+        if '=' in part:
+            operation, name = [x.strip() for x in part.split('=', 1)]
+            if operation not in operations:
+                raise BackendError("%s: unknown operation %s" % (environment_variable, operation))
+            override[operation] = name
+        else:
+            for operation in operations:
+                override[operation] = part
+    return override
+
+# Tests the backends, benchmarks the ones needed, and fills in chosen.
+# Returns chosen.
+def select(setting=None, run_benchmark=True):
+    if setting is None:
+        setting = os.environ.get(environment_variable)
+    register_numpy()
+    override = parse_override(setting)
+    chosen.clear()
+    failed.clear()
+    timings.clear()
+    passed = []
+    for name, functions in backends.items():
+        try:
+            known_answer_tests(functions)
+            passed.append(name)
+        except Exception as e:
+            failed[name] = e
+    for operation, name in override.items():
+        if name not in backends:
+            raise BackendError("%s: unknown backend %s" % (environment_variable, name))
+        if name in failed:
+            raise BackendError("%s: backend %s failed its tests: %s" % (environment_variable, name, failed[name]))
+        chosen[operation] = name
+    if len(chosen) < len(operations):
+        if run_benchmark:
+            for name in passed:
+                timings[name] = benchmark(backends[name])
+        for operation in operations:
+            if operation in chosen:
+                continue
+            if 'reference' not in passed:
+                raise BackendError("The reference SHA-256 failed its tests: %s" % (failed['reference']))
+            if run_benchmark:
+                chosen[operation] = min(passed, key=lambda name: timings[name][operation])
+            else:
+                chosen[operation] = 'reference'
+    return chosen
+
+# select(), unless that has been done.  Returns chosen.
+def ready():
+    with selecting:
+        if len(chosen) == 0:
+            select()
+    return chosen
+
+def get(operation):
+    if len(chosen) == 0:
+        ready()
+    return backends[chosen[operation]][operation]
+
+def describe():
+    ready()
+    lines = []
+    for operation in operations:
+        line = "%s: %s" % (operation, chosen[operation])
+        if chosen[operation] in timings:
+            line = line + " (%.1f us)" % (1e6 * timings[chosen[operation]][operation])
+        lines.append(line)
+    for name, error in failed.items():
+        lines.append("%s failed: %s" % (name, error))
+    return lines
+
+if __name__ == '__main__':
+    for line in describe():
+        print(line)
@@ -0,0 +1,177 @@
+import collections
+import struct
+
+# Precompiled struct codecs for the structures in hf_protocol.h.
+#
+# Each codec is built from a layout: a list of (struct format code, field)
+# pairs in the order the members appear in the C structure.  The field is
+# either a name, or for a C bitfield word, a list of (name, width) pairs
+# from the least significant bit up, which is how gcc lays them out on
+# a little-endian machine.  Everything is little-endian and packed, just
+# like the __attribute__((packed)) structures.
+#
+# unpack() and iter_unpack() return namedtuples with one entry per name,
+# bitfields already split out.  pack() takes the values in that same
+# order and returns bytes.  Values out of range raise struct.error, or
+# CodecError for bitfields.
+
+class CodecError(Exception):
+    pass
+
+class Codec():
+    def __init__(self, name, layout):
+        self.name = name
+        fmt = '<'
+        names = []
+        # For each raw struct item: None for a plain field, otherwise
+        # a list of (shift, mask) for the bitfields packed into it.
+        self.bitfields = []
+        for code, field in layout:
+            fmt = fmt + code
+            if isinstance(field, str):
+                names.append(field)
+                self.bitfields.append(None)
+            else:
+                shift = 0
+                parts = []
+                for bitname, width in field:
+                    names.append(bitname)
+                    parts.append((shift, (1 << width) - 1))
+                    shift = shift + width
+                assert shift <= 8 * struct.calcsize('<' + code)
+                self.bitfields.append(parts)
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+        self.record = collections.namedtuple(name, names)
+        self.has_bitfields = any(x is not None for x in self.bitfields)
+
+    def expand(self, raw):
+        if not self.has_bitfields:
+            return self.record._make(raw)
+        values = []
+        for item, parts in zip(raw, self.bitfields):
+            if parts is None:
+                values.append(item)
+            else:
+                for shift, mask in parts:
+                    values.append((item >> shift) & mask)
+        return self.record._make(values)
+
+    def collapse(self, values):
+        if not self.has_bitfields:
+            return values
+        raw = []
+        i = 0
+        for parts in self.bitfields:
+            if parts is None:
+                raw.append(values[i])
+                i = i + 1
+            else:
+                word = 0
+                for shift, mask in parts:
+                    if values[i] < 0 or values[i] > mask:
+                        raise CodecError("%s.%s is out of range: %d"
+                                         % (self.name, self.record._fields[i], values[i]))
+                    word = word | (values[i] << shift)
+                    i = i + 1
+                raw.append(word)
+        return raw
+
+    def pack(self, *values):
+        if len(values) != len(self.record._fields):
+            raise CodecError("%s takes %d values, got %d"
+                             % (self.name, len(self.record._fields), len(values)))
+        return self.struct.pack(*self.collapse(values))
+
+    def pack_into(self, buffer, offset, *values):
+        self.struct.pack_into(buffer, offset, *self.collapse(values))
+
+    # buffer may be longer than the structure; the rest is ignored.
+    # A list of ints is accepted too, at the cost of a copy.
+    def unpack(self, buffer, offset=0):
+        if isinstance(buffer, list):
+            buffer = bytes(buffer)
+        return self.expand(self.struct.unpack_from(buffer, offset))
+
+    # For arrays of records.  len(buffer) must be a multiple of self.size.
+    def iter_unpack(self, buffer):
+        if isinstance(buffer, list):
+            buffer = bytes(buffer)
+        if not self.has_bitfields:
+            return map(self.record._make, self.struct.iter_unpack(buffer))
+        return map(self.expand, self.struct.iter_unpack(buffer))
+
+# OP_HASH serial data
+hf_hash_serial = Codec('hf_hash_serial', [
+    ('32s', 'midstate'),
+    ('4s',  'merkle_residual'),
+    ('I',   'timestamp'),
+    ('I',   'bits'),
+    ('I',   'starting_nonce'),
+    ('I',   'nonce_loops'),
+    ('H',   'ntime_loops'),
+    ('B',   'search_difficulty'),
+    ('B',   'option'),
+    ('B',   'group'),
+    ('3s',  'spare3')])
+assert hf_hash_serial.size == 60
+
+# OP_NONCE data
+hf_candidate_nonce = Codec('hf_candidate_nonce', [
+    ('I', 'nonce'),
+    ('H', 'sequence'),
+    ('H', 'ntime')])
+assert hf_candidate_nonce.size == 8
+
+# Start of OP_STATUS data
+hf_g1_monitor = Codec('hf_g1_monitor', [
+    ('H',  'die_temperature'),
+    ('6s', 'core_voltage')])
+assert hf_g1_monitor.size == 8
+
+# Start of OP_USB_INIT reply data
+hf_usb_init_base = Codec('hf_usb_init_base', [
+    ('H', 'firmware_rev'),
+    ('H', 'hardware_rev'),
+    ('I', 'serial_number'),
+    ('B', 'operation_status'),
+    ('B', 'extra_status_1'),
+    ('H', 'sequence_modulus'),
+    ('H', 'hash_clockrate'),
+    ('H', 'inflight_target')])
+assert hf_usb_init_base.size == 16
+
+# OP_CONFIG data, also follows hf_usb_init_base in the OP_USB_INIT reply.
+hf_config_data = Codec('hf_config_data', [
+    ('H', [('status_period', 11),
+           ('enable_periodic_status', 1),
+           ('send_status_on_core_idle', 1),
+           ('send_status_on_pending_empty', 1),
+           ('pwm_active_level', 1),
+           ('forward_all_privileged_packets', 1)]),
+    ('B', 'status_batch_delay'),
+    ('B', [('watchdog', 7),
+           ('disable_sensors', 1)]),
+    ('B', [('rx_header_timeout', 7),
+           ('rx_ignore_header_crc', 1)]),
+    ('B', [('rx_data_timeout', 7),
+           ('rx_ignore_data_crc', 1)]),
+    ('B', [('stats_interval', 7),
+           ('stat_diagnostic', 1)]),
+    ('B', 'measure_interval'),
+    ('I', [('one_usec', 12),
+           ('max_nonces_per_frame', 4),
+           ('voltage_sample_points', 8),
+           ('pwm_phases', 2),
+           ('trim', 4),
+           ('clock_diagnostic', 1),
+           ('forward_all_packets', 1)]),
+    ('H', 'pwm_period'),
+    ('H', 'pwm_pulse_period')])
+assert hf_config_data.size == 16
+
+# OP_USB_NOTICE data.  Only the fixed part; the NUL terminated message
+# follows it.
+hf_usb_notice_data = Codec('hf_usb_notice_data', [
+    ('I', 'extra_data')])
+assert hf_usb_notice_data.size == 4
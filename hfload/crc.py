@@ -27,6 +27,23 @@ def crc8(bytes):
         crc = crc8_table[crc ^ byte]
     return crc
 
+# crc8() is affine in its input: for messages of the same length,
+# crc8(a ^ b) == crc8(a) ^ crc8(b) ^ crc8(zeros).  So the crc8 of a
+# message is the crc8 of the all-zero message xor'ed with one
+# contribution per byte.  This builds the table of contributions for
+# the byte at position in a message of the given length, which lets a
+# caller patch a few bytes of a message and fix up its crc8 with one
+# lookup per changed byte.
+def build_crc8_position_table(length, position):
+    assert position >= 0 and position < length
+    message = [0] * length
+    zero_crc = crc8(message)
+    table = [0] * 256
+    for value in range(256):
+        message[position] = value
+        table[value] = crc8(message) ^ zero_crc
+    return table
+
 # The crc32_table was almost directly copied from tools/utils/crc.c with this comment:
 # /*
 #    The crc produced by this function is bit-reversed from my standard
@@ -0,0 +1,183 @@
+import fractions
+import struct
+
+# Targets and share difficulty.
+#
+# A hash here is the 32 bytes cgminer_regen_hash() returns, which as a
+# number is little-endian: the last byte is the most significant, the
+# same way count_leading_zeros() in hf.py reads it.  hash_to_int() does
+# that conversion once, and everything else is integer comparison.
+#
+#   bits_to_target()    compact "bits" from a block header to a target
+#   target_to_bits()    and back
+#   zerobits_target()   the target a search difficulty of n zero bits
+#                       amounts to, so zero bits and targets mix
+#   meets_target()      hash <= target
+#   share_difficulty()  diff1_target / hash, as pools count difficulty
+#   difficulty_target() the target for a pool difficulty
+#   hashes_per_share()  expected hashes for one hash <= target
+#
+# The batch functions take a list of hashes, or an (N, 32) uint8 array
+# such as sha256_np returns, which they handle with numpy without going
+# through Python ints.
+
+# The target for difficulty 1, bits 0x1d00ffff.
+diff1_bits = 0x1d00ffff
+diff1_target = 0xffff << 208
+
+two_to_256 = 1 << 256
+
+def hash_to_int(regen_hash):
+    return int.from_bytes(bytes(regen_hash), 'little')
+
+def zerobits(regen_hash):
+    return 256 - hash_to_int(regen_hash).bit_length()
+
+# Hashes with at least n zero bits are the ones <= this.
+def zerobits_target(n):
+    assert n >= 0 and n <= 256
+    return (1 << (256 - n)) - 1
+
+# Fix: Bitcoin treats a set sign bit (0x00800000) as a negative target,
+#      which can never be met.  We raise instead, since it means the
+#      bits are garbage.
+def bits_to_target(bits):
+    assert bits >= 0 and bits < 2**32
+    exponent = bits >> 24
+    mantissa = bits & 0x007fffff
+    if bits & 0x00800000:
+        raise ValueError("Negative compact target: 0x%08x" % (bits))
+    if exponent <= 3:
+        return mantissa >> (8 * (3 - exponent))
+    target = mantissa << (8 * (exponent - 3))
+    if target >= two_to_256:
+        raise ValueError("Compact target overflows 256 bits: 0x%08x" % (bits))
+    return target
+
+def target_to_bits(target):
+    assert target >= 0 and target < two_to_256
+    size = (target.bit_length() + 7) // 8
+    if size <= 3:
+        mantissa = target << (8 * (3 - size))
+    else:
+        mantissa = target >> (8 * (size - 3))
+    # The mantissa's top bit would read as a sign.
+    if mantissa & 0x00800000:
+        mantissa = mantissa >> 8
+        size = size + 1
+    return (size << 24) | mantissa
+
+def meets_target(regen_hash, target):
+    return hash_to_int(regen_hash) <= target
+
+def meets_bits(regen_hash, bits):
+    return meets_target(regen_hash, bits_to_target(bits))
+
+# A float, since it is a ratio.  An all zero hash gets infinity.
+def share_difficulty(regen_hash):
+    value = hash_to_int(regen_hash)
+    if value == 0:
+        return float('inf')
+    return diff1_target / value
+
+def target_difficulty(target):
+    assert target > 0
+    return diff1_target / target
+
+# Pools hand out difficulties below 1 as floats, so go through a
+# fraction to keep every bit of the target.
+def difficulty_target(difficulty):
+    assert difficulty > 0
+    target = int(fractions.Fraction(diff1_target) / fractions.Fraction(difficulty))
+    return min(target, two_to_256 - 1)
+
+# A hash is uniform over [0, 2**256), so a share takes 2**256 / (target + 1)
+# hashes on average.  For zerobits_target(n) that is exactly 2**n.
+def hashes_per_share(target):
+    assert target >= 0 and target < two_to_256
+    return two_to_256 / (target + 1)
+
+def is_array(hashes):
+    return type(hashes).__module__ == 'numpy' and hasattr(hashes, 'shape')
+
+# (N, 4) uint64, most significant word first, so that comparing rows
+# word by word compares the hashes.
+def hash_words(hashes):
+    import numpy as np
+    rows = np.ascontiguousarray(hashes, dtype=np.uint8).reshape(-1, 32)
+    return rows[:, ::-1].copy().view('>u8').astype(np.uint64)
+
+def target_words(target):
+    return struct.unpack('>4Q', target.to_bytes(32, 'big'))
+
+def hash_ints(hashes):
+    if is_array(hashes):
+        return [int.from_bytes(bytes(x), 'little') for x in hashes]
+    return [hash_to_int(x) for x in hashes]
+
+# A list of bools, or a bool array for an array.
+def meet_target(hashes, target):
+    if not is_array(hashes):
+        return [hash_to_int(x) <= target for x in hashes]
+    import numpy as np
+    words = hash_words(hashes)
+    limits = target_words(target)
+    # Lexicographic: below the target at the first word which differs,
+    # or equal all the way.
+    result = np.zeros(len(words), dtype=bool)
+    equal = np.ones(len(words), dtype=bool)
+    for i in range(4):
+        limit = np.uint64(limits[i])
+        result = result | (equal & (words[:, i] < limit))
+        equal = equal & (words[:, i] == limit)
+    return result | equal
+
+# A list of floats, or a float64 array for an array.  Doubles carry 53
+# bits, which is plenty for a ratio.
+def share_difficulties(hashes):
+    if not is_array(hashes):
+        return [share_difficulty(x) for x in hashes]
+    import numpy as np
+    words = hash_words(hashes).astype(np.float64)
+    values = ((words[:, 0] * 2.0**64 + words[:, 1]) * 2.0**64 + words[:, 2]) * 2.0**64 + words[:, 3]
+    with np.errstate(divide='ignore'):
+        return float(diff1_target) / values
+
+# Checks the batch functions against the one at a time ones, and the
+# compact conversions against known values.  Returns True, or raises
+# AssertionError.
+def self_test(count=64, seed=1):
+    import random
+    assert bits_to_target(diff1_bits) == diff1_target
+    assert target_to_bits(diff1_target) == diff1_bits
+    # Block 100000.
+    assert bits_to_target(0x1b04864c) == 0x04864c << 192
+    assert target_to_bits(0x04864c << 192) == 0x1b04864c
+    assert hashes_per_share(zerobits_target(34)) == 2**34
+    assert difficulty_target(1) == diff1_target
+    assert difficulty_target(2**-28) == diff1_target << 28
+    rnd = random.Random(seed)
+    hashes = []
+    for i in range(count):
+        value = rnd.getrandbits(256) >> rnd.randrange(0, 80)
+        hashes.append(value.to_bytes(32, 'little'))
+    target = hash_to_int(hashes[count // 2])
+    for x in hashes:
+        assert zerobits(x) >= 34 or not meets_target(x, zerobits_target(34))
+        assert meets_target(x, zerobits_target(zerobits(x)))
+        assert bits_to_target(target_to_bits(hash_to_int(x))) <= hash_to_int(x)
+    expected = [hash_to_int(x) <= target for x in hashes]
+    assert meet_target(hashes, target) == expected
+    try:
+        import numpy as np
+    except ImportError:
+        return True
+    rows = np.frombuffer(b''.join(hashes), dtype=np.uint8).reshape(-1, 32)
+    assert meet_target(rows, target).tolist() == expected
+    for a, b in zip(share_difficulties(rows), share_difficulties(hashes)):
+        assert abs(a - b) <= 1e-12 * b
+    return True
+
+if __name__ == '__main__':
+    self_test()
+    print("difficulty agrees with itself.")
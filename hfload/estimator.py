@@ -0,0 +1,237 @@
+import collections
+import math
+import statistics
+import threading
+import time
+
+# Hash rate from the good nonces as they come in, for every core, every
+# die and the whole board.
+#
+# A good nonce at a target stands for hashes_per_share() of it hashes,
+# and good nonces turn up as a Poisson process, so a rate is a count of
+# nonces over a stretch of time, scaled.  A Tracker keeps three of
+# them, each updated in constant time per nonce:
+#
+#   window  the last window seconds, as a ring of buckets with running
+#           sums.  A bucket's counts come off the sums when the ring
+#           moves past it, so the window starts within one bucket width
+#           of window seconds ago.
+#   ewma    exponentially weighted: a nonce age seconds old counts
+#           e**(-age / tau).  Follows a change within a few tau.
+#   total   everything since the estimator started.
+#
+# Each comes back as a Rate, hashes a second with a confidence interval
+# from the Poisson interval on the nonce count.  The interval uses the
+# Wilson-Hilferty approximation to the chi-square quantiles, which is
+# within 1% of the exact bounds from two nonces on.  For ewma the count
+# is the weighted one, which if anything makes the interval too wide.
+# Until a tracker has a nonce, it scales its interval by the hashes the
+# latest nonce anywhere stood for, so a silent core still gets an upper
+# bound.
+#
+# add() is called from the loop which sees the verdicts, the queries
+# from any thread.  One lock covers both, held for a few arithmetic
+# operations, so a monitor thread polling every tenth of a second
+# costs the loop nothing to speak of.
+
+Rate = collections.namedtuple('Rate', ['rate', 'lower', 'upper', 'nonces', 'seconds'])
+
+kinds = ('window', 'ewma', 'total')
+
+# Bounds on the mean of a Poisson count, two sided with normal
+# quantile z.
+def poisson_interval(count, z):
+    if count > 0:
+        lower = max(count * (1 - 1 / (9 * count) - z / (3 * math.sqrt(count))) ** 3, 0.0)
+    else:
+        lower = 0.0
+    n = count + 1
+    upper = n * (1 - 1 / (9 * n) + z / (3 * math.sqrt(n))) ** 3
+    return (lower, upper)
+
+def rate_interval(count, hashes, seconds, weight, z):
+    if seconds <= 0:
+        return Rate(0.0, 0.0, float('inf'), count, 0.0)
+    if count > 0:
+        weight = hashes / count
+    lower, upper = poisson_interval(count, z)
+    return Rate(hashes / seconds, lower * weight / seconds, upper * weight / seconds, count, seconds)
+
+class Tracker():
+    __slots__ = ('start', 'width', 'size', 'counts', 'hashes', 'head',
+                 'window_count', 'window_hashes',
+                 'tau', 'ewma_count', 'ewma_hashes', 'ewma_time',
+                 'total_count', 'total_hashes')
+
+    def __init__(self, start, window, buckets, tau):
+        self.start = start
+        self.width = window / buckets
+        self.size = buckets
+        self.counts = [0] * buckets
+        self.hashes = [0.0] * buckets
+        # The newest bucket, counting from start.
+        self.head = 0
+        self.window_count = 0
+        self.window_hashes = 0.0
+        self.tau = tau
+        # As of ewma_time.
+        self.ewma_count = 0.0
+        self.ewma_hashes = 0.0
+        self.ewma_time = start
+        self.total_count = 0
+        self.total_hashes = 0.0
+
+    # Moves the ring up to now, emptying the buckets it passes.  Each
+    # bucket is emptied once per trip round the ring, so this is
+    # constant time per call on average, and never more than the size.
+    def advance(self, now):
+        index = int((now - self.start) / self.width)
+        if index <= self.head:
+            return
+        if index - self.head >= self.size:
+            self.counts = [0] * self.size
+            self.hashes = [0.0] * self.size
+            self.window_count = 0
+            self.window_hashes = 0.0
+        else:
+            for i in range(self.head + 1, index + 1):
+                bucket = i % self.size
+                self.window_count = self.window_count - self.counts[bucket]
+                self.window_hashes = self.window_hashes - self.hashes[bucket]
+                self.counts[bucket] = 0
+                self.hashes[bucket] = 0.0
+            # Keep rounding from piling up.
+            if self.window_count == 0:
+                self.window_hashes = 0.0
+        self.head = index
+
+    def add(self, now, hashes):
+        now = max(now, self.start)
+        self.advance(now)
+        # A nonce from before the head, because its verdict came late,
+        # still goes in its own bucket if that is in the window.
+        index = int((now - self.start) / self.width)
+        if index > self.head - self.size:
+            bucket = index % self.size
+            self.counts[bucket] = self.counts[bucket] + 1
+            self.hashes[bucket] = self.hashes[bucket] + hashes
+            self.window_count = self.window_count + 1
+            self.window_hashes = self.window_hashes + hashes
+        if now >= self.ewma_time:
+            decay = math.exp((self.ewma_time - now) / self.tau)
+            self.ewma_count = self.ewma_count * decay + 1
+            self.ewma_hashes = self.ewma_hashes * decay + hashes
+            self.ewma_time = now
+        else:
+            decay = math.exp((now - self.ewma_time) / self.tau)
+            self.ewma_count = self.ewma_count + decay
+            self.ewma_hashes = self.ewma_hashes + hashes * decay
+        self.total_count = self.total_count + 1
+        self.total_hashes = self.total_hashes + hashes
+
+    def window(self, now, weight, z):
+        self.advance(now)
+        oldest = self.start + (self.head - self.size + 1) * self.width
+        seconds = now - max(oldest, self.start)
+        return rate_interval(self.window_count, self.window_hashes, seconds, weight, z)
+
+    def ewma(self, now, weight, z):
+        decay = math.exp(min(self.ewma_time - now, 0) / self.tau)
+        # The weights of the time watched, which the weighted count is
+        # measured against.
+        seconds = self.tau * (1 - math.exp((self.start - now) / self.tau))
+        return rate_interval(self.ewma_count * decay, self.ewma_hashes * decay, seconds, weight, z)
+
+    def total(self, now, weight, z):
+        return rate_interval(self.total_count, self.total_hashes, now - self.start, weight, z)
+
+class HashRateEstimator():
+    # window and tau are in seconds, confidence is the interval's
+    # coverage.  clock is for tests.
+    def __init__(self, dies, cores, window=60.0, buckets=60, tau=60.0, confidence=0.95,
+                 clock=time.time):
+        assert window > 0 and buckets > 0 and tau > 0
+        assert confidence > 0 and confidence < 1
+        self.window_seconds = window
+        self.tau = tau
+        self.z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+        self.clock = clock
+        self.start = clock()
+        self.lock = threading.Lock()
+        # Hashes the latest nonce stood for.
+        self.weight = 0.0
+        self.board_tracker = Tracker(self.start, window, buckets, tau)
+        self.die_trackers = [Tracker(self.start, window, buckets, tau) for die in range(dies)]
+        self.core_trackers = [[Tracker(self.start, window, buckets, tau) for core in range(cores)]
+                              for die in range(dies)]
+
+    # A good nonce standing for hashes hashes, found at now.
+    def add(self, die, core, hashes, now=None):
+        if now is None:
+            now = self.clock()
+        with self.lock:
+            self.weight = hashes
+            self.board_tracker.add(now, hashes)
+            self.die_trackers[die].add(now, hashes)
+            self.core_trackers[die][core].add(now, hashes)
+
+    def query(self, trackers, kind):
+        assert kind in kinds
+        now = self.clock()
+        with self.lock:
+            return [getattr(tracker, kind)(now, self.weight, self.z) for tracker in trackers]
+
+    def board(self, kind='window'):
+        return self.query([self.board_tracker], kind)[0]
+
+    def die(self, die, kind='window'):
+        return self.query([self.die_trackers[die]], kind)[0]
+
+    def core(self, die, core, kind='window'):
+        return self.query([self.core_trackers[die][core]], kind)[0]
+
+    # Rates for every die, by die.
+    def dies(self, kind='window'):
+        return self.query(self.die_trackers, kind)
+
+    # Rates for every core on die, by core.
+    def cores(self, die, kind='window'):
+        return self.query(self.core_trackers[die], kind)
+
+def self_test():
+    # The exact 95% bounds for a count of 10 are 4.795 and 18.390.
+    lower, upper = poisson_interval(10, statistics.NormalDist().inv_cdf(0.975))
+    assert abs(lower - 4.795) < 0.01 * 4.795 and abs(upper - 18.390) < 0.01 * 18.390
+    now = [0.0]
+    estimator = HashRateEstimator(1, 2, window=10.0, buckets=10, tau=10.0, clock=lambda: now[0])
+    # A nonce a second, each standing for 100 hashes.
+    for i in range(10):
+        estimator.add(0, 0, 100.0, i + 0.5)
+    now[0] = 10.0
+    # The window has moved past the first bucket, so it covers the last
+    # nine seconds and nine nonces.
+    window = estimator.board()
+    assert window.nonces == 9 and abs(window.seconds - 9.0) < 1e-9
+    assert abs(window.rate - 100.0) < 1e-9
+    assert window.lower < window.rate < window.upper
+    total = estimator.board('total')
+    assert total.nonces == 10 and abs(total.rate - 100.0) < 1e-9
+    ewma = estimator.die(0, 'ewma')
+    assert abs(ewma.rate - 100.0) < 1.0
+    assert estimator.core(0, 0) == window
+    # A late verdict still lands in its own bucket.
+    estimator.add(0, 0, 100.0, 3.2)
+    assert estimator.board().nonces == 10
+    # A core without a nonce gets a rate of nothing, but an upper bound
+    # from the hashes the latest nonce stood for.
+    silent = estimator.core(0, 1)
+    assert silent.nonces == 0 and silent.rate == 0.0 and silent.upper > 0.0
+    # Once the window has passed every nonce, it is empty.
+    now[0] = 25.0
+    assert estimator.board().nonces == 0 and estimator.board('total').nonces == 11
+    assert estimator.cores(0, 'total')[0].nonces == 11
+    return True
+
+if __name__ == '__main__':
+    self_test()
+    print("estimator agrees with itself.")
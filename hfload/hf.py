@@ -1,17 +1,21 @@
+import array
+import collections
 import ctypes
 import random
+import struct
 import sys
 import time
 
+from . import backends
+from . import codec
 from . import crc
-from . import sha256
 
 assert sys.version_info.major >= 3
 
 # Fix: Drop "HF" from most class names.  The module is called "hf", that's enough.
 # Fix: Think about how to capture traffic.  Need timestamps.
 # Fix: Put the CRC32 stuff back in when we switch to direct access to the serial line.
-# Fix: Test code should be written for this module.
+# Fix: self_test() only covers the parsers and Send.  The rest needs tests too.
 # Fix: Don't forget the documentation.
 # Fix: We may also want to keep track of serial line saturation.  How much of
 #      the serial line bandwidth are we using?  How much clumping is happening?
@@ -27,6 +31,8 @@ SEND = 2
 RECEIVE = 3
 SEND_MAX = 4
 RECEIVE_MAX = 5
+RECEIVE_INTO = 6
+RECEIVE_TIMEOUT = 7
 
 # Operation codes from hf_protocol.h.
 opcodes = {
@@ -88,6 +94,15 @@ PROTOCOL_GLOBAL_WORK_QUEUE = 1
 HF_NTIME_MASK = 0x0fff       # Mask for for ntime
 # If this bit is set, search forward for other nonce(s)
 HF_NONCE_SEARCH = 0x1000     # Search bit in candidate_nonce -> ntime
+
+# How far forward HF_NONCE_SEARCH asks us to look, as cgminer does.
+nonce_search_span = 128
+
+# From hf_protocol.h
+HF_BROADCAST_ADDRESS = 0xff
+
+# Frames which make the queued OP_HASH work stale.
+abort_opcodes = set([opcodes['OP_ABORT'], opcodes['OP_WORK_RESTART']])
     
 class HF_Error(Exception):
     pass
@@ -101,114 +116,306 @@ class HF_InternalError(HF_Error):
 # Fix: Might be less confusing to have a single object which can
 #      both send and receive -- and in the future we may want
 #      some state, so it would be good if it was in one place.
-# Fix: Maybe we want two queues.  One is a list of packets,
-#      the other is the continuous stream of bytes.  Let's
-#      say we want to abort everything that's going on.  Then,
-#      we would like to kill the packets and immediately send
-#      the OP_ABORT broadcast without losing the sync with
-#      the dies.
-# Fix: We also need a separate queueing function which does
-#      not immediately send.  The reason is that we may have
-#      occasion to set up many packets at once within the
-#      state machine, but we don't want to do the USB back
-#      and forth at that particular time.
+#
+# schedule() only queues bytes.  The queue goes out in flush(), as a
+# single USB transfer written in pieces of up to max_transfer bytes,
+# so a whole batch of frames costs a handful of talkusb() calls
+# instead of one per 64 byte packet.  flush() happens when asked for,
+# when the queue reaches flush_size bytes, or from schedule() or
+# service() when the oldest queued byte is older than flush_age
+# seconds.  send() is schedule() followed by flush(), so send([])
+# just pushes out whatever is queued.
+#
+# There are two lanes.  The normal lane is the queue above.  The
+# control lane, fed by schedule_control(), abort() and work_restart(),
+# always goes out first and is flushed right away.  Since whole frames
+# are written, the dies never lose sync.  Queuing an OP_ABORT or an
+# OP_WORK_RESTART also cuts the OP_HASH frames still waiting in the
+# normal lane for the chips it applies to, so no stale work follows
+# the abort onto the wire.  The time from queuing such a frame to the
+# end of the talkusb() call that wrote it is kept in the abort_latency
+# counters; other control frames are not counted.
+#
+# The cut frames never reach the device, so whoever sent them has work
+# on its books which will never run.  schedule_control(), abort() and
+# work_restart() return (chip, core, sequence) for each, and on_drop,
+# if given, is called with the same list.
 class Send():
-    def __init__(self, talkusb):
+    def __init__(self, talkusb, max_transfer=4096, flush_size=None, flush_age=0.005,
+                 on_drop=None):
         self.talkusb = talkusb
-        self.queue = []
+        self.on_drop = on_drop
+        self.queue = bytearray()
+        self.queued_since = None
+        # (start, end, operation code, chip address) for each frame in
+        # the queue.  The codes are None for bytes that are not frames.
+        self.frames = collections.deque()
+        self.control = bytearray()
+        self.control_since = None
+        # When the oldest OP_ABORT or OP_WORK_RESTART in control was queued.
+        self.abort_since = None
+        # USB packet size.
         self.max_send = self.talkusb(SEND_MAX, None, 0)
+        # Keep every piece of a transfer except the last a whole
+        # number of packets, so the device only sees a short packet
+        # at the very end.
+        self.max_transfer = max(self.max_send, max_transfer - max_transfer % self.max_send)
+        if flush_size is None:
+            flush_size = self.max_transfer
+        self.flush_size = flush_size
+        self.flush_age = flush_age
+        self.transfers = 0
+        self.bytes_sent = 0
+        self.zero_length_packets = 0
+        self.control_frames = 0
+        self.dropped_frames = 0
+        self.dropped_bytes = 0
+        self.aborts = 0
+        self.abort_latency_count = 0
+        self.abort_latency_last = None
+        self.abort_latency_max = 0.0
+        self.abort_latency_total = 0.0
 
     # Fix: Maybe schedule -> send, and send -> transmit.
+    # byteslist may be a list of ints or anything bytes-like, such as
+    # HF_Frame.buffer.  bytearray.extend() raises ValueError if any
+    # value is out of range.
     def schedule(self, byteslist):
-        raise HF_Error("schedule() is temporarily out of service.")
-        assert len(byteslist) == 0 or {x >= 0 and x < 256 for x in byteslist} == set([True])
-        if byteslist != None and len(byteslist) > 0:
-            self.queue = self.queue + byteslist
+        if len(byteslist) > 0:
+            if self.queued_since is None:
+                self.queued_since = time.time()
+            start = len(self.queue)
+            self.queue.extend(byteslist)
+            self.mark_frames(start)
+        if len(self.queue) >= self.flush_size:
+            self.flush()
+        else:
+            self.service()
+
+    # Note where each frame in queue[start:] begins and ends.  Anything
+    # that doesn't walk as a run of whole frames is kept as one span
+    # which is never dropped.
+    def mark_frames(self, start):
+        queue = self.queue
+        end = len(queue)
+        while start < end:
+            if queue[start] == 0xaa and start + 8 <= end:
+                frame_end = start + 8 + 4 * queue[start+6]
+                if frame_end <= end:
+                    self.frames.append((start, frame_end, queue[start+1], queue[start+2]))
+                    start = frame_end
+                    continue
+            self.frames.append((start, end, None, None))
+            return
+
+    # byteslist must be whole frames.  Returns the OP_HASH frames cut,
+    # as (chip, core, sequence).
+    def schedule_control(self, byteslist):
+        framebytes = bytes(byteslist)
+        now = time.time()
+        if self.control_since is None:
+            self.control_since = now
+        self.control.extend(framebytes)
+        self.control_frames = self.control_frames + 1
+        dropped = []
+        position = 0
+        while position + 8 <= len(framebytes):
+            if framebytes[position] != 0xaa:
+                raise HF_Error("schedule_control() needs whole frames.")
+            if framebytes[position+1] in abort_opcodes:
+                self.aborts = self.aborts + 1
+                if self.abort_since is None:
+                    self.abort_since = now
+                dropped.extend(self.drop_hash_frames(framebytes[position+2]))
+            position = position + 8 + 4 * framebytes[position+6]
+        self.flush()
+        if dropped and self.on_drop is not None:
+            self.on_drop(dropped)
+        return dropped
+
+    # Remove the queued OP_HASH frames for chip_address, or for every
+    # chip if chip_address is HF_BROADCAST_ADDRESS.  Returns them as
+    # (chip, core, sequence).
+    def drop_hash_frames(self, chip_address):
+        op_hash = opcodes['OP_HASH']
+        queue = self.queue
+        kept = bytearray()
+        frames = collections.deque()
+        dropped = []
+        for start, end, operation_code, chip in self.frames:
+            if operation_code == op_hash and \
+                    (chip_address == HF_BROADCAST_ADDRESS or chip == chip_address):
+                self.dropped_frames = self.dropped_frames + 1
+                self.dropped_bytes = self.dropped_bytes + end - start
+                dropped.append((chip, queue[start+3], queue[start+4] | (queue[start+5] << 8)))
+            else:
+                frames.append((len(kept), len(kept) + end - start, operation_code, chip))
+                kept.extend(self.queue[start:end])
+        self.queue = kept
+        self.frames = frames
+        if len(self.queue) == 0:
+            self.queued_since = None
+        return dropped
+
+    def abort(self, chip_address=None):
+        if chip_address is None:
+            chip_address = HF_BROADCAST_ADDRESS
+        op_abort = HF_Frame({'operation_code': opcodes['OP_ABORT'], \
+                             'chip_address': chip_address})
+        return self.schedule_control(op_abort.buffer)
+
+    # See the OP_WORK_RESTART notes in hf_protocol.h for hdata and
+    # die_bitmap.  Zero for both is a plain restart.
+    def work_restart(self, hdata=0, die_bitmap=None):
+        frame = {'operation_code': opcodes['OP_WORK_RESTART'], \
+                 'chip_address': HF_BROADCAST_ADDRESS, \
+                 'hdata': hdata}
+        if die_bitmap is not None:
+            frame['data'] = int_to_lebytes(die_bitmap, 4)
+        return self.schedule_control(HF_Frame(frame).buffer)
+
+    def service(self):
+        if self.queued_since is not None and \
+                time.time() - self.queued_since >= self.flush_age:
+            self.flush()
 
     def send(self, byteslist):
-        assert len(byteslist) == 0 or {x >= 0 and x < 256 for x in byteslist} == set([True])
-#        if byteslist != None and len(byteslist) > 0:
-#            self.queue = self.queue + byteslist
-        sendsize = 0
-        mybyteslist = byteslist.copy()
-        while len(mybyteslist) > 0:
-            sendsize = min(self.max_send, len(mybyteslist))
-#            sendstuff = ctypes.create_string_buffer(bytes(mybyteslist[0:sendsize]))
-            sendstuff = mybyteslist[0:sendsize]
-            mybyteslist = mybyteslist[sendsize:]
-#            print("Send:send(): Queue: %d bytes  Sending %d bytes. Bytes: %s"
-#                  % (len(self.queue), sendsize, ["0x%02x" % (x) for x in self.queue[0:sendsize]]))
-            while len(sendstuff) > 0:
-                sendstuff_package = sendstuff.copy() #ctypes.create_string_buffer(bytes(sendstuff))
-                rslt = self.talkusb(SEND, sendstuff_package, sendsize)
-                if rslt > 0:
-#                self.queue = self.queue[rslt:]
-                    sendstuff = sendstuff[rslt:]
-                elif rslt == 0:
-                    pass
-                else:
-                    raise HF_Error("Bad call trying to send using talkusb(): %d" % (rslt))
-            # If we sent the maximum size, we need to send a zero
-            # length packet so that the other side knows the send is
-            # done.  (A surprising consequence of the design of USB.)
-        if sendsize == self.max_send:
-#                print("Send:send(): sending zero length packet.")
+        self.schedule(byteslist)
+        self.flush()
+
+    def flush(self):
+        if len(self.control) > 0:
+            outgoing = self.control
+            since = self.abort_since
+            self.control = bytearray()
+            self.control_since = None
+            self.abort_since = None
+            self.transmit(outgoing)
+            if since is not None:
+                latency = time.time() - since
+                self.abort_latency_count = self.abort_latency_count + 1
+                self.abort_latency_last = latency
+                self.abort_latency_max = max(self.abort_latency_max, latency)
+                self.abort_latency_total = self.abort_latency_total + latency
+        if len(self.queue) > 0:
+            outgoing = self.queue
+            self.queue = bytearray()
+            self.queued_since = None
+            self.frames = collections.deque()
+            self.transmit(outgoing)
+
+    def abort_latency_average(self):
+        if self.abort_latency_count == 0:
+            return None
+        return self.abort_latency_total / self.abort_latency_count
+
+    def transmit(self, outgoing):
+        sent = 0
+        while sent < len(outgoing):
+            sendsize = min(self.max_transfer, len(outgoing) - sent)
+            rslt = self.talkusb(SEND, bytes(outgoing[sent:sent+sendsize]), sendsize)
+            if rslt > 0:
+                sent = sent + rslt
+            elif rslt == 0:
+                pass
+            else:
+                raise HF_Error("Bad call trying to send using talkusb(): %d" % (rslt))
+        self.transfers = self.transfers + 1
+        self.bytes_sent = self.bytes_sent + sent
+        # If the transfer ended on a full packet, we need to send a
+        # zero length packet so that the other side knows the send is
+        # done.  (A surprising consequence of the design of USB.)
+        if len(outgoing) % self.max_send == 0:
             empty = ctypes.create_string_buffer(0)
             self.talkusb(SEND, empty, 0);
-
-##    def send(self, byteslist):
-##        assert len(byteslist) == 0 or {x >= 0 and x < 256 for x in byteslist} == set([True])
-##        if byteslist != None and len(byteslist) > 0:
-##            self.queue = self.queue + byteslist
-##        if len(self.queue) > 0:
-##            sendsize = min(self.max_send, len(self.queue))
-##            sendstuff = ctypes.create_string_buffer(bytes(self.queue[0:sendsize]))
-###            print("Send:send(): Queue: %d bytes  Sending %d bytes. Bytes: %s"
-###                  % (len(self.queue), sendsize, ["0x%02x" % (x) for x in self.queue[0:sendsize]]))
-##            rslt = self.talkusb(SEND, sendstuff, sendsize)
-##            if rslt > 0:
-##                self.queue = self.queue[rslt:]
-##            elif rslt == 0:
-##                pass
-##            else:
-##                raise HF_Error("Bad call trying to send using talkusb(): %d" % (rslt))
-##            # If we sent the maximum size, we need to send a zero
-##            # length packet so that the other side knows the send is
-##            # done.  (A surprising consequence of the design of USB.)
-##            if sendsize == self.max_send:
-###                print("Send:send(): sending zero length packet.")
-##                empty = ctypes.create_string_buffer(0)
-##                self.talkusb(SEND, empty, 0);
-
+            self.zero_length_packets = self.zero_length_packets + 1
+
+# receive() collects traffic, read() hands it over as bytes.
+#
+# If talkusb() supports RECEIVE_INTO, each poll is one bulk read of a
+# single packet, straight into a preallocated array, with a timeout of
+# timeout milliseconds.  Otherwise each poll is a single RECEIVE of one
+# packet.
+#
+# Fix: Reads are one packet on purpose.  A read of several packets only
+#      ends early on a short packet; if a burst ends on a packet
+#      boundary and the device sends no zero length packet, the read
+#      times out, and pyusb throws away what it had already read, whole
+#      frames from the middle of the stream.  A one packet read which
+#      times out has read nothing.  Going back to bigger reads needs the
+#      firmware to end every IN transfer with a short or zero length
+#      packet.
+#
+#      So this does not cut the number of USB round trips: a burst is
+#      still one bulk read per 64 byte packet, as with RECEIVE.  What it
+#      does cut is the work around each read, with no allocation per
+#      read, no list of ints, a short timeout and fewer empty polls.
+#      Sizing reads to the packets already pending would need the
+#      device to say how many that is, which it doesn't.
+#
+# The number of polls adapts to the traffic.  After a poll finds data,
+# keep polling as long as the reads come back full, up to max_packets
+# reads in all, since there is more waiting.  Before data is found,
+# receive() polls up to polls times.  That goes up to however many
+# polls it took to find data, and down by one on each cycle that found
+# nothing at all, but never below min_polls or above max_polls.
 class Receive():
-    def __init__(self, talkusb):
+    def __init__(self, talkusb, timeout=2, min_polls=1, max_polls=4, max_packets=64):
         self.talkusb = talkusb
-        self.queue = []
+        self.queue = bytearray()
         self.max_receive = self.talkusb(RECEIVE_MAX, None, 0)
+        self.min_polls = min_polls
+        self.max_polls = max_polls
+        self.max_packets = max_packets
+        self.polls = max_polls
+        self.reads = 0
+        self.empty_reads = 0
+        self.bytes_received = 0
+        self.buffer = None
+        if self.talkusb(RECEIVE_TIMEOUT, None, timeout) == 0:
+            self.buffer = array.array('B', bytes(self.max_receive))
+            self.view = memoryview(self.buffer)
+
+    def poll(self):
+        self.reads = self.reads + 1
+        if self.buffer is not None:
+            rslt = self.talkusb(RECEIVE_INTO, self.buffer, len(self.buffer))
+            if rslt > 0:
+                self.queue.extend(self.view[0:rslt])
+        else:
+            rslt = self.talkusb(RECEIVE, None, self.max_receive)
+            if not isinstance(rslt, int):
+                self.queue.extend(rslt)
+                rslt = len(rslt)
+        if rslt == 0:
+            self.empty_reads = self.empty_reads + 1
+        elif rslt < 0:
+            raise HF_Error("Bad call trying to receive using talkusb(): %d" % (rslt))
+        self.bytes_received = self.bytes_received + rslt
+        return rslt
 
     def receive(self):
-#        print("Receive:receive() called.")
         # The Atmel USB code has an odd feature that it has to be
         # asked four times before it responds with the packet.  This
         # is true even if the requests are delayed for a second.  So
-        # we ask until we get data or we asked four times.
-        for i in range(4):
-            buf = "" #ctypes.create_string_buffer(self.max_receive)
-            rslt = self.talkusb(RECEIVE, buf, self.max_receive)
-            buf = rslt
-            rslt = len(buf)
-#            print("Receive:receive(): got %d bytes" % (rslt))
+        # we ask until we get data or we asked four times.  Or
+        # however many times it has taken lately, see above.
+        for i in range(self.polls):
+            rslt = self.poll()
             if rslt > 0:
-                self.queue = self.queue + list(buf[0:rslt])
                 break
-            elif rslt == 0:
-                pass
-            else:
-                raise HF_Error("Bad call trying to receive using talkusb(): %d" % (rslt))
+        else:
+            self.polls = max(self.min_polls, self.polls - 1)
+            return
+        self.polls = min(self.max_polls, max(self.polls, i + 1))
+        for i in range(self.max_packets - 1):
+            if rslt < self.max_receive:
+                break
+            rslt = self.poll()
 
     def read(self):
-        result = self.queue
-        self.queue = []
+        result = bytes(self.queue)
+        self.queue = bytearray()
         return result
 
 # Adapted from hf_protocol.h.
@@ -222,14 +429,19 @@ def GN_DIE_TEMPERATURE(a):
     return (float(a)*float(240))/4096.0 - 61.5
 
 class Garbage():
+    __slots__ = ('garbage',)
+
     def __init__(self, garbage):
         self.garbage = garbage
 
     def read(self):
         return self.garbage
 
+# Accepts a list of byte values or anything bytes() accepts.  Out of
+# range values make bytes() raise ValueError, so there is no need to
+# check every byte by hand.
 def check_framebytes(framebytes):
-    assert {x >= 0 and x < 256 for x in framebytes} == set([True])
+    framebytes = bytes(framebytes)
     assert len(framebytes) >= 8
     assert framebytes[0] == 0xaa
     assert framebytes[7] == crc.crc8(framebytes[1:7])
@@ -242,38 +454,23 @@ def check_framebytes(framebytes):
         # expected_framebytes_length = 8 + data_length + 4
         expected_framebytes_length = 8 + data_length
         assert expected_framebytes_length == len(framebytes)
-        data = framebytes[8:8+data_length]
 # Fix: Restore when using serial line directly
+#        data = framebytes[8:8+data_length]
 #        crc32 = framebytes[-4:]
 #        if crc32 != crc.crc32_to_bytelist(crc.crc32(data)):
 #            raise HF_Error("Bad CRC32 checksum.")
 
+# bytes() raises ValueError for values out of range.
 def lebytes_to_int(lebytes):
-    assert {x >= 0 and x < 256 for x in lebytes} == set([True])
-    accum = 0
-    pow = 1
-    while lebytes:
-        accum = accum + pow * lebytes[0]
-        pow = 256 * pow
-        lebytes = lebytes[1:]
-    return accum
+    return int.from_bytes(bytes(lebytes), 'little')
 
 def int_to_lebytes(integer, digit):
     assert digit > 0
     assert integer >= 0 and integer < 256 ** digit
-    result = []
-    for i in range(digit):
-        result = result + [integer % 256]
-        integer = integer >> 8
-    return result
+    return list(integer.to_bytes(digit, 'little'))
 
 # Fix: Document terminology: frame is the whole thing and consists of up to
 #      three parts: the header, the data, and the CRC32 checksum.
-# Fix: Wants to verify checksums and throw exception if they are not right.
-#      And check for 0xaa.
-# Fix: Wants to make all the fields of the header accessible, but also provide raw bytes.
-# Fix: Should be able to initialize with stream of bytes or by filling in fields
-#      and asking for the bytes.  Throw exception if field values are out of bounds.
 # Fix: Maybe want something which checks for known opcode and whether fields are
 #      plausible for that opcode -- problem is that if we are using this to report
 #      what was seen on the wire, we need to make those assumptions, maybe.
@@ -281,56 +478,85 @@ def int_to_lebytes(integer, digit):
 #      and then have specific methods for that type.  Probably more trouble than
 #      its worth, but it would also let us have specific methods for parameters
 #      that just occupy a couple bits.
+#
+# A frame is a single immutable bytes object, self.buffer, holding
+# exactly what goes over the wire.  The header fields are decoded from
+# the buffer when they are asked for, and self.data is a memoryview
+# into the buffer, so nothing is copied after the frame is built.
+# self.framebytes and self.databytes are still there for code that
+# wants lists of ints, as both used to be, but they build a new list
+# every time, so keep them out of hot loops.
 class HF_Frame():
+    __slots__ = ('buffer',)
+
     def __init__(self, initial_state):
         self.initialize()
         if initial_state is None:
             pass
-        elif isinstance(initial_state, list):
+        elif isinstance(initial_state, (bytes, bytearray, list)):
             self.off_the_wire(initial_state)
         elif isinstance(initial_state, dict):
             self.buildframe(initial_state)
         else:
-            raise HF_Error("Argument type not supported: %s" % (inital_state))
+            raise HF_Error("Argument type not supported: %s" % (initial_state))
 
     def initialize(self):
-        self.framebytes = []
-        self.operation_code = None
-        self.chip_address = 0
-        self.core_address = 0
-        self.hdata = 0
-        self.data_length_field = 0
-        self.crc8 = 0
-        self.data = None
-# Fix: Restore when using serial line directly
-#        self.crc32 = None
-        self.data_length = 0;
+        self.buffer = b''
 
     def off_the_wire(self, framebytes):
-        check_framebytes(framebytes)
-        self.framebytes = framebytes
-        self.operation_code = framebytes[1]
-        self.chip_address = framebytes[2]
-        self.core_address = framebytes[3]
-        self.hdata = lebytes_to_int(framebytes[4:6])
-        self.data_length_field = framebytes[6]
-        self.data_length = 4 * self.data_length_field
-        self.crc8 = framebytes[7]
-        if self.data_length > 0:
-            assert {x >= 0 and x < 256 for x in framebytes} == set([True])
-            self.data = framebytes[8:8+self.data_length]
-# Fix: Restore when using serial line directly
-#            self.crc32 = framebytes[8+self.data_length:]
+        # bytes() of a bytes object is the same object, not a copy.
+        buffer = bytes(framebytes)
+        check_framebytes(buffer)
+        self.buffer = buffer
+
+    @property
+    def framebytes(self):
+        return list(self.buffer)
+
+    @property
+    def operation_code(self):
+        return self.buffer[1]
+
+    @property
+    def chip_address(self):
+        return self.buffer[2]
+
+    @property
+    def core_address(self):
+        return self.buffer[3]
+
+    @property
+    def hdata(self):
+        return self.buffer[4] | (self.buffer[5] << 8)
+
+    @property
+    def data_length_field(self):
+        return self.buffer[6]
+
+    @property
+    def data_length(self):
+        return 4 * self.buffer[6]
+
+    @property
+    def crc8(self):
+        return self.buffer[7]
+
+    @property
+    def data(self):
+        if self.buffer[6] == 0:
+            return None
+        # Fix: Restore when using serial line directly
+        #      (The CRC32 follows the data.)
+        return memoryview(self.buffer)[8:8+4*self.buffer[6]]
+
+    @property
+    def databytes(self):
+        if self.buffer[6] == 0:
+            return None
+        return list(self.buffer[8:8+4*self.buffer[6]])
 
     def construct_framebytes(self):
-        frameheader = [0xaa, self.operation_code, self.chip_address, self.core_address] + \
-            int_to_lebytes(self.hdata, 2) + [self.data_length_field, self.crc8]
-        if self.data_length > 0:
-# Fix: Restore when using serial line directly
-#            return frameheader + self.data + crc.crc32_to_bytelist(self.crc32)
-            return frameheader + self.data
-        else:
-            return frameheader
+        return list(self.buffer)
 
     def buildframe(self, framedict):
         legal_fields = set(['operation_code', 'chip_address', 'core_address', 'hdata', 'data'])
@@ -338,32 +564,33 @@ class HF_Frame():
         assert received_fields.issubset(legal_fields)
         assert 'operation_code' in framedict
         assert framedict['operation_code'] in opnames
-        self.operation_code = framedict['operation_code']
+        operation_code = framedict['operation_code']
+        chip_address = 0
+        core_address = 0
+        hdata = 0
+        data = b''
         if 'chip_address' in framedict:
             if framedict['chip_address'] < 0 or framedict['chip_address'] > 255:
                 raise HF_Error("chip_address is out of range: %d" % (framedict['chip_address']))
-            self.chip_address = framedict['chip_address']
+            chip_address = framedict['chip_address']
         if 'core_address' in framedict:
             if framedict['core_address'] < 0 or framedict['core_address'] > 255:
                 raise HF_Error("core_address is out of range: %d" % (framedict['core_address']))
-            self.core_address = framedict['core_address']
+            core_address = framedict['core_address']
         if 'hdata' in framedict:
             if framedict['hdata'] < 0 or framedict['hdata'] > 65535:
                 raise HF_Error("hdata is out of range: %d" % (framedict['hdata']))
-            self.hdata = framedict['hdata']
+            hdata = framedict['hdata']
         if 'data' in framedict:
-            assert len(framedict['data']) == 0 or {x >= 0 and x < 256 for x in framedict['data']} == set([True])
-            assert len(framedict['data']) <= 1020 and len(framedict['data']) % 4 == 0
-            if len(framedict['data']) > 0:
-                self.data = framedict['data']
-                self.data_length = len(framedict['data'])
-                self.data_length_field = int(self.data_length / 4)
-                # Fix: Restore when using serial line directly
-                # self.crc32 = crc.crc32(self.data)
-        crc8_input = [self.operation_code, self.chip_address, self.core_address] + int_to_lebytes(self.hdata, 2) \
-            + [self.data_length_field]
-        self.crc8 = crc.crc8(crc8_input)
-        self.framebytes = self.construct_framebytes()
+            # bytes() raises ValueError for values out of range.
+            data = bytes(framedict['data'])
+            assert len(data) <= 1020 and len(data) % 4 == 0
+            # Fix: Restore when using serial line directly
+            # crc32 = crc.crc32(data)
+        header = bytearray([0xaa, operation_code, chip_address, core_address,
+                            hdata & 0xff, hdata >> 8, len(data) >> 2, 0])
+        header[7] = crc.crc8(header[1:7])
+        self.buffer = bytes(header) + data
 
     def print(self):
         print("framebytes: %s" % (self.framebytes))
@@ -372,27 +599,21 @@ class HF_Frame():
         print("core_address: 0x%02x" % (self.core_address))
         print("hdata: %d" % (self.hdata))
         print("data_length_field: %d" % (self.data_length))
-        print("data: %s" % (self.data))
+        if self.data is None:
+            print("data: None")
+        else:
+            print("data: %s" % (self.databytes))
 
 
 # Imitates "struct hf_hash_serial" in hf_protocols.h.
+# The range of every field is checked by codec.hf_hash_serial.pack(),
+# which raises struct.error, and by bytes() for the byte arrays.
 class hf_hash_serial():
     def __init__(self, midstate, merkle_residual, timestamp, bits, starting_nonce,
                  nonce_loops, ntime_loops, search_difficulty, option, group, spare3):
         assert len(midstate) == 32
-        assert {x >= 0 and x < 256 for x in midstate} == set([True])
         assert len(merkle_residual) == 4
-        assert {x >= 0 and x < 256 for x in merkle_residual} == set([True])
-        assert timestamp >= 0 and timestamp < 2**32
-        assert bits >= 0 and bits < 2**32
-        assert starting_nonce >= 0 and starting_nonce < 2**32
-        assert nonce_loops >= 0 and nonce_loops < 2**32
-        assert ntime_loops >= 0 and ntime_loops < 2**16
-        assert search_difficulty >= 0 and search_difficulty < 256
-        assert option >= 0 and option < 256
-        assert group >= 0 and option < 256
         assert len(spare3) == 3
-        assert {x >= 0 and x < 256 for x in spare3} == set([True])
 
         self.midstate = midstate
         self.merkle_residual = merkle_residual
@@ -407,58 +628,115 @@ class hf_hash_serial():
         self.spare3 = spare3
         self.generate_frame_data()
 
+    # self.frame_data is the 60 byte structure as bytes.
     def generate_frame_data(self):
-        self.frame_data = self.midstate + self.merkle_residual + \
-            int_to_lebytes(self.timestamp, 4) + int_to_lebytes(self.bits, 4) + \
-            int_to_lebytes(self.starting_nonce, 4) + int_to_lebytes(self.nonce_loops, 4) + \
-            int_to_lebytes(self.ntime_loops, 2) + [self.search_difficulty] + \
-            [self.option] + [self.group] + self.spare3
+        self.frame_data = codec.hf_hash_serial.pack(
+            bytes(self.midstate), bytes(self.merkle_residual),
+            self.timestamp, self.bits, self.starting_nonce, self.nonce_loops,
+            self.ntime_loops, self.search_difficulty, self.option, self.group,
+            bytes(self.spare3))
 
 # Fix: We would like to confirm that chip_address and core_address make sense
 #      for our particular hardware, but that information is not available
 #      to this object.
 class HF_OP_HASH(HF_Frame):
+    __slots__ = ('job',)
+
     def __init__(self, chip_address, core_address, sequence, job):
         assert chip_address >= 0 and chip_address < 256
         assert core_address >= 0 and core_address < 256
         assert sequence >= 0 and sequence < 2**16
         assert isinstance(job, hf_hash_serial)
         self.job = job
-        HF_Frame.__init__(self, {'operation_code': opcodes['OP_HASH'],
-                                      'chip_address': chip_address,
-                                      'core_address': core_address,
-                                      'hdata': sequence,
-                                      'data': self.job.frame_data})
+        header = bytes([0xaa, opcodes['OP_HASH'], chip_address, core_address,
+                        sequence & 0xff, sequence >> 8, op_hash_data_length_field,
+                        op_hash_crc8(chip_address, core_address, sequence)])
+        self.buffer = header + job.frame_data
+
+# Everything in an OP_HASH header is fixed except the chip address,
+# core address and sequence number (hdata), so its crc8 is a constant
+# xor'ed with one table lookup for each of the four variable bytes.
+# See crc.build_crc8_position_table().
+op_hash_data_length_field = codec.hf_hash_serial.size >> 2
+op_hash_crc8_base = crc.crc8([opcodes['OP_HASH'], 0, 0, 0, 0, op_hash_data_length_field])
+op_hash_crc8_chip = crc.build_crc8_position_table(6, 1)
+op_hash_crc8_core = crc.build_crc8_position_table(6, 2)
+op_hash_crc8_sequence_low = crc.build_crc8_position_table(6, 3)
+op_hash_crc8_sequence_high = crc.build_crc8_position_table(6, 4)
+
+def op_hash_crc8(chip_address, core_address, sequence):
+    return op_hash_crc8_base ^ op_hash_crc8_chip[chip_address] ^ \
+        op_hash_crc8_core[core_address] ^ op_hash_crc8_sequence_low[sequence & 0xff] ^ \
+        op_hash_crc8_sequence_high[sequence >> 8]
+
+# Encodes OP_HASH frames into one reusable bytearray.  The constant
+# header bytes are filled in once; each encode() only patches the
+# addresses, sequence, crc8 and the hf_hash_serial payload (normally
+# hf_hash_serial.frame_data) and returns the buffer.  The returned
+# buffer is overwritten by the next encode(), so send or copy it first.
+# Not thread safe; use one template per thread.
+class HF_OP_HASH_Template():
+    def __init__(self):
+        self.buffer = bytearray(8 + codec.hf_hash_serial.size)
+        self.buffer[0] = 0xaa
+        self.buffer[1] = opcodes['OP_HASH']
+        self.buffer[6] = op_hash_data_length_field
+
+    def encode(self, chip_address, core_address, sequence, payload):
+        buffer = self.buffer
+        if len(payload) != codec.hf_hash_serial.size:
+            raise HF_Error("OP_HASH payload must be %d bytes, not %d."
+                           % (codec.hf_hash_serial.size, len(payload)))
+        # bytearray raises ValueError for anything out of range.
+        buffer[2] = chip_address
+        buffer[3] = core_address
+        buffer[4] = sequence & 0xff
+        buffer[5] = sequence >> 8
+        buffer[7] = op_hash_crc8(chip_address, core_address, sequence)
+        buffer[8:] = payload
+        return buffer
 
 # Imitates "strudct hf_candidate_nonce" in hf_protocols.h.
 class hf_candidate_nonce:
+    __slots__ = ('nonce', 'sequence', 'ntime', 'ntime_offset', 'search_forward')
+
     def __init__(self, nonce_bytes):
         assert len(nonce_bytes) == 8
-        self.nonce = lebytes_to_int(nonce_bytes[0:4])
-        self.sequence = lebytes_to_int(nonce_bytes[4:6])
-        self.ntime = lebytes_to_int(nonce_bytes[6:8])
+        self.decode(codec.hf_candidate_nonce.unpack(nonce_bytes))
+
+    # Build from a record already unpacked by codec.hf_candidate_nonce.
+    @classmethod
+    def from_record(cls, record):
+        candidate = cls.__new__(cls)
+        candidate.decode(record)
+        return candidate
+
+    def decode(self, record):
+        self.nonce, self.sequence, self.ntime = record
         self.ntime_offset = self.ntime & HF_NTIME_MASK
         self.search_forward = self.ntime & HF_NONCE_SEARCH
 
 class HF_OP_NONCE(HF_Frame):
+    __slots__ = ('nonces',)
+
     def __init__(self, framebytes):
         HF_Frame.__init__(self, framebytes)
-        assert len(self.data) % 8 == 0
-        self.nonces = []
-        for i in range(int(len(self.data) / 8)):
-            self.nonces = self.nonces + [hf_candidate_nonce(self.data[8*i:8*i+8])]
+        data = self.data
+        assert len(data) % 8 == 0
+        self.nonces = [hf_candidate_nonce.from_record(x)
+                       for x in codec.hf_candidate_nonce.iter_unpack(data)]
 
 # Imitates "struct hf_g1_monitor" in hf_protocols.h.
 class hf_g1_monitor():
     def __init__(self, monitor_bytes):
-        raw_temp = lebytes_to_int(monitor_bytes[0:2])
+        raw_temp, core_voltage = codec.hf_g1_monitor.unpack(monitor_bytes)
         self.die_temperature = GN_DIE_TEMPERATURE(raw_temp)
-        self.core_voltage_main = GN_CORE_VOLTAGE(monitor_bytes[2])
-        self.core_voltage_A = GN_CORE_VOLTAGE(monitor_bytes[3])
-        self.core_voltage_B = GN_CORE_VOLTAGE(monitor_bytes[4])
-        self.core_voltage_C = GN_CORE_VOLTAGE(monitor_bytes[5])
-        self.core_voltage_D = GN_CORE_VOLTAGE(monitor_bytes[6])
-        self.core_voltage_E = GN_CORE_VOLTAGE(monitor_bytes[7])
+        self.core_voltage_main = GN_CORE_VOLTAGE(core_voltage[0])
+        self.core_voltage_A = GN_CORE_VOLTAGE(core_voltage[1])
+        self.core_voltage_B = GN_CORE_VOLTAGE(core_voltage[2])
+        self.core_voltage_C = GN_CORE_VOLTAGE(core_voltage[3])
+        self.core_voltage_D = GN_CORE_VOLTAGE(core_voltage[4])
+        self.core_voltage_E = GN_CORE_VOLTAGE(core_voltage[5])
 
 # Fix: Support all fields.
 # Fix: Error check.
@@ -474,40 +752,72 @@ class hf_g1_monitor():
 # Fix: We would like to decode the core map here, but this object does
 #      not actually know how many cores there are.
 class HF_OP_STATUS(HF_Frame):
-    def __init__(self, initial_state):
-        HF_Frame.__init__(self, initial_state)
-        self.thermal_cutoff = (self.core_address & 0x80) >> 7
-        self.tach_csec = self.core_address & 0x0f
-        self.last_sequence_number = self.hdata
-        self.monitor_data = hf_g1_monitor(self.data[0:16])
-        self.coremap = self.data[8:]
+    __slots__ = ()
+
+    @property
+    def thermal_cutoff(self):
+        return (self.buffer[3] & 0x80) >> 7
+
+    @property
+    def tach_csec(self):
+        return self.buffer[3] & 0x0f
+
+    @property
+    def last_sequence_number(self):
+        return self.hdata
+
+    @property
+    def monitor_data(self):
+        return hf_g1_monitor(self.data[0:16])
+
+    @property
+    def coremap(self):
+        return self.data[8:]
 
 # Fix: Support all fields.
 # Fix: Error check.
 class HF_OP_USB_INIT(HF_Frame):
-    pass
+    __slots__ = ()
 
 class HF_OP_USB_SHUTDOWN(HF_Frame):
-    pass
+    __slots__ = ()
 
 # Modeled on struct hf_usb_notice_data in hf_protocol.h.
 class HF_OP_USB_NOTICE(HF_Frame):
+    __slots__ = ('extra_data', 'message')
+
     def __init__(self, initial_state):
         HF_Frame.__init__(self, initial_state)
-        self.notification_code = self.hdata
         self.extra_data = None
         self.message = None
         if self.data_length_field > 0:
-            self.extra_data = lebytes_to_int(self.data[0:4])
+            self.extra_data = codec.hf_usb_notice_data.unpack(self.buffer, 8).extra_data
         if self.data_length_field > 1:
             try:
-                raw_message = self.data[4:]
+                raw_message = self.buffer[12:]
                 first_NUL = raw_message.index(0)
             except ValueError:
                 # Fix: Check that the last bytes are all NUL, there may be more than
                 #      one, once the firmware is fixed to do that.
                 raise HF_Error("OP_USB_NOTICE returned a non-NUL terminated string.")
-            self.message = "".join([chr(x) for x in raw_message[0:first_NUL]])
+            # One character per byte, as chr() would give.
+            self.message = raw_message[0:first_NUL].decode('latin-1')
+
+    @property
+    def notification_code(self):
+        return self.hdata
+
+# Token classes built by the parsers, by operation code.  Anything not
+# listed here comes back as a plain HF_Frame.
+token_classes = {
+    opcodes['OP_NONCE']: HF_OP_NONCE,
+    opcodes['OP_STATUS']: HF_OP_STATUS,
+    opcodes['OP_USB_INIT']: HF_OP_USB_INIT,
+    opcodes['OP_USB_NOTICE']: HF_OP_USB_NOTICE,
+}
+
+def frame_to_token(framebytes):
+    return token_classes.get(framebytes[1], HF_Frame)(framebytes)
 
 # Fix: Returns a full frame or garbage that could not be parsed.
 class HF_Parse():
@@ -543,20 +853,7 @@ class HF_Parse():
                         self.frame_header = self.frame_header + [byte]
                         self.data_length = 4 * self.frame_header[6]
                         if self.data_length == 0:
-                            # Fix: This parallels code with the data, maybe this should
-                            #      be a single "queue up what we got" method?
-                            next_token = None
-                            if self.frame_header[1] == opcodes['OP_NONCE']:
-                                next_token = HF_OP_NONCE(self.frame_header)
-                            elif self.frame_header[1] == opcodes['OP_STATUS']:
-                                next_token = HF_OP_STATUS(self.frame_header)
-                            elif self.frame_header[1] == opcodes['OP_USB_INIT']:
-                                next_token = HF_OP_USB_INIT(self.frame_header)
-                            elif self.frame_header[1] == opcodes['OP_USB_NOTICE']:
-                                next_token = HF_OP_USB_NOTICE(self.frame_header)
-                            else:
-                                next_token = HF_Frame(self.frame_header)
-                            self.tokens = self.tokens + [next_token]
+                            self.tokens = self.tokens + [frame_to_token(self.frame_header)]
                             self.clear_frame()
                             self.state = 'next frame'
                         else:
@@ -579,18 +876,7 @@ class HF_Parse():
 #                    self.state = 'reading CRC32'
                 # Fix: This should be removed when using CRC32 check again.
                 if len(self.frame_data) == self.data_length:
-                    next_token = None
-                    if self.frame_header[1] == opcodes['OP_NONCE']:
-                        next_token = HF_OP_NONCE(self.frame_header + self.frame_data)
-                    elif self.frame_header[1] == opcodes['OP_STATUS']:
-                        next_token = HF_OP_STATUS(self.frame_header + self.frame_data)
-                    elif self.frame_header[1] == opcodes['OP_USB_INIT']:
-                        next_token = HF_OP_USB_INIT(self.frame_header + self.frame_data)
-                    elif self.frame_header[1] == opcodes['OP_USB_NOTICE']:
-                        next_token = HF_OP_USB_NOTICE(self.frame_header + self.frame_data)
-                    else:
-                        next_token = HF_Frame(self.frame_header + self.frame_data)
-                    self.tokens = self.tokens + [next_token]
+                    self.tokens = self.tokens + [frame_to_token(self.frame_header + self.frame_data)]
                     self.clear_frame()
                     self.state = 'next frame'
                 elif len(self.frame_data) > self.data_length:
@@ -635,6 +921,61 @@ class HF_Parse():
         else:
             return None
 
+# Produces the same tokens as HF_Parse, but works on whole chunks of
+# input instead of walking a state machine one byte at a time.  The
+# input may be bytes, a bytearray or a list of integers.  Unparsed
+# bytes (a partial frame) are kept in self.pending until the next call
+# to input(), and out of sync bytes collect in self.garbage until the
+# next 0xaa shows up, just as with HF_Parse.
+class HF_ChunkParse():
+    def __init__(self):
+        self.tokens = collections.deque()
+        self.pending = bytearray()
+        self.garbage = bytearray()
+
+    def input(self, rawbytes):
+        buf = self.pending
+        buf.extend(rawbytes)
+        end = len(buf)
+        pos = 0
+        while pos < end:
+            start = buf.find(0xaa, pos)
+            if start < 0:
+                self.garbage += buf[pos:end]
+                pos = end
+                break
+            if start > pos:
+                self.garbage += buf[pos:start]
+            if len(self.garbage) > 0:
+                self.tokens.append(Garbage(list(self.garbage)))
+                self.garbage = bytearray()
+            if end - start < 8:
+                # Wait for the rest of the header.
+                pos = start
+                break
+            if buf[start+7] != crc.crc8(buf[start+1:start+7]):
+                # Bad frame header.  Like HF_Parse, drop all eight
+                # bytes and resynchronize after them.
+                pos = start + 8
+                continue
+            frame_end = start + 8 + 4 * buf[start+6]
+            if frame_end > end:
+                # Wait for the rest of the data.
+                pos = start
+                break
+            self.tokens.append(frame_to_token(bytes(buf[start:frame_end])))
+            pos = frame_end
+        del buf[0:pos]
+
+    def has_token(self):
+        return len(self.tokens) > 0
+
+    def next_token(self):
+        if len(self.tokens) > 0:
+            return self.tokens.popleft()
+        else:
+            return None
+
 def dice_up_coremap(lebytes, dies, cores):
     assert len(lebytes) % 4 == 0
     assert 8 * len(lebytes) >= dies * cores
@@ -687,52 +1028,6 @@ def display_cores_by_G1_location_lines(ca):
             "".join([ I(ca[86]), NI(ca[83]),  I(ca[64]), NI(ca[62]),  I(ca[43]), NI(ca[42]),  I(ca[23]), NI(ca[20]),  I(ca[1])]),
             "".join([NI(ca[85]),  I(ca[84]), NI(ca[63]),      'O',          'O',        'O', NI(ca[22]),  I(ca[21]), NI(ca[0])])]
 
-# Fix: This really needs test code and documentation.  Make sure it
-#      works for future designs as well as G1.
-def decode_op_status_job_map(jobmap, cores):
-    assert 8 * len(jobmap) <= 2 * cores
-    bitmap = lebytes_to_int(jobmap)
-    active_map = [0] * cores
-    for i in range(cores):
-        if bitmap & (1 << 2*i) > 0:
-            active_map[i] = 1
-    pending_map = [0] * cores
-    for i in range(cores):
-        if bitmap & (1 << (2*i + 1)) > 0:
-            pending_map[i] = 1
-    return [active_map, pending_map]
-
-# Fix: Remove this if we don't need it.
-# Find empties: takes core list like [0,1,0,0,1...] and converts to
-# dictionary in which each key is an empty slot.
-def core_list_to_dict(corelist):
-    empties = {}
-    for i in range(len(corelist)):
-        if corelist[i] == 0:
-            empties[i] = 1
-    return empties
-
-# Fix: cores -> slots
-def list_available_cores(corelist):
-    empties = []
-    for i in range(len(corelist)):
-        if corelist[i] == 0:
-            empties.append(i)
-    return empties
-
-def random_work(search_difficulty):
-    midstate = list(randbytes(32))
-    merkle_residual = list(randbytes(4))
-    timestamp = lebytes_to_int(randbytes(4))
-    bits = lebytes_to_int(randbytes(4))
-    return hf_hash_serial(midstate, merkle_residual, timestamp, bits, 0, 0, 0, search_difficulty, 0, 0, [0, 0, 0])
-
-def randbytes(count, source="/dev/urandom"):
-    src = open(source, "rb")
-    rslt = src.read(count)
-    src.close()
-    return rslt
-
 import hashlib
 
 # version: integer
@@ -853,14 +1148,11 @@ def count_leading_zero_bits(byte):
 # bytes, then converting them to bits from least significant to most
 # significant in the usual way.  Then reverse this string of bits and
 # count the zero bits from the beginning.
+# That is the bytes read as a little-endian number, so one int
+# conversion does it.  bytes() raises ValueError for anything out of
+# range.
 def count_leading_zeros(bytelist):
-    assert {x >= 0 and x < 256 for x in bytelist} == set([True])
-    zero_bits = 0
-    for i in range(len(bytelist)-1, -1, -1):
-        zero_bits = zero_bits + count_leading_zero_bits(bytelist[i])
-        if bytelist[i] > 0:
-            break
-    return zero_bits
+    return 8 * len(bytelist) - int.from_bytes(bytes(bytelist), 'little').bit_length()
 
 def sequence_a_le_b(a, b):
     assert a >= 0 and a < 2**16
@@ -878,6 +1170,9 @@ def sequence_a_leq_b(a, b):
     else:
         return sequence_a_le_b(a, b)
 
+# Nothing here calls this any more.  It stays as the plain statement of
+# the job dict, in the order its fields take entropy, which
+# jobs.JobSource and stratum's jobs follow.
 def rand_job(rnd):
     newjob = {}
     newjob['version'] = 2
@@ -890,17 +1185,29 @@ def rand_job(rnd):
     newjob['ntime loops'] = 0
     return newjob    
 
-def check_nonce(job, nonce, zerobits_required):
+def bswap32(integer):
+    return int.from_bytes(integer.to_bytes(4, 'little'), 'big')
+
+# The device rolls ntime in the header as the chip sees it, which is the
+# job's timestamp byte swapped, so undo the swap, add, and swap back.
+def roll_timestamp(timestamp, ntime_offset):
+    if ntime_offset == 0:
+        return timestamp
+    return bswap32((bswap32(timestamp) + ntime_offset) & 0xffffffff)
+
+# ntime_offset is the one from hf_candidate_nonce, for jobs with ntime
+# loops.
+def check_nonce(job, nonce, zerobits_required, ntime_offset=0):
     assert check_job(job)
     assert nonce >= 0 and nonce < 4294967296 # 32 bits
     assert zerobits_required >= 0 and zerobits_required < 256
     feed_to_regen_hash = int_to_lebytes(job['version'], 4) + \
         job['previous block hash'] + \
         job['merkle tree root'] + \
-        int_to_lebytes(job['timestamp'], 4) + \
+        int_to_lebytes(roll_timestamp(job['timestamp'], ntime_offset), 4) + \
         int_to_lebytes(job['bits'], 4) + \
         int_to_lebytes(nonce, 4)
-    regen_hash = sha256.cgminer_regen_hash(feed_to_regen_hash)
+    regen_hash = backends.get('regen_hash')(feed_to_regen_hash)
     regen_hash_expanded = list(regen_hash)
     zerobits = count_leading_zeros(regen_hash_expanded)
     if zerobits >= zerobits_required:
@@ -908,20 +1215,71 @@ def check_nonce(job, nonce, zerobits_required):
     else:
         return False
 
-def check_nonce_work(job, nonce):
+def check_nonce_work(job, nonce, ntime_offset=0):
     assert check_job(job)
     assert nonce >= 0 and nonce < 4294967296 # 32 bits
     feed_to_regen_hash = int_to_lebytes(job['version'], 4) + \
         job['previous block hash'] + \
         job['merkle tree root'] + \
-        int_to_lebytes(job['timestamp'], 4) + \
+        int_to_lebytes(roll_timestamp(job['timestamp'], ntime_offset), 4) + \
         int_to_lebytes(job['bits'], 4) + \
         int_to_lebytes(nonce, 4)
-    regen_hash = sha256.cgminer_regen_hash(feed_to_regen_hash)
+    regen_hash = backends.get('regen_hash')(feed_to_regen_hash)
     regen_hash_expanded = list(regen_hash)
     zerobits = count_leading_zeros(regen_hash_expanded)
     return [zerobits, regen_hash_expanded]
 
+# Checks nonces for one job with the same results as check_nonce_work().
+# The header is byte swapped once, the way cgminer_regen_hash() does it,
+# and the first 64 bytes of it are fed to a hashlib.sha256 object here.
+# Each check() only copies that object and feeds it the last 16 bytes.
+# A rolled ntime only changes those 16 bytes.
+class JobVerifier():
+    __slots__ = ('job', 'prefix', 'tail', 'residual', 'bits')
+
+    def __init__(self, job):
+        assert check_job(job)
+        self.job = job
+        header = struct.pack('<I32s32sII', job['version'],
+                             bytes(job['previous block hash']),
+                             bytes(job['merkle tree root']),
+                             job['timestamp'], job['bits'])
+        swapped = struct.pack('>19I', *struct.unpack('<19I', header))
+        self.prefix = hashlib.sha256(swapped[0:64])
+        # The nonce is swapped too, so it goes in big-endian.
+        self.tail = swapped[64:76]
+        self.residual = swapped[64:68]
+        self.bits = swapped[72:76]
+
+    def tail_for(self, ntime_offset):
+        if ntime_offset == 0:
+            return self.tail
+        timestamp = roll_timestamp(self.job['timestamp'], ntime_offset)
+        return self.residual + timestamp.to_bytes(4, 'big') + self.bits
+
+    def check(self, nonce, ntime_offset=0):
+        hash1 = self.prefix.copy()
+        hash1.update(self.tail_for(ntime_offset) + nonce.to_bytes(4, 'big'))
+        hash2 = hashlib.sha256(hash1.digest()).digest()
+        zerobits = 256 - int.from_bytes(hash2, 'little').bit_length()
+        return [zerobits, list(hash2)]
+
+    # For a nonce with HF_NONCE_SEARCH set: the first of the next
+    # nonce_search_span nonces with zerobits_required zero bits, as
+    # [nonce, zerobits, hash], or None.
+    def search(self, nonce, zerobits_required, ntime_offset=0):
+        tail = self.tail_for(ntime_offset)
+        limit = 1 << (256 - zerobits_required)
+        for i in range(1, nonce_search_span + 1):
+            candidate = (nonce + i) & 0xffffffff
+            hash1 = self.prefix.copy()
+            hash1.update(tail + candidate.to_bytes(4, 'big'))
+            hash2 = hashlib.sha256(hash1.digest()).digest()
+            value = int.from_bytes(hash2, 'little')
+            if value < limit:
+                return [candidate, 256 - value.bit_length(), list(hash2)]
+        return None
+
 def check_job(job):
     exact_job_fields = set(['version', 'previous block hash', 'merkle tree root', 'timestamp', 'bits', 'starting nonce', 'nonce loops', 'ntime loops'])
     if set(job.keys()) != exact_job_fields:
@@ -952,7 +1310,7 @@ def prepare_hf_hash_serial(job, search_difficulty):
     # Fix: Note that we do not know exactly how to feed the fields from real blocks
     #      into this function.  It works with random bytes because we don't care
     #      about their order.
-    midstate = sha256.cgminer_calc_midstate(int_to_lebytes(job['version'], 4) + job['previous block hash'] + job['merkle tree root'][0:28])
+    midstate = backends.get('midstate')(int_to_lebytes(job['version'], 4) + job['previous block hash'] + job['merkle tree root'][0:28])
     return hf_hash_serial(midstate,
                           job['merkle tree root'][28:32],
                           job['timestamp'],
@@ -964,3 +1322,152 @@ def prepare_hf_hash_serial(job, search_difficulty):
 
 def nominal_hash_rate(clockrate):
     return 0.768 * clockrate - 0.03 * 0.768 * clockrate
+
+# A talkusb() stand-in for the checks below, which keeps what is sent.
+class RecordingTalkusb():
+    def __init__(self, packet_size=64):
+        self.packet_size = packet_size
+        self.transfers = []
+
+    def __call__(self, action, buffer, length):
+        if action == SEND_MAX or action == RECEIVE_MAX:
+            return self.packet_size
+        if action == SEND:
+            self.transfers.append(bytes(buffer[:length]))
+            return length
+        return -1
+
+# What a parser hands out, in a form that compares.
+def token_key(token):
+    if isinstance(token, Garbage):
+        return ('garbage', bytes(token.garbage))
+    return (type(token).__name__, token.buffer)
+
+def parsed_keys(parser):
+    keys = []
+    while parser.has_token():
+        keys.append(token_key(parser.next_token()))
+    return keys
+
+# Good frames, noise and frames with a bad CRC8 go through HF_Parse
+# all at once and through HF_ChunkParse in random pieces, and have to
+# come out as the same tokens.
+def check_parsers(seed=1, trials=100):
+    rnd = random.Random(seed)
+    for trial in range(trials):
+        stream = bytearray()
+        for i in range(20):
+            kind = rnd.random()
+            if kind < 0.6:
+                operation_code = rnd.choice(['OP_NONCE', 'OP_STATUS', 'OP_PING', 'OP_USB_INIT'])
+                if operation_code == 'OP_NONCE':
+                    length = 8 * rnd.randrange(1, 4)
+                else:
+                    length = 4 * rnd.randrange(0, 6)
+                frame = HF_Frame({'operation_code': opcodes[operation_code],
+                                  'chip_address': rnd.randrange(4),
+                                  'data': [rnd.randrange(256) for j in range(length)]})
+                stream.extend(frame.buffer)
+            elif kind < 0.8:
+                stream.extend([rnd.randrange(256) for j in range(rnd.randrange(1, 12))])
+            else:
+                frame = bytearray(HF_Frame({'operation_code': opcodes['OP_PING'], 'data': bytes(8)}).buffer)
+                frame[7] = frame[7] ^ 1
+                stream.extend(frame)
+        reference = HF_Parse()
+        reference.input(list(stream))
+        chunked = HF_ChunkParse()
+        position = 0
+        while position < len(stream):
+            size = rnd.randrange(1, 80)
+            chunked.input(stream[position:position+size])
+            position = position + size
+        assert parsed_keys(chunked) == parsed_keys(reference)
+    return True
+
+# Send keeps frames until a flush, writes them in pieces of whole
+# packets, and ends a transfer that fills its last packet with a zero
+# length packet.
+def check_send_coalescing():
+    usb = RecordingTalkusb()
+    sender = Send(usb, max_transfer=200, flush_size=1000, flush_age=3600)
+    assert sender.max_transfer == 192
+    frame = HF_Frame({'operation_code': opcodes['OP_PING'], 'data': bytes(range(8))}).buffer
+    for i in range(30):
+        sender.schedule(frame)
+    assert usb.transfers == []
+    sender.flush()
+    # 480 bytes: two pieces of 192 and the last 96, and no zero length
+    # packet, since 480 is not a multiple of 64.
+    assert [len(x) for x in usb.transfers] == [192, 192, 96]
+    assert b''.join(usb.transfers) == frame * 30
+    assert sender.transfers == 1 and sender.bytes_sent == 480
+    assert sender.zero_length_packets == 0
+    # 16 frames of 16 bytes fill four packets exactly.
+    usb.transfers = []
+    for i in range(16):
+        sender.schedule(frame)
+    sender.flush()
+    assert [len(x) for x in usb.transfers] == [192, 64, 0]
+    assert sender.zero_length_packets == 1
+    # Reaching flush_size sends without being asked.
+    usb.transfers = []
+    for i in range(62):
+        sender.schedule(frame)
+    assert usb.transfers == []
+    sender.schedule(frame)
+    assert sum(len(x) for x in usb.transfers) == 63 * 16
+    # send() is schedule() and flush().
+    usb.transfers = []
+    sender.send(frame)
+    assert usb.transfers == [frame]
+    return True
+
+def self_test():
+    check_parsers()
+    check_send_coalescing()
+    template = HF_OP_HASH_Template()
+    payload = bytes(codec.hf_hash_serial.size)
+    # An abort for one chip takes out only that chip's queued OP_HASH
+    # frames, and says which they were.
+    usb = RecordingTalkusb()
+    drops = []
+    sender = Send(usb, flush_age=3600, on_drop=drops.extend)
+    expected = bytearray()
+    for sequence in range(6):
+        chip = sequence % 3
+        frame = bytes(template.encode(chip, sequence + 10, 0x100 + sequence, payload))
+        sender.schedule(frame)
+        if chip != 1:
+            expected.extend(frame)
+    other = HF_Frame({'operation_code': opcodes['OP_PING'], 'chip_address': 1}).buffer
+    sender.schedule(other)
+    expected.extend(other)
+    assert usb.transfers == []
+    assert sender.abort(1) == [(1, 11, 0x101), (1, 14, 0x104)]
+    assert drops == [(1, 11, 0x101), (1, 14, 0x104)]
+    assert sender.dropped_frames == 2 and sender.aborts == 1
+    assert sender.abort_latency_count == 1
+    assert usb.transfers[0][1] == opcodes['OP_ABORT'] and usb.transfers[0][2] == 1
+    assert b''.join(usb.transfers[1:]) == bytes(expected)
+    # A control frame which is not an abort doesn't count as one.
+    assert sender.schedule_control(other) == []
+    assert sender.abort_latency_count == 1 and sender.aborts == 1
+    # A broadcast work restart takes out everything queued for hashing.
+    sent = len(usb.transfers)
+    sender.schedule(template.encode(2, 3, 7, payload))
+    sender.schedule(other)
+    assert sender.work_restart() == [(2, 3, 7)]
+    assert sender.abort_latency_count == 2
+    transfers = [x for x in usb.transfers[sent:] if len(x) > 0]
+    assert transfers[0][1] == opcodes['OP_WORK_RESTART']
+    assert transfers[1:] == [bytes(other)]
+    # data is a view into the buffer, databytes the list it used to be.
+    frame = HF_Frame(HF_Frame({'operation_code': opcodes['OP_PING'], 'data': [1, 2, 3, 4]}).framebytes)
+    assert frame.databytes == [1, 2, 3, 4] and bytes(frame.data) == bytes([1, 2, 3, 4])
+    assert HF_Frame({'operation_code': opcodes['OP_PING']}).databytes is None
+    return True
+
+if __name__ == '__main__':
+    self_test()
+    print("hf agrees with itself.")
@@ -0,0 +1,221 @@
+import collections
+import random
+import threading
+
+from . import backends
+from .hf import HF_Error
+from .hf import hf_hash_serial, JobVerifier
+
+# Random jobs for the hash tests, made in batches ahead of time.
+#
+# rand_job() reads /dev/urandom four times per job, and
+# prepare_hf_hash_serial() computes one midstate per job, all in the
+# middle of the stocking loops.  A JobSource instead reads entropy in
+# blocks of block_size bytes, makes batch_size jobs at a time with
+# their midstates (through backends 'midstates'), and keeps up to
+# capacity of them in a ring.  next() pops one.
+#
+# With a seed, entropy comes from random.Random(seed) instead of the
+# source, so a run can be repeated job for job.
+#
+# With background=True, start() runs a producer thread which tops the
+# ring up whenever it falls below capacity - batch_size, and next()
+# waits for it if the ring is empty.  Otherwise next() makes a batch
+# itself when the ring is empty.  Either way the jobs come out in the
+# same order.
+#
+# ntime_loops goes into every job, so the device rolls ntime that many
+# times through the nonce range before it is done with a job.
+# A WorkSource goes one step further and hands out PreparedWork: the
+# OP_HASH payload already encoded for one search difficulty, and the
+# JobVerifier for checking nonces.  All that is left for the stocking
+# loops is HF_OP_HASH_Template.encode(), which fills in chip, core and
+# sequence, so restocking after an OP_STATUS costs the same per slot
+# however many slots opened up.
+
+# A job from rand_job() and the midstate prepare_hf_hash_serial()
+# would compute for it.
+class PreparedJob():
+    __slots__ = ('job', 'midstate')
+
+    def __init__(self, job, midstate):
+        self.job = job
+        self.midstate = midstate
+
+    # Same as prepare_hf_hash_serial(self.job, search_difficulty).
+    def hash_serial(self, search_difficulty):
+        assert search_difficulty >= 0 and search_difficulty < 256
+        job = self.job
+        return hf_hash_serial(self.midstate,
+                              job['merkle tree root'][28:32],
+                              job['timestamp'],
+                              job['bits'],
+                              job['starting nonce'],
+                              job['nonce loops'],
+                              job['ntime loops'],
+                              search_difficulty, 0, 0, [0, 0, 0])
+
+    # The 60 bytes of OP_HASH data.
+    def payload(self, search_difficulty):
+        return self.hash_serial(search_difficulty).frame_data
+
+    def verifier(self):
+        return JobVerifier(self.job)
+
+# A PreparedJob with its payload and verifier made ahead of time.
+class PreparedWork(PreparedJob):
+    __slots__ = ('search_difficulty', 'encoded', 'job_verifier')
+
+    def __init__(self, prepared, search_difficulty):
+        PreparedJob.__init__(self, prepared.job, prepared.midstate)
+        self.search_difficulty = search_difficulty
+        self.encoded = prepared.payload(search_difficulty)
+        self.job_verifier = JobVerifier(prepared.job)
+
+    # Only encodes again if asked for a different difficulty.
+    def payload(self, search_difficulty):
+        if search_difficulty == self.search_difficulty:
+            return self.encoded
+        return PreparedJob.payload(self, search_difficulty)
+
+    def verifier(self):
+        return self.job_verifier
+
+# Bytes per job: previous block hash, merkle tree root, timestamp, bits,
+# in the order rand_job() reads them.
+job_entropy = 72
+
+class JobSource():
+    def __init__(self, seed=None, source="/dev/urandom", batch_size=256,
+                 capacity=4096, background=False, block_size=65536, ntime_loops=0):
+        assert batch_size > 0 and capacity >= batch_size
+        assert ntime_loops >= 0 and ntime_loops < 2**16
+        self.ntime_loops = ntime_loops
+        self.seed = seed
+        self.source = source
+        self.batch_size = batch_size
+        self.capacity = capacity
+        self.background = background
+        self.block_size = block_size
+        if seed is not None:
+            self.rnd = random.Random(seed)
+            self.src = None
+        else:
+            self.rnd = None
+            self.src = open(source, 'rb')
+        self.entropy_buffer = b''
+        self.entropy_position = 0
+        self.ring = collections.deque()
+        self.condition = threading.Condition()
+        self.producer = None
+        self.running = False
+        self.error = None
+        self.generated = 0
+        self.waits = 0
+
+    def entropy(self, count):
+        if self.rnd is not None:
+            return self.rnd.getrandbits(8 * count).to_bytes(count, 'little')
+        if self.entropy_position + count > len(self.entropy_buffer):
+            rest = self.entropy_buffer[self.entropy_position:]
+            more = self.src.read(max(self.block_size, count - len(rest)))
+            self.entropy_buffer = rest + more
+            self.entropy_position = 0
+            if len(self.entropy_buffer) < count:
+                raise HF_Error("Ran out of entropy reading %s" % (self.source))
+        result = self.entropy_buffer[self.entropy_position:self.entropy_position+count]
+        self.entropy_position = self.entropy_position + count
+        return result
+
+    def generate(self, count):
+        raw = self.entropy(count * job_entropy)
+        jobs = []
+        blocks = []
+        for i in range(count):
+            chunk = raw[i*job_entropy:(i+1)*job_entropy]
+            job = {}
+            job['version'] = 2
+            job['previous block hash'] = list(chunk[0:32])
+            job['merkle tree root'] = list(chunk[32:64])
+            job['timestamp'] = int.from_bytes(chunk[64:68], 'little')
+            job['bits'] = int.from_bytes(chunk[68:72], 'little')
+            job['starting nonce'] = 0
+            job['nonce loops'] = 0
+            job['ntime loops'] = self.ntime_loops
+            jobs.append(job)
+            blocks.append(b'\x02\x00\x00\x00' + chunk[0:60])
+        midstates = backends.get('midstates')(blocks)
+        self.generated = self.generated + count
+        return [PreparedJob(job, midstate) for job, midstate in zip(jobs, midstates)]
+
+    def next(self):
+        with self.condition:
+            if not self.ring:
+                if self.producer is None:
+                    self.ring.extend(self.generate(self.batch_size))
+                else:
+                    self.waits = self.waits + 1
+                    self.condition.notify_all()
+                    while not self.ring and self.error is None:
+                        self.condition.wait()
+                    if self.error is not None:
+                        raise HF_Error("Job producer failed: %s" % (self.error))
+            prepared = self.ring.popleft()
+            if self.producer is not None and len(self.ring) <= self.capacity - self.batch_size:
+                self.condition.notify_all()
+            return prepared
+
+    def start(self):
+        if not self.background or self.producer is not None:
+            return
+        self.running = True
+        self.producer = threading.Thread(target=self.produce, name="hfload job producer")
+        self.producer.daemon = True
+        self.producer.start()
+
+    def stop(self):
+        if self.producer is None:
+            return
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.producer.join()
+        self.producer = None
+
+    def produce(self):
+        try:
+            while True:
+                with self.condition:
+                    while self.running and len(self.ring) > self.capacity - self.batch_size:
+                        self.condition.wait()
+                    if not self.running:
+                        return
+                batch = self.generate(self.batch_size)
+                with self.condition:
+                    self.ring.extend(batch)
+                    self.condition.notify_all()
+        except Exception as e:
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+
+    # Called with every good nonce from a job this source made.  Random
+    # jobs have nowhere to send them; see stratum.StratumWorkSource.
+    def found(self, job, nonce, ntime_offset, regen_hash):
+        return False
+
+    def close(self):
+        self.stop()
+        if self.src is not None:
+            self.src.close()
+            self.src = None
+
+class WorkSource(JobSource):
+    def __init__(self, search_difficulty, **job_source_options):
+        assert search_difficulty >= 0 and search_difficulty < 256
+        JobSource.__init__(self, **job_source_options)
+        self.search_difficulty = search_difficulty
+
+    def generate(self, count):
+        return [PreparedWork(x, self.search_difficulty)
+                for x in JobSource.generate(self, count)]
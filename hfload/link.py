@@ -0,0 +1,191 @@
+import array
+import collections
+import threading
+import time
+
+from .hf import HF_Error
+from .hf import Send, HF_ChunkParse
+from .hf import RECEIVE, RECEIVE_MAX, RECEIVE_INTO, RECEIVE_TIMEOUT
+
+# Fix: The four-times receive quirk of the Atmel USB code is handled
+#      by simply never stopping asking.  Check that this doesn't upset
+#      anything on the device side.
+
+# A full duplex link to one board, built on talkusb().
+#
+# A reader thread does nothing but read from talkusb() and append
+# (arrival time, bytes) to the arrivals deque.  If talkusb() supports
+# RECEIVE_INTO, each read is one packet with a timeout of
+# receive_timeout milliseconds, as in hf.Receive, so the reader sees
+# stop() within that long.  Otherwise it falls back to RECEIVE.  A deque append
+# and popleft are atomic, so the reader never waits on anything but the
+# device.  Whoever asks for tokens drains the arrivals into an
+# HF_ChunkParse, under the parse lock, and gets the tokens back in
+# order.  Each token is stamped with the arrival time of the read which
+# completed it.
+#
+# Sends go through a Send object under the send lock.  Neither lock is
+# taken by the reader thread, so a send never waits for a read, and a
+# read never waits for a send.
+#
+# The link has both the Send interface (schedule, send, flush, abort,
+# work_restart) and the parser interface (has_token, next_token), so it
+# can stand in for a Send and a parser at the same time.
+class Link():
+    def __init__(self, talkusb, idle_sleep=0.0005, receive_timeout=10, **send_options):
+        self.talkusb = talkusb
+        self.idle_sleep = idle_sleep
+        self.max_receive = self.talkusb(RECEIVE_MAX, None, 0)
+        self.buffer = None
+        if self.talkusb(RECEIVE_TIMEOUT, None, receive_timeout) == 0:
+            self.buffer = array.array('B', bytes(self.max_receive))
+
+        self.send_lock = threading.Lock()
+        self.transmitter = Send(talkusb, **send_options)
+
+        self.arrivals = collections.deque()
+        self.arrived = threading.Event()
+        self.parse_lock = threading.Lock()
+        self.parser = HF_ChunkParse()
+        self.tokens = collections.deque()
+
+        self.bytes_received = 0
+        self.reads = 0
+        self.empty_reads = 0
+        self.error = None
+
+        self.running = False
+        self.reader = None
+
+    def start(self):
+        if self.reader is not None:
+            raise HF_Error("Link already started.")
+        self.running = True
+        self.reader = threading.Thread(target=self.read_loop, name="hfload link reader")
+        self.reader.daemon = True
+        self.reader.start()
+
+    # Without RECEIVE_INTO, talkusb(RECEIVE, ...) may block forever, in
+    # which case the reader is left behind.  It is a daemon thread, so
+    # it won't hold up exit.
+    def stop(self, timeout=1.0):
+        self.running = False
+        if self.reader is not None:
+            self.reader.join(timeout)
+            self.reader = None
+
+    # Returns the bytes read, empty if nothing came.
+    def read(self):
+        if self.buffer is not None:
+            rslt = self.talkusb(RECEIVE_INTO, self.buffer, len(self.buffer))
+            if rslt < 0:
+                raise HF_Error("Bad call trying to receive using talkusb(): %d" % (rslt))
+            return self.buffer[0:rslt].tobytes()
+        rslt = self.talkusb(RECEIVE, None, self.max_receive)
+        if isinstance(rslt, int):
+            raise HF_Error("Bad call trying to receive using talkusb(): %d" % (rslt))
+        if len(rslt) == 0:
+            # The read didn't wait, so don't spin.
+            time.sleep(self.idle_sleep)
+        return bytes(rslt)
+
+    def read_loop(self):
+        try:
+            while self.running:
+                data = self.read()
+                self.reads = self.reads + 1
+                if len(data) > 0:
+                    self.arrivals.append((time.time(), data))
+                    self.bytes_received = self.bytes_received + len(data)
+                    self.arrived.set()
+                else:
+                    self.empty_reads = self.empty_reads + 1
+        except Exception as e:
+            self.error = e
+            self.running = False
+            self.arrived.set()
+
+    def check(self):
+        if self.error is not None:
+            raise HF_Error("Link reader stopped: %s" % (self.error))
+
+    # Must be called with the parse lock held.
+    def drain(self):
+        arrivals = self.arrivals
+        parser = self.parser
+        while arrivals:
+            stamp, data = arrivals.popleft()
+            parser.input(data)
+            while parser.has_token():
+                self.tokens.append((stamp, parser.next_token()))
+
+    def has_token(self):
+        with self.parse_lock:
+            self.drain()
+            if self.tokens:
+                return True
+        self.check()
+        return False
+
+    # Returns (arrival time, token), or None if there is no token.
+    def next_stamped_token(self):
+        with self.parse_lock:
+            self.drain()
+            if self.tokens:
+                return self.tokens.popleft()
+        self.check()
+        return None
+
+    def next_token(self):
+        stamped = self.next_stamped_token()
+        if stamped is None:
+            return None
+        return stamped[1]
+
+    # Waits up to timeout seconds, or forever if timeout is None, for a
+    # token.  Returns (arrival time, token), or None on timeout.
+    def get(self, timeout=None):
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            # Clear before looking, so an arrival after the look still
+            # wakes the wait below.
+            self.arrived.clear()
+            stamped = self.next_stamped_token()
+            if stamped is not None:
+                return stamped
+            if timeout is None:
+                self.arrived.wait()
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.arrived.wait(remaining)
+
+    def schedule(self, byteslist):
+        with self.send_lock:
+            self.transmitter.schedule(byteslist)
+
+    def send(self, byteslist):
+        with self.send_lock:
+            self.transmitter.send(byteslist)
+
+    def flush(self):
+        with self.send_lock:
+            self.transmitter.flush()
+
+    def service(self):
+        with self.send_lock:
+            self.transmitter.service()
+
+    def schedule_control(self, byteslist):
+        with self.send_lock:
+            return self.transmitter.schedule_control(byteslist)
+
+    def abort(self, chip_address=None):
+        with self.send_lock:
+            return self.transmitter.abort(chip_address)
+
+    def work_restart(self, hdata=0, die_bitmap=None):
+        with self.send_lock:
+            return self.transmitter.work_restart(hdata, die_bitmap)
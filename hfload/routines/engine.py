@@ -0,0 +1,529 @@
+import collections
+import random
+import time
+
+from .. import backends
+from .. import codec
+from ..hf import HF_Error, HF_Thermal
+from ..hf import Send, Receive
+from ..hf import HF_ChunkParse, Garbage
+from ..hf import HF_Frame, opcodes, opnames
+from ..hf import HF_OP_USB_INIT, HF_OP_NONCE, HF_OP_STATUS, HF_OP_USB_NOTICE
+from ..hf import HF_OP_HASH_Template
+from ..hf import SHUTDOWN, PROTOCOL_USB_MAPPED_SERIAL
+from ..jobs import WorkSource
+from ..worktable import WorkTable
+from ..scheduler import SlotScheduler, count_bits
+from ..difficulty import zerobits_target, meets_target, share_difficulty, hashes_per_share
+from ..estimator import HashRateEstimator
+
+# The hash test, as something to call rather than a script.
+#
+# HashEngine brings a device up with OP_USB_INIT, keeps every free core
+# slot stocked with test work and checks the nonces which come back.
+# It prints nothing.  What happens is handed to listeners as events,
+# the namedtuples below: listen(callback, GoodNonce, Status) calls
+# callback with each GoodNonce and Status, listen(callback) with every
+# event.  An event is only built when its type has a listener, so a
+# run nobody watches pays for no events and no formatting.
+#
+# step() is one pass of the loop, and raises when something goes wrong.
+# run() calls step() until a budget runs out -- seconds, hashes or good
+# nonces, whichever comes first -- or stop() is called, and returns a
+# RunResult.  With no budget it runs until interrupted or an error.  An
+# error or an interrupt ends the run and shuts the device down, and
+# ends up in the result; nothing exits.  After a budget runs out the
+# device is left hashing, and run() can be called again; each RunResult
+# counts its own run only.
+#
+# Subclasses change what is kept per die with new_die(), and which free
+# slots get work with free_slots().
+
+InitSent = collections.namedtuple('InitSent', ['count'])
+# The reply to OP_USB_INIT, before operation_status is looked at.
+InitReceived = collections.namedtuple('InitReceived', ['dies', 'cores', 'hdata', 'framebytes',
+                                                       'init_base', 'config', 'coremap_bytes'])
+GoodNonce = collections.namedtuple('GoodNonce', ['die', 'core', 'sequence', 'nonce', 'zerobits',
+                                                 'difficulty', 'ntime_offset'])
+BadNonce = collections.namedtuple('BadNonce', ['die', 'core', 'sequence', 'nonce', 'ntime_offset'])
+UnknownSequence = collections.namedtuple('UnknownSequence', ['die', 'sequence'])
+# active and pending are the numbers of filled slots.  A Status with
+# thermal_cutoff set is the last one: the run ends with HF_Thermal.
+Status = collections.namedtuple('Status', ['die', 'last_sequence', 'active', 'pending',
+                                           'thermal_cutoff', 'monitor_data'])
+Notice = collections.namedtuple('Notice', ['code', 'extra_data', 'message'])
+UnexpectedFrame = collections.namedtuple('UnexpectedFrame', ['operation', 'token'])
+GarbageReceived = collections.namedtuple('GarbageReceived', ['count'])
+# Every report_interval seconds once nonces are coming in.  die_rates
+# are estimator.Rates over the estimator's window.
+HashReport = collections.namedtuple('HashReport', ['hash_rate', 'idle_slot_seconds', 'die_rates'])
+Shutdown = collections.namedtuple('Shutdown', ['reason', 'error'])
+
+event_types = (InitSent, InitReceived, GoodNonce, BadNonce, UnknownSequence, Status,
+               Notice, UnexpectedFrame, GarbageReceived, HashReport, Shutdown)
+
+class DieStats():
+    def __init__(self):
+        self.good_nonces = 0
+        self.bad_nonces = 0
+        self.unknown_sequences = 0
+        self.hashes = 0
+        self.statuses = 0
+        self.best_share_difficulty = 0
+        # Filled in when the run ends.
+        self.jobs = 0
+        self.idle_slot_seconds = 0.0
+
+class RunResult():
+    def __init__(self, start):
+        self.start = start
+        self.elapsed = 0.0
+        # 'duration', 'hashes', 'nonces', 'stopped', 'interrupted',
+        # 'thermal' or 'error'.
+        self.reason = None
+        self.error = None
+        self.hashes = 0
+        self.good_nonces = 0
+        self.bad_nonces = 0
+        self.unknown_sequences = 0
+        self.garbage_bytes = 0
+        self.jobs = 0
+        self.best_share_difficulty = 0
+        # Hashes and good nonces a second over the run.
+        self.hash_rate = 0.0
+        self.nonce_rate = 0.0
+        self.dies = []
+        # Per die (jobs inserted, idle slot seconds) when counting began.
+        self.baseline = []
+
+    def errors(self):
+        return self.bad_nonces + self.unknown_sequences
+
+class HashEngine():
+    # If link is given (a started link.Link on the same talkusb), it
+    # does all the sending and receiving, and the receive calls in the
+    # stocking loop go away.  If validator is given (a
+    # validate.Validator), nonces are checked there instead of in
+    # step(), and counted as the verdicts come back.  job_source (a
+    # jobs.JobSource) supplies the work; give one with a seed for a
+    # repeatable run.  The caller still owns it, and closes it.  The
+    # default is a jobs.WorkSource with a producer thread, so the
+    # payloads are encoded before the slots open up, which the engine
+    # makes in start() and closes itself.
+    def __init__(self, talkusb, clockrate, link=None, validator=None, job_source=None):
+        self.link = link
+        self.validator = validator
+        self.job_source = job_source
+        self.owns_job_source = job_source is None
+        self.started = False
+        self.talkusb = talkusb
+        self.clockrate = clockrate
+        # event type -> callbacks, for the types with any.
+        self.handlers = {}
+        self.stopping = False
+
+        self.cores_per_die = None
+        self.number_of_dies = None
+        self.dies = None
+        self.scheduler = None
+        # Rates per core, die and board, from OP_USB_INIT on.  Safe to
+        # query from other threads.
+        self.estimator = None
+
+        self.hash_rate_start = None
+        self.hash_rate = 0
+        self.total_hashes = 0
+        self.total_errors = 0
+        self.time_of_last_hash_report = None
+        self.hash_report_interval = 2 # secs.
+
+        self.op_usb_init_delay = 5.0
+        self.last_op_usb_init_sent = None
+        self.last_op_usb_init_count = 0
+
+        self.test_search_difficulty = 34
+        # The device rolls ntime this many times per job, so each OP_HASH
+        # keeps a core busy for test_ntime_loops + 1 passes over the nonces.
+        # 0 is one pass, the workload the scripts were written for; a
+        # caller which wants longer jobs sets it.
+        self.test_ntime_loops = 0
+        # Good nonces are the ones at or below this target, and each stands
+        # for hashes_per_share() of it.  None means the target of
+        # test_search_difficulty zero bits, 2**test_search_difficulty hashes a
+        # nonce; set a stricter one, say from real bits, for pool style counting.
+        self.test_target = None
+        self.best_share_difficulty = 0
+        self.global_state = 'starting'
+        self.random_source = "/dev/urandom"
+        if self.link is None:
+            self.parser = HF_ChunkParse()
+        else:
+            self.parser = self.link
+        self.op_hash_template = HF_OP_HASH_Template()
+
+        # Seconds spent stocking slots in step(), when there were any.
+        self.restock_time_last = None
+        self.restock_time_max = 0
+
+        # (die, core, sequence) of OP_HASH frames an abort or a work
+        # restart cut from the send queue, possibly from another thread,
+        # for step() to take off the books.
+        self.dropped = collections.deque()
+        if self.link is None:
+            self.transmitter = Send(talkusb, on_drop=self.dropped.extend)
+            self.receiver = Receive(talkusb)
+        else:
+            self.transmitter = self.link
+            self.link.transmitter.on_drop = self.dropped.extend
+            self.receiver = None
+
+        # Counters for the run in progress, or for step() calls outside
+        # of run().
+        self.result = RunResult(time.time())
+
+    def listen(self, callback, *types):
+        for event_type in types or event_types:
+            self.handlers.setdefault(event_type, []).append(callback)
+
+    def unlisten(self, callback):
+        for event_type in list(self.handlers):
+            callbacks = self.handlers[event_type]
+            while callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                del self.handlers[event_type]
+
+    def emit(self, event):
+        for callback in self.handlers.get(type(event), ()):
+            callback(event)
+
+    # Ends run() after the current step.  Safe from another thread or
+    # from a listener.
+    def stop(self):
+        self.stopping = True
+
+    # Everything the loop needs that can wait until the device is about
+    # to be used: the random seed, the SHA-256 backend choice and the
+    # job source's producer.  Choosing the backends takes about a second,
+    # which is better spent here than in the first restock.  The first
+    # step() calls it, so test_search_difficulty and test_ntime_loops
+    # can still be set between __init__ and run().
+    def start(self):
+        if self.started:
+            return
+        with open(self.random_source, 'rb') as rndsrc:
+            random.seed(rndsrc.read(256))
+        backends.ready()
+        if self.job_source is None:
+            self.job_source = WorkSource(self.test_search_difficulty,
+                                         source=self.random_source, background=True,
+                                         ntime_loops=self.test_ntime_loops)
+        self.job_source.start()
+        self.started = True
+
+    def run(self, duration=None, hashes=None, nonces=None):
+        self.stopping = False
+        result = RunResult(time.time())
+        self.result = result
+        self.begin_counting(result)
+        reason = None
+        error = None
+        try:
+            while reason is None:
+                self.step()
+                if self.stopping:
+                    reason = 'stopped'
+                elif duration is not None and time.time() - result.start >= duration:
+                    reason = 'duration'
+                elif hashes is not None and result.hashes >= hashes:
+                    reason = 'hashes'
+                elif nonces is not None and result.good_nonces >= nonces:
+                    reason = 'nonces'
+        except KeyboardInterrupt:
+            reason = 'interrupted'
+            self.shutdown(reason)
+        except HF_Thermal as e:
+            reason = 'thermal'
+            error = e
+            self.shutdown(reason, error)
+        except Exception as e:
+            reason = 'error'
+            error = e
+            self.shutdown(reason, error)
+        return self.finish(result, reason, error)
+
+    def begin_counting(self, result):
+        if self.dies is None:
+            return
+        result.dies = [DieStats() for die in self.dies]
+        idle = self.scheduler.idle_slot_seconds()
+        result.baseline = [(self.dies[i]['work'].inserted, idle[i]) for i in range(len(self.dies))]
+
+    def finish(self, result, reason, error):
+        result.reason = reason
+        result.error = error
+        result.elapsed = time.time() - result.start
+        if self.dies is not None:
+            idle = self.scheduler.idle_slot_seconds()
+            for i in range(len(result.dies)):
+                inserted, idle_start = result.baseline[i]
+                stats = result.dies[i]
+                stats.jobs = self.dies[i]['work'].inserted - inserted
+                stats.idle_slot_seconds = idle[i] - idle_start
+                result.best_share_difficulty = max(result.best_share_difficulty,
+                                                   stats.best_share_difficulty)
+            result.jobs = sum(stats.jobs for stats in result.dies)
+        if result.elapsed > 0:
+            result.hash_rate = result.hashes / result.elapsed
+            result.nonce_rate = result.good_nonces / result.elapsed
+        return result
+
+    def shutdown(self, reason=None, error=None):
+        if Shutdown in self.handlers:
+            self.emit(Shutdown(reason, error))
+        self.talkusb(SHUTDOWN, None, 0);
+
+    def step(self):
+        if not self.started:
+            self.start()
+        result = self.result
+        # Fix: Every time we send, we want also to receive (to make sure nothing
+        #      deadlocks), so the send and receive objects should be combined.
+        # Fix: Do we want to have a delay in here or some sort of select() like thing?
+        if self.receiver is not None:
+            self.receiver.receive()
+        self.transmitter.send([])
+
+        if self.receiver is not None:
+            traffic = self.receiver.read()
+            if traffic:
+                self.parser.input(traffic)
+
+        if self.global_state == 'starting':
+            if self.last_op_usb_init_sent is None or \
+                    time.time() - self.last_op_usb_init_sent > self.op_usb_init_delay:
+                # Fix: Move this documentation elsewhere.
+                # core_address fields
+                # bits 2:0: Protocol to use
+                # bit  3:   Override configuration data
+                # bit  4:   PLL bypass
+                # bit  5:   Disable automatic ASIC initialization sequence
+                # bit  6:   At speed core test, return bitmap separately.
+                # bit  7:   Host supports gwq status shed_count
+                # If the uc thinks shed_supported is off, then it automatically disables
+                # core 95.  This only affects GWQ mode.  We turn it on so that core 95
+                # shows up on the working core map.
+                shed_supported = 0x80
+                core_address_field = PROTOCOL_USB_MAPPED_SERIAL | shed_supported
+                # Fix: Do this the correct way, probably by creating OP_USB_INIT class.
+                op_usb_init = HF_Frame({'operation_code': opcodes['OP_USB_INIT'], \
+                                               'core_address': core_address_field, \
+                                               'hdata': self.clockrate})
+                self.last_op_usb_init_count = self.last_op_usb_init_count + 1
+                if InitSent in self.handlers:
+                    self.emit(InitSent(self.last_op_usb_init_count))
+                self.transmitter.send(op_usb_init.buffer)
+                self.last_op_usb_init_sent = time.time()
+
+            token = self.parser.next_token()
+            if token:
+                if isinstance(token, HF_OP_USB_INIT):
+                    # Fix: Do this the correct way, probably by creating OP_FAN class.
+                    op_fan = HF_Frame({'operation_code': opcodes['OP_FAN'], \
+                                        'core_address': 0x01, \
+                                        'chip_address': 0xFF, \
+                                        'hdata': 252})
+                    self.transmitter.send(op_fan.buffer)
+
+                    # parse OP_USB_INIT
+                    self.number_of_dies = token.chip_address
+                    self.cores_per_die = token.core_address
+                    self.global_state = 'running'
+
+                    # 16 bytes of struct hf_usb_init_base
+                    # 16 bytes of struct hf_config_data
+                    # Variable length core map
+                    init_base = codec.hf_usb_init_base.unpack(token.data, 0)
+                    config = codec.hf_config_data.unpack(token.data, codec.hf_usb_init_base.size)
+                    coremap_bytes = bytes(token.data[codec.hf_usb_init_base.size + codec.hf_config_data.size:])
+                    if InitReceived in self.handlers:
+                        self.emit(InitReceived(token.chip_address, token.core_address, token.hdata,
+                                               token.framebytes, init_base, config, coremap_bytes))
+
+                    if init_base.operation_status != 0:
+                        raise HF_Error("operation_status not successful: %d" % (init_base.operation_status))
+
+                    self.estimator = HashRateEstimator(token.chip_address, token.core_address)
+                    self.dies = [self.new_die() for i in range(token.chip_address)]
+                    self.scheduler = SlotScheduler(token.chip_address, token.core_address)
+                    self.begin_counting(result)
+
+        elif self.global_state == 'running':
+            while self.dropped:
+                die, core, sequence = self.dropped.popleft()
+                self.dies[die]['work'].kill(sequence)
+                self.scheduler.dropped(die, core, sequence)
+
+            # Fix: Perhaps average should be updated on every good nonce and then
+            #      be available for reading.
+            if self.time_of_last_hash_report is not None and HashReport in self.handlers:
+                report_elapsed = time.time() - self.time_of_last_hash_report
+                if report_elapsed > self.hash_report_interval:
+                    self.emit(HashReport(self.hash_rate, self.scheduler.idle_slot_seconds(),
+                                         self.estimator.dies()))
+                    self.time_of_last_hash_report = time.time()
+
+            while(self.parser.has_token()):
+                token = self.parser.next_token()
+                if token:
+                    if isinstance(token, HF_OP_NONCE):
+                        for nonce in token.nonces:
+                            die = token.chip_address
+                            work = self.dies[die]['work']
+                            sequence = nonce.sequence
+                            if sequence in work:
+                                core = work.cores[sequence]
+                                if self.validator is None:
+                                    verifier = work.verifiers[sequence]
+                                    zerobits, regen_hash_expanded = verifier.check(nonce.nonce, nonce.ntime_offset)
+                                    self.nonce_verdict(die, core, sequence, nonce.nonce, zerobits,
+                                                       regen_hash_expanded, nonce.ntime_offset,
+                                                       work.generations[sequence])
+                                    # Another nonce in the next few.
+                                    if nonce.search_forward:
+                                        found = verifier.search(nonce.nonce, work.search_difficulties[sequence],
+                                                                nonce.ntime_offset)
+                                        if found is not None:
+                                            self.nonce_verdict(die, core, sequence,
+                                                               found[0], found[1], found[2], nonce.ntime_offset,
+                                                               work.generations[sequence])
+                                else:
+                                    search_difficulty = None
+                                    if nonce.search_forward:
+                                        search_difficulty = work.search_difficulties[sequence]
+                                    self.validator.submit(work.jobs[sequence], nonce.nonce, die, core, sequence,
+                                                          nonce.ntime_offset, search_difficulty,
+                                                          work.generations[sequence])
+                            else:
+                                self.total_errors += 1
+                                result.unknown_sequences = result.unknown_sequences + 1
+                                result.dies[die].unknown_sequences = result.dies[die].unknown_sequences + 1
+                                if UnknownSequence in self.handlers:
+                                    self.emit(UnknownSequence(die, sequence))
+                    elif isinstance(token, HF_OP_STATUS):
+                        die = token.chip_address
+                        last_sequence_seen = token.hdata
+                        assert die < len(self.dies)
+                        self.scheduler.status(die, token.coremap, last_sequence_seen)
+                        result.dies[die].statuses = result.dies[die].statuses + 1
+                        if Status in self.handlers:
+                            slots = self.scheduler.dies[die]
+                            self.emit(Status(die, last_sequence_seen,
+                                             count_bits(slots.active), count_bits(slots.pending),
+                                             token.thermal_cutoff, token.monitor_data))
+                        if token.thermal_cutoff:
+                            raise HF_Thermal("THERMAL CUTOFF, die %d" % (die))
+                        self.dies[die]['last sequence'] = last_sequence_seen
+                        self.dies[die]['work'].expire(last_sequence_seen)
+                    elif isinstance(token, HF_OP_USB_NOTICE):
+                        if Notice in self.handlers:
+                            self.emit(Notice(token.notification_code, token.extra_data, token.message))
+                    elif isinstance(token, HF_Frame):
+                        # Including an OP_USB_INIT we did not ask for.
+                        if UnexpectedFrame in self.handlers:
+                            self.emit(UnexpectedFrame(opnames[token.operation_code], token))
+                    elif isinstance(token, Garbage):
+                        result.garbage_bytes = result.garbage_bytes + len(token.garbage)
+                        if GarbageReceived in self.handlers:
+                            self.emit(GarbageReceived(len(token.garbage)))
+                    else:
+                        raise HF_Error("Unexpected token type: %s" % (token))
+
+            if self.validator is not None:
+                for verdict in self.validator.verdicts():
+                    self.nonce_verdict(verdict.die, verdict.core, verdict.sequence, verdict.nonce,
+                                       verdict.zerobits, verdict.hash, verdict.ntime_offset,
+                                       verdict.generation)
+
+            restock_start = time.time()
+            restocked = 0
+            for die, core in self.free_slots():
+                this_die = self.dies[die]
+                prepared = self.job_source.next()
+                job = prepared.job
+                sequence = this_die['sequence']
+                this_die['work'].insert(sequence, job, prepared.verifier(), core,
+                                        self.test_search_difficulty, time.time())
+                this_die['sequence'] = (sequence + 1) % 2**16
+                self.scheduler.dispatched(die, core, sequence)
+                self.transmitter.schedule(self.op_hash_template.encode(die, core, sequence,
+                                                                       prepared.payload(self.test_search_difficulty)))
+                # Fix: See if there's a way to decrease time it takes to check
+                #      for incoming traffic so this hack can be avoided.
+                if self.receiver is not None and restocked % 10 == 0:
+                    self.receiver.receive()
+                restocked = restocked + 1
+            if restocked > 0:
+                self.restock_time_last = time.time() - restock_start
+                self.restock_time_max = max(self.restock_time_max, self.restock_time_last)
+            # Push out whatever the stocking loop queued.
+            self.transmitter.flush()
+        else:
+            raise HF_Error("Unknown global_state: %s" % (self.global_state))
+
+    def new_die(self):
+        return {'sequence': 0, 'work': WorkTable(), 'last sequence': None}
+
+    # (die, core) for each slot to stock now: active slots on every die
+    # first, then pending ones.
+    def free_slots(self):
+        return self.scheduler.slots()
+
+    def share_target(self):
+        if self.test_target is None:
+            return zerobits_target(self.test_search_difficulty)
+        return self.test_target
+
+    # generation is the WorkTable generation sequence had when the nonce
+    # came in.  A verdict which comes back after the slot has been
+    # reused still counts towards the hash rate, but is not reported
+    # as a share of the new job.
+    def nonce_verdict(self, die, core, sequence, nonce, zerobits, regen_hash, ntime_offset=0,
+                      generation=None):
+        result = self.result
+        stats = result.dies[die]
+        target = self.share_target()
+        if meets_target(regen_hash, target):
+            job = self.dies[die]['work'].job(sequence, generation)
+            if job is not None:
+                self.job_source.found(job, nonce, ntime_offset, regen_hash)
+            now = time.time()
+            if self.hash_rate_start is None:
+                self.hash_rate_start = now
+                self.time_of_last_hash_report = now
+            hashes = hashes_per_share(target)
+            self.total_hashes += hashes
+            self.estimator.add(die, core, hashes, now)
+            elapsed = now - self.hash_rate_start
+            if elapsed > 0:
+                self.hash_rate = self.total_hashes / elapsed
+            difficulty = share_difficulty(regen_hash)
+            self.best_share_difficulty = max(self.best_share_difficulty, difficulty)
+            result.hashes += hashes
+            result.good_nonces += 1
+            stats.hashes += hashes
+            stats.good_nonces += 1
+            if difficulty > stats.best_share_difficulty:
+                stats.best_share_difficulty = difficulty
+            if GoodNonce in self.handlers:
+                self.emit(GoodNonce(die, core, sequence, nonce, zerobits, difficulty, ntime_offset))
+        else:
+            self.total_errors += 1
+            result.bad_nonces += 1
+            stats.bad_nonces += 1
+            if BadNonce in self.handlers:
+                self.emit(BadNonce(die, core, sequence, nonce, ntime_offset))
+
+    def __del__(self):
+        if self.owns_job_source and self.job_source is not None:
+            self.job_source.close()
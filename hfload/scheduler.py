@@ -0,0 +1,233 @@
+import collections
+import heapq
+import random
+import time
+
+from .hf import sequence_a_leq_b
+
+# Which core slots to stock, kept as bitmasks.
+#
+# The OP_STATUS job map has two bits per core, active then pending,
+# core 0 in the lowest bits.  split_job_map() pulls the even and odd
+# bits apart with a handful of shift-and-mask steps on the whole map,
+# so bit n of each result is core n.  A slot is free to stock when its
+# bit is clear, and the core is not still waiting for the die to take
+# the last job we sent it, which is the unseen mask.
+#
+# A core goes into unseen when it is sent a job, and comes out when an
+# OP_STATUS has a last sequence at or past that job.  The jobs go
+# through an in-order queue, so a status only looks at the jobs it has
+# newly seen.  Together with iterating set bits only, the cost of a
+# status and a restock is in the slots which changed, not the cores.
+#
+# slots() hands out every free slot, active ones on all dies first;
+# after sending work there, call dispatched().  The dies take turns: a
+# heap keyed on (free slots left, time of the die's last restock) picks
+# the die with the most free slots, and of those the one which has waited
+# longest, for each slot in turn.  So a burst of statuses from one die
+# doesn't hold the others up while its work is encoded, and the OP_HASH
+# frames go out interleaved.
+#
+# A free active slot is a core with nothing to hash.  Each die adds up
+# its free active slots times the seconds they stay free, from the status
+# which shows them until the slot is stocked or the next status, in
+# idle_slot_seconds.  That is the hashing capacity lost to the host.
+# Free pending slots are not counted, since their cores are still busy.
+
+# (shift, mask) steps for compacting every other bit of a 2 * width bit
+# map: each step halves the gaps, like the usual 0x5555..., 0x3333...,
+# 0x0f0f... sequence for 32 bits.
+compact_steps = {}
+
+def steps_for(width):
+    steps = compact_steps.get(width)
+    if steps is None:
+        steps = []
+        group = 1
+        while True:
+            mask = 0
+            for start in range(0, 2 * width, 2 * group):
+                mask = mask | (((1 << group) - 1) << start)
+            steps.append((group // 2, mask))
+            if group >= width:
+                break
+            group = 2 * group
+        compact_steps[width] = steps
+    return steps
+
+# Bits 0, 2, 4... of x packed into bits 0, 1, 2...
+def compact_even_bits(x, width):
+    for shift, mask in steps_for(width):
+        x = (x | (x >> shift)) & mask
+    return x
+
+# Returns (active, pending) bitmasks, bit n for core n.
+def split_job_map(jobmap, cores):
+    bitmap = int.from_bytes(bytes(jobmap), 'little')
+    return (compact_even_bits(bitmap, cores), compact_even_bits(bitmap >> 1, cores))
+
+def bits(x):
+    while x:
+        low = x & -x
+        yield low.bit_length() - 1
+        x = x ^ low
+
+def count_bits(x):
+    return bin(x).count('1')
+
+class DieSlots():
+    __slots__ = ('active', 'pending', 'free_active', 'free_pending', 'unseen',
+                 'latest', 'sent', 'last_sequence',
+                 'idle', 'idle_since', 'idle_slot_seconds', 'last_restock')
+
+    def __init__(self):
+        self.active = 0
+        self.pending = 0
+        self.free_active = 0
+        self.free_pending = 0
+        self.unseen = 0
+        # core -> last sequence sent to it
+        self.latest = {}
+        # (sequence, core) in the order sent, until the die takes them
+        self.sent = collections.deque()
+        self.last_sequence = None
+        # Free active slots, and since when that count has held.
+        self.idle = 0
+        self.idle_since = None
+        self.idle_slot_seconds = 0.0
+        self.last_restock = 0.0
+
+    def account(self, now, idle):
+        if self.idle_since is not None:
+            self.idle_slot_seconds = self.idle_slot_seconds + self.idle * (now - self.idle_since)
+        self.idle = idle
+        self.idle_since = now
+
+class SlotScheduler():
+    def __init__(self, dies, cores, clock=time.time):
+        self.cores = cores
+        self.all_cores = (1 << cores) - 1
+        self.dies = [DieSlots() for i in range(dies)]
+        self.clock = clock
+
+    def status(self, die, jobmap, last_sequence):
+        slots = self.dies[die]
+        now = self.clock()
+        slots.last_sequence = last_sequence
+        sent = slots.sent
+        while sent and sequence_a_leq_b(sent[0][0], last_sequence):
+            sequence, core = sent.popleft()
+            if slots.latest.get(core) == sequence:
+                slots.unseen = slots.unseen & ~(1 << core)
+        slots.active, slots.pending = split_job_map(jobmap, self.cores)
+        available = self.all_cores & ~slots.unseen
+        slots.free_active = ~slots.active & available
+        slots.free_pending = ~slots.pending & available
+        slots.account(now, count_bits(slots.free_active))
+
+    def dispatched(self, die, core, sequence):
+        slots = self.dies[die]
+        slots.latest[core] = sequence
+        slots.unseen = slots.unseen | (1 << core)
+        slots.sent.append((sequence, core))
+
+    # The OP_HASH for sequence was cut from the send queue by an abort
+    # and will never reach the die, so stop waiting for it to be taken.
+    def dropped(self, die, core, sequence):
+        slots = self.dies[die]
+        if slots.latest.get(core) == sequence:
+            del slots.latest[core]
+            slots.unseen = slots.unseen & ~(1 << core)
+
+    # Leaves count free active slots on die, picked at random, unstocked
+    # until the next status.  They are left idle on purpose, so they stop
+    # counting towards idle_slot_seconds.
+    def hold(self, die, count):
+        slots = self.dies[die]
+        free = list(bits(slots.free_active))
+        for core in random.sample(free, min(count, len(free))):
+            slots.free_active = slots.free_active & ~(1 << core)
+        slots.account(self.clock(), count_bits(slots.free_active))
+
+    def free_count(self):
+        return sum(count_bits(x.free_active) + count_bits(x.free_pending) for x in self.dies)
+
+    # Including the time the currently free slots have been waiting.
+    def idle_slot_seconds(self):
+        now = self.clock()
+        result = []
+        for slots in self.dies:
+            idle = slots.idle_slot_seconds
+            if slots.idle_since is not None:
+                idle = idle + slots.idle * (now - slots.idle_since)
+            result.append(idle)
+        return result
+
+    # (die, core) for every free slot, active slots first unless
+    # pending is False, in which case pending slots stay free.
+    def slots(self, pending=True):
+        for die, core in self.take('free_active'):
+            yield (die, core)
+        if pending:
+            for die, core in self.take('free_pending'):
+                yield (die, core)
+
+    def take(self, kind):
+        heap = []
+        for die in range(len(self.dies)):
+            slots = self.dies[die]
+            free = getattr(slots, kind)
+            if free:
+                heap.append((-count_bits(free), slots.last_restock, die))
+        heapq.heapify(heap)
+        while heap:
+            count, last_restock, die = heapq.heappop(heap)
+            slots = self.dies[die]
+            free = getattr(slots, kind)
+            low = free & -free
+            setattr(slots, kind, free ^ low)
+            now = self.clock()
+            slots.last_restock = now
+            if kind == 'free_active':
+                slots.account(now, slots.idle - 1)
+            if count < -1:
+                heapq.heappush(heap, (count + 1, now, die))
+            yield (die, low.bit_length() - 1)
+
+def self_test():
+    # Core 0 active, core 1 pending, core 2 both.
+    assert split_job_map([0b00111001], 4) == (0b0101, 0b0110)
+    rnd = random.Random(1)
+    active = rnd.getrandbits(96)
+    pending = rnd.getrandbits(96)
+    jobmap = 0
+    for core in range(96):
+        jobmap = jobmap | (((active >> core) & 1) << (2 * core)) | (((pending >> core) & 1) << (2 * core + 1))
+    assert split_job_map(jobmap.to_bytes(24, 'little'), 96) == (active, pending)
+    # Active slots on every die before any pending one, the die with the
+    # most free first, and turn about when they are even.
+    ticks = iter(range(1000))
+    scheduler = SlotScheduler(2, 4, clock=lambda: float(next(ticks)))
+    scheduler.status(0, [0], 0)
+    scheduler.status(1, [0b00000101], 0)
+    assert list(scheduler.slots()) == [(0, 0), (0, 1), (1, 2), (0, 2), (1, 3), (0, 3),
+                                       (1, 0), (0, 0), (1, 1), (0, 1), (1, 2), (0, 2), (1, 3), (0, 3)]
+    # Only active slots with pending=False.
+    scheduler.status(1, [0], 0)
+    assert list(scheduler.slots(pending=False)) == [(1, 0), (1, 1), (1, 2), (1, 3)]
+    # A core sent work is not offered again until a status shows the die
+    # has taken it, or the work is dropped.
+    scheduler.dispatched(0, 0, 5)
+    scheduler.dispatched(0, 1, 6)
+    scheduler.status(0, [0], 4)
+    assert list(scheduler.slots(pending=False)) == [(0, 2), (0, 3)]
+    scheduler.status(0, [0], 5)
+    assert list(scheduler.slots(pending=False)) == [(0, 0), (0, 2), (0, 3)]
+    scheduler.dropped(0, 1, 6)
+    scheduler.status(0, [0], 5)
+    assert list(scheduler.slots(pending=False)) == [(0, 0), (0, 1), (0, 2), (0, 3)]
+    return True
+
+if __name__ == '__main__':
+    self_test()
+    print("scheduler agrees with itself.")
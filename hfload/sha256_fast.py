@@ -0,0 +1,188 @@
+# Fast companions to the helpers in sha256.py.
+
+# Same names and arguments as in sha256.py, but the results are bytes
+# where sha256.py returns lists of byte values, and inputs may be
+# anything bytes-like as well as lists.  The work is done with struct,
+# int.from_bytes()/to_bytes() and array.byteswap() instead of list
+# concatenation, and the input checks only run when check_inputs is
+# True.  sha256.py stays as the checked reference; self_test() makes
+# sure the two agree.
+#
+# The compression function here is sha256_internal() without the
+# asserts and function calls, still plain Python.  It is only needed for
+# midstates, which hashlib doesn't expose.  Whole hashes go to hashlib.
+
+import array
+import hashlib
+import struct
+
+from . import sha256 as reference
+
+check_inputs = False
+
+# An array type with 4 byte items, for swapping words.
+if array.array('I').itemsize == 4:
+    word_type = 'I'
+else:
+    word_type = 'L'
+assert array.array(word_type).itemsize == 4
+
+K = tuple(reference.K)
+H_const = tuple(reference.H_const)
+
+def check_bytes(data, length=None):
+    data = bytes(data)
+    if length is not None:
+        assert len(data) == length
+    return data
+
+def int_to_lebytes(integer, digit):
+    if check_inputs:
+        assert digit > 0
+        assert integer >= 0 and integer < 256 ** digit
+    return integer.to_bytes(digit, 'little')
+
+def int_to_bebytes(integer, digit):
+    if check_inputs:
+        assert digit > 0
+        assert integer >= 0 and integer < 256 ** digit
+    return integer.to_bytes(digit, 'big')
+
+def bebytes_to_int(bebytes):
+    if check_inputs:
+        bebytes = check_bytes(bebytes)
+    return int.from_bytes(bytes(bebytes), 'big')
+
+def reverse_every_four_bytes(data):
+    if check_inputs:
+        assert len(data) % 4 == 0
+    words = array.array(word_type, bytes(data))
+    words.byteswap()
+    return words.tobytes()
+
+def hash_words_to_bstring(hws):
+    if check_inputs:
+        assert len(hws) == 8
+    return struct.pack('>8I', *hws)
+
+def midstate_to_bytes(midstate):
+    if check_inputs:
+        assert len(midstate) == 8
+    return struct.pack('>8I', *midstate)
+
+def bytes_to_midstate(data):
+    if check_inputs:
+        data = check_bytes(data, 32)
+    return list(struct.unpack('>8I', bytes(data)))
+
+def pad_message(M, bytecount=None):
+    M = bytes(M)
+    if bytecount is None:
+        bytecount = len(M)
+    zero_count = (55 - len(M)) % 64
+    return M + b'\x80' + bytes(zero_count) + (8 * bytecount).to_bytes(8, 'big')
+
+def parse_message(M_padded):
+    M_padded = bytes(M_padded)
+    if check_inputs:
+        assert len(M_padded) % 64 == 0
+    return [list(words) for words in struct.iter_unpack('>16I', M_padded)]
+
+def sha256_internal(parsed_message, midstate=None):
+    if midstate is None:
+        midstate = H_const
+    if check_inputs:
+        assert len(midstate) == 8
+        assert all(len(x) == 16 for x in parsed_message)
+    H = list(midstate)
+    for M in parsed_message:
+        W = list(M)
+        for t in range(16, 64):
+            x = W[t-15]
+            y = W[t-2]
+            s0 = ((x >> 7) | (x << 25)) ^ ((x >> 18) | (x << 14)) ^ (x >> 3)
+            s1 = ((y >> 17) | (y << 15)) ^ ((y >> 19) | (y << 13)) ^ (y >> 10)
+            W.append((s1 + W[t-7] + (s0 & 0xffffffff) + W[t-16]) & 0xffffffff)
+        a, b, c, d, e, f, g, h = H
+        for t in range(64):
+            S1 = ((e >> 6) | (e << 26)) ^ ((e >> 11) | (e << 21)) ^ ((e >> 25) | (e << 7))
+            T1 = h + (S1 & 0xffffffff) + ((e & f) ^ (~e & g)) + K[t] + W[t]
+            S0 = ((a >> 2) | (a << 30)) ^ ((a >> 13) | (a << 19)) ^ ((a >> 22) | (a << 10))
+            T2 = (S0 & 0xffffffff) + ((a & b) ^ (a & c) ^ (b & c))
+            h = g
+            g = f
+            f = e
+            e = (d + T1) & 0xffffffff
+            d = c
+            c = b
+            b = a
+            a = (T1 + T2) & 0xffffffff
+        H = [(x + y) & 0xffffffff for x, y in zip(H, (a, b, c, d, e, f, g, h))]
+    return H
+
+# Whole messages without a midstate go to hashlib.
+def sha256(M, midstate=None, bytecount=None):
+    if midstate is None and bytecount is None:
+        return hashlib.sha256(bytes(M)).digest()
+    parsed = parse_message(pad_message(M, bytecount))
+    return hash_words_to_bstring(sha256_internal(parsed, midstate))
+
+def sha256_with_midstate(M, midstate, bytecount):
+    return sha256_internal(parse_message(pad_message(M, bytecount)), midstate)
+
+def sha256_midstate(M):
+    if check_inputs:
+        assert len(M) % 64 == 0
+    return sha256_internal(parse_message(M))
+
+# This behaves exactly like cgminer's calc_midstate() function.
+def cgminer_calc_midstate(sixty_four_bytes):
+    if check_inputs:
+        sixty_four_bytes = check_bytes(sixty_four_bytes, 64)
+    # The byte swapping before and after is just reading and writing
+    # the words little-endian.
+    block = list(struct.unpack('<16I', bytes(sixty_four_bytes)))
+    return struct.pack('<8I', *sha256_internal([block]))
+
+def cgminer_regen_hash(eighty_bytes):
+    if check_inputs:
+        eighty_bytes = check_bytes(eighty_bytes, 80)
+    swapped = reverse_every_four_bytes(eighty_bytes)
+    return hashlib.sha256(hashlib.sha256(swapped).digest()).digest()
+
+# Checks that everything here agrees with sha256.py, on count random
+# inputs.  Returns True, or raises AssertionError.
+def self_test(count=8, seed=1):
+    import random
+    rnd = random.Random(seed)
+    for i in range(count):
+        integer = rnd.getrandbits(32)
+        assert list(int_to_lebytes(integer, 4)) == reference.int_to_lebytes(integer, 4)
+        assert list(int_to_bebytes(integer, 4)) == reference.int_to_bebytes(integer, 4)
+        data = [rnd.getrandbits(8) for j in range(rnd.randrange(1, 200))]
+        assert bebytes_to_int(data) == reference.bebytes_to_int(data)
+        assert list(pad_message(data)) == reference.pad_message(data)
+        assert list(pad_message(data, 1000)) == reference.pad_message(data, 1000)
+        padded = reference.pad_message(data)
+        assert parse_message(padded) == reference.parse_message(padded)
+        assert sha256_internal(parse_message(padded)) == reference.sha256_internal(reference.parse_message(padded))
+        assert sha256(data) == reference.sha256(data)
+        words = [rnd.getrandbits(32) for j in range(8)]
+        assert list(midstate_to_bytes(words)) == reference.midstate_to_bytes(words)
+        assert hash_words_to_bstring(words) == reference.hash_words_to_bstring(words)
+        thirty_two = reference.midstate_to_bytes(words)
+        assert bytes_to_midstate(thirty_two) == reference.bytes_to_midstate(thirty_two)
+        sixty_four = [rnd.getrandbits(8) for j in range(64)]
+        assert list(reverse_every_four_bytes(sixty_four)) == reference.reverse_every_four_bytes(sixty_four)
+        assert sha256_midstate(sixty_four) == reference.sha256_midstate(sixty_four)
+        assert list(cgminer_calc_midstate(sixty_four)) == reference.cgminer_calc_midstate(sixty_four)
+        assert sha256_with_midstate(data, words, 64 + len(data)) == \
+            reference.sha256_with_midstate(data, words, 64 + len(data))
+        assert sha256(data, words, 64 + len(data)) == reference.sha256(data, words, 64 + len(data))
+        eighty = [rnd.getrandbits(8) for j in range(80)]
+        assert cgminer_regen_hash(eighty) == reference.cgminer_regen_hash(eighty)
+    return True
+
+if __name__ == '__main__':
+    self_test()
+    print("sha256_fast agrees with sha256.")
@@ -0,0 +1,174 @@
+# Batch SHA-256 with NumPy.
+
+# requires numpy
+#   pip install numpy
+
+# Runs the compression function of sha256.py over N blocks at once.  A
+# state is an (N, 8) array and a set of blocks an (N, 16) array, both
+# of np.uint32 words, as in FIPS-180-4.  Every operation is one array
+# operation over all N, so the Python overhead is paid once per round
+# rather than once per block.
+#
+# The entry points mirror the cgminer flavoured functions in sha256.py
+# and hf.py:
+#   calc_midstates()  cgminer_calc_midstate() for N 64 byte blocks
+#   regen_hashes()    cgminer_regen_hash() for N 80 byte headers
+#   regen_hashes_with_midstates()  the same, from the midstates
+#   count_leading_zeros()  hf.count_leading_zeros() for N hashes
+# self_test() checks them all against the reference implementation.
+#
+# Byte inputs may be bytes (N blocks back to back) or (N, size) uint8
+# arrays.  Hashes come back as an (N, 32) uint8 array.
+
+import numpy as np
+
+from . import hf
+from . import sha256
+
+K = np.array(sha256.K, dtype=np.uint32)
+H_const = np.array(sha256.H_const, dtype=np.uint32)
+
+def ROTR(n, x):
+    return (x >> np.uint32(n)) | (x << np.uint32(32 - n))
+
+# W is a list of 16 arrays of N words, one per message word.
+def compress(state, W):
+    W = list(W)
+    for t in range(16, 64):
+        x = W[t-15]
+        y = W[t-2]
+        s0 = ROTR(7, x) ^ ROTR(18, x) ^ (x >> np.uint32(3))
+        s1 = ROTR(17, y) ^ ROTR(19, y) ^ (y >> np.uint32(10))
+        W.append(s1 + W[t-7] + s0 + W[t-16])
+    a, b, c, d, e, f, g, h = [state[:, i] for i in range(8)]
+    for t in range(64):
+        S1 = ROTR(6, e) ^ ROTR(11, e) ^ ROTR(25, e)
+        ch = (e & f) ^ (~e & g)
+        T1 = h + S1 + ch + K[t] + W[t]
+        S0 = ROTR(2, a) ^ ROTR(13, a) ^ ROTR(22, a)
+        maj = (a & b) ^ (a & c) ^ (b & c)
+        T2 = S0 + maj
+        h = g
+        g = f
+        f = e
+        e = d + T1
+        d = c
+        c = b
+        b = a
+        a = T1 + T2
+    return state + np.stack([a, b, c, d, e, f, g, h], axis=1)
+
+def as_byte_rows(data, size):
+    if not isinstance(data, np.ndarray):
+        data = np.frombuffer(bytes(data), dtype=np.uint8)
+    return np.ascontiguousarray(data.reshape(-1, size), dtype=np.uint8)
+
+# Reads each row as 32 bit words, big-endian as SHA-256 wants them, or
+# little-endian, which is what cgminer's byte swapping amounts to.
+def words(rows, byteorder):
+    dtype = np.dtype(np.uint32).newbyteorder('>' if byteorder == 'big' else '<')
+    return rows.view(dtype).astype(np.uint32)
+
+def columns(word_rows):
+    return [word_rows[:, i] for i in range(word_rows.shape[1])]
+
+def initial_states(n):
+    return np.tile(H_const, (n, 1))
+
+# Padding words for a message of length bytes ending in this block,
+# after count words of message.
+def padding_columns(n, count, length):
+    pad = [np.zeros(n, dtype=np.uint32) for i in range(16 - count)]
+    pad[0] = pad[0] | np.uint32(0x80000000)
+    pad[-1] = pad[-1] | np.uint32(8 * length)
+    return pad
+
+def state_bytes(states):
+    return words_to_bytes(states, 'big')
+
+def words_to_bytes(word_rows, byteorder):
+    dtype = np.dtype(np.uint32).newbyteorder('>' if byteorder == 'big' else '<')
+    return np.ascontiguousarray(word_rows.astype(dtype)).view(np.uint8)
+
+# cgminer_calc_midstate() for each 64 byte row.  Returns (N, 32) uint8.
+def calc_midstates(sixty_fours):
+    rows = as_byte_rows(sixty_fours, 64)
+    states = compress(initial_states(len(rows)), columns(words(rows, 'little')))
+    return words_to_bytes(states, 'little')
+
+# The second SHA-256 of a double hash, over the 32 bytes of states.
+def second_hash(states):
+    W = columns(states) + padding_columns(len(states), 8, 32)
+    return state_bytes(compress(initial_states(len(states)), W))
+
+# cgminer_regen_hash() for each 80 byte row.  Returns (N, 32) uint8.
+def regen_hashes(eighty_bytes):
+    rows = as_byte_rows(eighty_bytes, 80)
+    W = columns(words(rows, 'little'))
+    states = compress(initial_states(len(rows)), W[0:16])
+    states = compress(states, W[16:20] + padding_columns(len(rows), 4, 80))
+    return second_hash(states)
+
+# Like regen_hashes(), starting from the midstates as cgminer_calc_midstate()
+# returns them, (N, 32), and the last 16 bytes of each header, (N, 16),
+# still in header order.  For checking many nonces of one job, repeat
+# the one midstate with np.tile().
+def regen_hashes_with_midstates(midstates, tails):
+    states = words(as_byte_rows(midstates, 32), 'little')
+    W = columns(words(as_byte_rows(tails, 16), 'little'))
+    states = compress(states, W + padding_columns(len(states), 4, 80))
+    return second_hash(states)
+
+# Last 16 bytes of the headers for one job and an array of nonces.
+def job_tails(merkle_residual, timestamp, bits, nonces):
+    nonces = np.asarray(nonces, dtype=np.uint32)
+    tails = np.empty((len(nonces), 4), dtype=np.uint32)
+    tails[:, 0] = np.frombuffer(bytes(merkle_residual), dtype='<u4')[0]
+    tails[:, 1] = timestamp
+    tails[:, 2] = bits
+    tails[:, 3] = nonces
+    return words_to_bytes(tails, 'little')
+
+clz_table = np.array([8 - x.bit_length() for x in range(256)], dtype=np.int64)
+
+# hf.count_leading_zeros() for each 32 byte row: zero bits counted from
+# the most significant bit of the last byte down.  Returns N ints.
+def count_leading_zeros(hashes):
+    rows = as_byte_rows(hashes, 32)[:, ::-1]
+    nonzero = rows != 0
+    first = np.argmax(nonzero, axis=1)
+    top = rows[np.arange(len(rows)), first]
+    zeros = 8 * first + clz_table[top]
+    zeros[~nonzero.any(axis=1)] = 256
+    return zeros
+
+# Checks every entry point against sha256.py on count random inputs.
+# Returns True, or raises AssertionError.
+def self_test(count=16, seed=1):
+    rng = np.random.default_rng(seed)
+    sixty_fours = rng.integers(0, 256, (count, 64), dtype=np.uint8)
+    midstates = calc_midstates(sixty_fours)
+    for i in range(count):
+        assert bytes(midstates[i]) == bytes(sha256.cgminer_calc_midstate(sixty_fours[i].tolist()))
+    headers = rng.integers(0, 256, (count, 80), dtype=np.uint8)
+    hashes = regen_hashes(headers)
+    for i in range(count):
+        assert bytes(hashes[i]) == sha256.cgminer_regen_hash(headers[i].tolist())
+    with_midstates = regen_hashes_with_midstates(calc_midstates(headers[:, 0:64]), headers[:, 64:80])
+    assert (with_midstates == hashes).all()
+    # Clear the top bytes and bits by varying amounts, so the zero
+    # counting sees more than the odd leading zero.
+    samples = rng.integers(0, 256, (count, 32), dtype=np.uint8)
+    for i in range(count):
+        top = (5 * i) % 33
+        samples[i, 32-top:] = 0
+        if top < 32:
+            samples[i, 31-top] >>= i % 8
+    zeros = count_leading_zeros(samples)
+    for i in range(count):
+        assert zeros[i] == hf.count_leading_zeros(samples[i].tolist())
+    return True
+
+if __name__ == '__main__':
+    self_test()
+    print("sha256_np agrees with sha256.")
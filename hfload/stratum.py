@@ -0,0 +1,537 @@
+import collections
+import hashlib
+import json
+import random
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+from . import backends
+from .difficulty import difficulty_target, hash_to_int
+from .hf import bswap32
+from .jobs import JobSource, PreparedJob, PreparedWork
+
+# Real work over the stratum protocol, and a pool to get it from.
+#
+# StratumClient speaks stratum (JSON-RPC, one message per line) to a
+# pool: subscribe, authorize, take mining.notify and
+# mining.set_difficulty, and submit shares, timing how long each
+# submission takes to be answered.
+#
+# StratumWork turns one mining.notify into hfload jobs.  Each job gets
+# the next extranonce2.  The coinbase is hashed from a hashlib state
+# which has already taken coinb1 and extranonce1, so only extranonce2 and
+# coinb2 are hashed per job, and the merkle branch is decoded once and
+# folded onto the coinbase hash.
+#
+# StratumWorkSource is a JobSource whose jobs come from the client's
+# latest StratumWork instead of random bytes.  Good nonces handed to
+# found() which meet the pool's target are submitted as shares.
+#
+# MockStratumServer is a small pool on localhost which makes up its own
+# work, checks shares from scratch, and keeps count, so all of the above
+# can be run without the network.
+#
+# Byte order: the jobs are in cgminer's order, the block header with
+# every four bytes swapped, as everywhere else in hfload.  So the job's
+# version, timestamp and bits are the header fields byte swapped, the
+# merkle root is swapped word by word, and stratum's previous block hash
+# is already in that order.  A nonce from the device goes into the
+# submission the same way cgminer does it, as the hex of its four bytes.
+
+class StratumError(Exception):
+    pass
+
+def double_sha256(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+def swap_words(data):
+    return struct.pack('>%dI' % (len(data) // 4), *struct.unpack('<%dI' % (len(data) // 4), data))
+
+# One mining.notify, ready to make jobs from.
+class StratumWork():
+    def __init__(self, params, extranonce1, extranonce2_size, target, generation=0):
+        (self.job_id, prevhash, coinb1, coinb2, branch,
+         version, nbits, ntime, self.clean_jobs) = params[0:9]
+        self.extranonce1 = extranonce1
+        self.extranonce2_size = extranonce2_size
+        self.target = target
+        self.generation = generation
+        self.prevhash = list(bytes.fromhex(prevhash))
+        self.branch = [bytes.fromhex(x) for x in branch]
+        self.version = int(version, 16)
+        self.nbits = int(nbits, 16)
+        self.ntime = int(ntime, 16)
+        self.coinbase_prefix = hashlib.sha256(bytes.fromhex(coinb1) + extranonce1)
+        self.coinb2 = bytes.fromhex(coinb2)
+        self.extranonce2 = 0
+        self.received = time.time()
+
+    def merkle_root(self, extranonce2):
+        hash1 = self.coinbase_prefix.copy()
+        hash1.update(extranonce2 + self.coinb2)
+        root = hashlib.sha256(hash1.digest()).digest()
+        for step in self.branch:
+            root = double_sha256(root + step)
+        return root
+
+    def next_extranonce2(self):
+        value = self.extranonce2
+        self.extranonce2 = (value + 1) % (256 ** self.extranonce2_size)
+        return value.to_bytes(self.extranonce2_size, 'little')
+
+    # A job dict as rand_job() makes them, and the extranonce2 it uses.
+    def job(self, ntime_loops=0):
+        extranonce2 = self.next_extranonce2()
+        job = {}
+        job['version'] = bswap32(self.version)
+        job['previous block hash'] = self.prevhash
+        job['merkle tree root'] = list(swap_words(self.merkle_root(extranonce2)))
+        job['timestamp'] = bswap32(self.ntime)
+        job['bits'] = bswap32(self.nbits)
+        job['starting nonce'] = 0
+        job['nonce loops'] = 0
+        job['ntime loops'] = ntime_loops
+        return [job, extranonce2]
+
+    # mining.submit parameters after the worker name.
+    def submission(self, extranonce2, nonce, ntime_offset=0):
+        ntime = (self.ntime + ntime_offset) & 0xffffffff
+        return [self.job_id, extranonce2.hex(), '%08x' % (ntime), nonce.to_bytes(4, 'little').hex()]
+
+class StratumClient():
+    def __init__(self, host, port, username, password='x', timeout=10.0, agent='hfload'):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.agent = agent
+
+        self.sock = None
+        self.reader = None
+        self.send_lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.next_id = 1
+        # id -> time sent, for mining.submit; id -> response for call().
+        self.submitted = {}
+        self.responses = {}
+        self.error = None
+
+        self.extranonce1 = None
+        self.extranonce2_size = None
+        self.difficulty = 1
+        self.target = difficulty_target(1)
+        self.work = None
+        self.generation = 0
+        self.listeners = []
+
+        self.notifies = 0
+        self.shares_submitted = 0
+        self.shares_accepted = 0
+        self.shares_rejected = 0
+        self.rejections = collections.Counter()
+        self.submit_latency_last = None
+        self.submit_latency_max = 0
+        self.submit_latency_total = 0
+        self.submit_latency_count = 0
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), self.timeout)
+        self.sock.settimeout(None)
+        self.reader = threading.Thread(target=self.read_loop, name="hfload stratum reader")
+        self.reader.daemon = True
+        self.reader.start()
+        result = self.call('mining.subscribe', [self.agent])
+        self.extranonce1 = bytes.fromhex(result[1])
+        self.extranonce2_size = result[2]
+        if not self.call('mining.authorize', [self.username, self.password]):
+            raise StratumError("Not authorized as %s" % (self.username))
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+        if self.reader is not None:
+            self.reader.join()
+            self.reader = None
+        self.sock = None
+
+    def send(self, message):
+        line = (json.dumps(message) + '\n').encode('ascii')
+        with self.send_lock:
+            self.sock.sendall(line)
+
+    def request(self, method, params):
+        with self.condition:
+            message_id = self.next_id
+            self.next_id = self.next_id + 1
+            if method == 'mining.submit':
+                self.submitted[message_id] = time.time()
+        self.send({'id': message_id, 'method': method, 'params': params})
+        return message_id
+
+    # Waits for the answer, and returns its result.
+    def call(self, method, params):
+        message_id = self.request(method, params)
+        deadline = time.time() + self.timeout
+        with self.condition:
+            while message_id not in self.responses and self.error is None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise StratumError("No answer to %s" % (method))
+                self.condition.wait(remaining)
+            if message_id not in self.responses:
+                raise StratumError("Connection failed: %s" % (self.error))
+            response = self.responses.pop(message_id)
+        if response.get('error'):
+            raise StratumError("%s failed: %s" % (method, response['error']))
+        return response.get('result')
+
+    def read_loop(self):
+        try:
+            stream = self.sock.makefile('rb')
+            for line in stream:
+                if line.strip():
+                    self.handle(json.loads(line.decode('ascii')))
+            raise StratumError("Connection closed")
+        except Exception as e:
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+
+    def handle(self, message):
+        method = message.get('method')
+        if method == 'mining.notify':
+            with self.condition:
+                self.generation = self.generation + 1
+                self.work = StratumWork(message['params'], self.extranonce1, self.extranonce2_size,
+                                        self.target, self.generation)
+                self.notifies = self.notifies + 1
+                self.condition.notify_all()
+            for listener in self.listeners:
+                listener(self.work)
+        elif method == 'mining.set_difficulty':
+            # Applies from the next notify, as pools expect.
+            with self.condition:
+                self.difficulty = message['params'][0]
+                self.target = difficulty_target(self.difficulty)
+        elif method is None:
+            now = time.time()
+            with self.condition:
+                message_id = message.get('id')
+                sent = self.submitted.pop(message_id, None)
+                if sent is None:
+                    self.responses[message_id] = message
+                else:
+                    self.submit_answered(now - sent, message)
+                self.condition.notify_all()
+
+    # Under the condition.
+    def submit_answered(self, latency, message):
+        self.submit_latency_last = latency
+        self.submit_latency_max = max(self.submit_latency_max, latency)
+        self.submit_latency_total = self.submit_latency_total + latency
+        self.submit_latency_count = self.submit_latency_count + 1
+        if message.get('result') and not message.get('error'):
+            self.shares_accepted = self.shares_accepted + 1
+        else:
+            self.shares_rejected = self.shares_rejected + 1
+            self.rejections[str(message.get('error'))] += 1
+
+    def submit_latency_average(self):
+        if self.submit_latency_count == 0:
+            return None
+        return self.submit_latency_total / self.submit_latency_count
+
+    # Shares still waiting for an answer.
+    def outstanding(self):
+        with self.condition:
+            return len(self.submitted)
+
+    def submit(self, work, extranonce2, nonce, ntime_offset=0):
+        self.shares_submitted = self.shares_submitted + 1
+        self.request('mining.submit', [self.username] + work.submission(extranonce2, nonce, ntime_offset))
+
+    def wait_for_work(self):
+        deadline = time.time() + self.timeout
+        with self.condition:
+            while self.work is None and self.error is None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise StratumError("No work from %s:%d" % (self.host, self.port))
+                self.condition.wait(remaining)
+            if self.work is None:
+                raise StratumError("Connection failed: %s" % (self.error))
+            return self.work
+
+# What found() needs to turn a nonce into a share.
+class StratumPreparedWork(PreparedWork):
+    __slots__ = ('work', 'extranonce2')
+
+    def __init__(self, prepared, search_difficulty, work, extranonce2):
+        PreparedWork.__init__(self, prepared, search_difficulty)
+        self.work = work
+        self.extranonce2 = extranonce2
+
+class StratumWorkSource(JobSource):
+    def __init__(self, client, search_difficulty, batch_size=64, capacity=1024,
+                 background=False, ntime_loops=0):
+        # The seed only keeps JobSource from opening an entropy source
+        # which would never be read.
+        JobSource.__init__(self, seed=0, batch_size=batch_size, capacity=capacity,
+                           background=background, ntime_loops=ntime_loops)
+        self.client = client
+        self.search_difficulty = search_difficulty
+        # id(job) -> StratumPreparedWork, for the jobs still out.
+        self.outstanding = collections.OrderedDict()
+        self.outstanding_limit = 65536
+        self.outstanding_lock = threading.Lock()
+        self.clean_generation = 0
+        self.stale = 0
+        self.shares = 0
+        client.listeners.append(self.new_work)
+
+    # Old work is no good once the pool says so.
+    def new_work(self, work):
+        if work.clean_jobs:
+            with self.condition:
+                self.clean_generation = work.generation
+                self.stale = self.stale + len(self.ring)
+                self.ring.clear()
+                self.condition.notify_all()
+
+    def generate(self, count):
+        work = self.client.wait_for_work()
+        jobs = []
+        blocks = []
+        for i in range(count):
+            job, extranonce2 = work.job(self.ntime_loops)
+            jobs.append([job, extranonce2])
+            blocks.append(struct.pack('<I', job['version']) + bytes(job['previous block hash']) +
+                          bytes(job['merkle tree root'][0:28]))
+        midstates = backends.get('midstates')(blocks)
+        self.generated = self.generated + count
+        return [StratumPreparedWork(PreparedJob(job, midstate), self.search_difficulty, work, extranonce2)
+                for (job, extranonce2), midstate in zip(jobs, midstates)]
+
+    def next(self):
+        while True:
+            prepared = JobSource.next(self)
+            if prepared.work.generation >= self.clean_generation:
+                break
+            self.stale = self.stale + 1
+        with self.outstanding_lock:
+            self.outstanding[id(prepared.job)] = prepared
+            while len(self.outstanding) > self.outstanding_limit:
+                self.outstanding.popitem(last=False)
+        return prepared
+
+    def found(self, job, nonce, ntime_offset, regen_hash):
+        with self.outstanding_lock:
+            prepared = self.outstanding.get(id(job))
+        if prepared is None or prepared.job is not job:
+            return False
+        if hash_to_int(regen_hash) > prepared.work.target:
+            return False
+        self.shares = self.shares + 1
+        self.client.submit(prepared.work, prepared.extranonce2, nonce, ntime_offset)
+        return True
+
+    def close(self):
+        JobSource.close(self)
+        if self.new_work in self.client.listeners:
+            self.client.listeners.remove(self.new_work)
+
+class MockStratumServer():
+    def __init__(self, host='127.0.0.1', port=0, difficulty=1, extranonce2_size=4,
+                 branch_length=10, notify_interval=None, seed=None):
+        self.difficulty = difficulty
+        self.target = difficulty_target(difficulty)
+        self.extranonce2_size = extranonce2_size
+        self.branch_length = branch_length
+        self.notify_interval = notify_interval
+        self.rnd = random.Random(seed)
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.job = None
+        self.next_job_id = 0
+        self.next_extranonce1 = 1
+        self.connections = []
+        self.seen = set()
+        self.accepted = 0
+        self.rejected = collections.Counter()
+        self.running = False
+        self.notifier = None
+
+        server = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                server.serve(self)
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler, bind_and_activate=False)
+        self.server.daemon_threads = True
+        self.server.allow_reuse_address = True
+        self.server.server_bind()
+        self.server.server_activate()
+        self.address = self.server.server_address
+        self.serving = None
+        self.new_job(True)
+
+    def start(self):
+        self.running = True
+        self.serving = threading.Thread(target=self.server.serve_forever, name="mock stratum server")
+        self.serving.daemon = True
+        self.serving.start()
+        if self.notify_interval is not None:
+            self.notifier = threading.Thread(target=self.notify_loop, name="mock stratum notify")
+            self.notifier.daemon = True
+            self.notifier.start()
+
+    def stop(self):
+        self.running = False
+        if self.serving is not None:
+            self.server.shutdown()
+            self.serving.join()
+            self.serving = None
+        self.server.server_close()
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            try:
+                connection.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self.notifier is not None:
+            self.notifier.join()
+            self.notifier = None
+
+    def notify_loop(self):
+        while self.running:
+            time.sleep(self.notify_interval)
+            if self.running:
+                self.new_job(False)
+
+    def random_hex(self, count):
+        return bytes(self.rnd.getrandbits(8) for i in range(count)).hex()
+
+    # A coinbase with room for the extranonces in its input script.
+    def new_job(self, clean):
+        with self.lock:
+            job_id = '%x' % (self.next_job_id)
+            self.next_job_id = self.next_job_id + 1
+            tag = b'/hfload mock/'
+            script_length = 4 + 4 + self.extranonce2_size + len(tag)
+            coinb1 = ('01000000' + '01' + '00' * 32 + 'ffffffff' +
+                      '%02x' % (script_length) + '03' + self.random_hex(3))
+            coinb2 = (tag.hex() + 'ffffffff' + '01' + (625000000).to_bytes(8, 'little').hex() +
+                      '19' + '76a914' + self.random_hex(20) + '88ac' + '00000000')
+            job = {'job_id': job_id,
+                   'prevhash': self.random_hex(32),
+                   'coinb1': coinb1,
+                   'coinb2': coinb2,
+                   'branch': [self.random_hex(32) for i in range(self.branch_length)],
+                   'version': '20000000',
+                   'nbits': '1d00ffff',
+                   'ntime': '%08x' % (int(time.time())),
+                   'clean': clean}
+            if clean:
+                self.jobs = {}
+            self.jobs[job_id] = job
+            self.job = job
+            connections = list(self.connections)
+        for connection in connections:
+            self.notify(connection, job)
+
+    def notify_message(self, job):
+        return {'id': None, 'method': 'mining.notify',
+                'params': [job['job_id'], job['prevhash'], job['coinb1'], job['coinb2'],
+                           job['branch'], job['version'], job['nbits'], job['ntime'], job['clean']]}
+
+    def notify(self, connection, job):
+        self.write(connection, self.notify_message(job))
+
+    def write(self, connection, message):
+        try:
+            with connection.write_lock:
+                connection.wfile.write((json.dumps(message) + '\n').encode('ascii'))
+                connection.wfile.flush()
+        except OSError:
+            pass
+
+    def serve(self, connection):
+        connection.write_lock = threading.Lock()
+        connection.extranonce1 = None
+        try:
+            for line in connection.rfile:
+                if not line.strip():
+                    continue
+                message = json.loads(line.decode('ascii'))
+                result, error = self.answer(connection, message)
+                self.write(connection, {'id': message.get('id'), 'result': result, 'error': error})
+                if message.get('method') == 'mining.authorize' and result:
+                    with self.lock:
+                        self.connections.append(connection)
+                        job = self.job
+                    self.write(connection, {'id': None, 'method': 'mining.set_difficulty',
+                                            'params': [self.difficulty]})
+                    self.notify(connection, job)
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                if connection in self.connections:
+                    self.connections.remove(connection)
+
+    def answer(self, connection, message):
+        method = message.get('method')
+        params = message.get('params', [])
+        if method == 'mining.subscribe':
+            with self.lock:
+                connection.extranonce1 = self.next_extranonce1.to_bytes(4, 'big')
+                self.next_extranonce1 = self.next_extranonce1 + 1
+            return [[['mining.notify', 'hfload']], connection.extranonce1.hex(), self.extranonce2_size], None
+        if method == 'mining.authorize':
+            return True, None
+        if method == 'mining.submit':
+            reason = self.check_share(connection, params)
+            if reason is None:
+                return True, None
+            return False, [20, reason, None]
+        return None, [20, "Unknown method %s" % (method), None]
+
+    # Builds the header from scratch, the way a pool would.
+    def check_share(self, connection, params):
+        worker, job_id, extranonce2, ntime, nonce = params
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                self.rejected['stale'] += 1
+                return "Job not found"
+            key = (job_id, connection.extranonce1, extranonce2, ntime, nonce)
+            if key in self.seen:
+                self.rejected['duplicate'] += 1
+                return "Duplicate share"
+            self.seen.add(key)
+        if len(bytes.fromhex(extranonce2)) != self.extranonce2_size:
+            self.rejected['extranonce2'] += 1
+            return "Wrong extranonce2 size"
+        coinbase = bytes.fromhex(job['coinb1']) + connection.extranonce1 + \
+            bytes.fromhex(extranonce2) + bytes.fromhex(job['coinb2'])
+        root = double_sha256(coinbase)
+        for step in job['branch']:
+            root = double_sha256(root + bytes.fromhex(step))
+        header = struct.pack('<I', int(job['version'], 16)) + \
+            swap_words(bytes.fromhex(job['prevhash'])) + root + \
+            struct.pack('<III', int(ntime, 16), int(job['nbits'], 16), int(nonce, 16))
+        if hash_to_int(double_sha256(header)) > self.target:
+            with self.lock:
+                self.rejected['low difficulty'] += 1
+            return "Low difficulty share"
+        with self.lock:
+            self.accepted = self.accepted + 1
+        return None
@@ -3,6 +3,7 @@
 # requires pyusb
 #   pip install --pre pyusb
 
+import errno
 import usb.core
 import usb.util
 import sys
@@ -14,10 +15,15 @@ SEND = 2
 RECEIVE = 3
 SEND_MAX = 4
 RECEIVE_MAX = 5
+RECEIVE_INTO = 6
+RECEIVE_TIMEOUT = 7
 
 epr = None
 epw = None
 
+# Milliseconds RECEIVE_INTO waits for data.  0 waits forever.
+receive_timeout = 10
+
 def talkusb_init():
   global epr
   global epw
@@ -93,6 +99,11 @@ def talkusb(action, usbBuffer, usbBufferLen):
       ret = epr.read(usbBufferLen, 0)
       #print("RECEIVE: "+str(time.time()-s))
       return ret
+    if action is RECEIVE_INTO:
+      return receive_into(usbBuffer)
+    if action is RECEIVE_TIMEOUT:
+      set_receive_timeout(usbBufferLen)
+      return 0
     if action is INIT:
       talkusb_init()
       return 0
@@ -136,6 +147,30 @@ def receive(usbBufferLen):
   except usb.core.USBError:
     return -1
 
+# usbBuffer must be an array.array('B'), which is what pyusb reads
+# into.  Reads up to len(usbBuffer) bytes and returns the number of
+# bytes read, 0 on timeout, or -1 on error.  A timeout loses whatever
+# the read had already received, so unless the device ends every
+# transfer with a short packet, keep usbBuffer to one packet, as
+# hf.Receive does.
+def receive_into(usbBuffer):
+  try:
+    return epr.read(usbBuffer, receive_timeout)
+  except usb.core.USBError as e:
+    if is_timeout(e):
+      return 0
+    return -1
+
+# Older pyusb has no USBTimeoutError, just errno ETIMEDOUT.
+def is_timeout(e):
+  if hasattr(usb.core, 'USBTimeoutError') and isinstance(e, usb.core.USBTimeoutError):
+    return True
+  return e.errno == errno.ETIMEDOUT
+
+def set_receive_timeout(milliseconds):
+  global receive_timeout
+  receive_timeout = milliseconds
+
 def send_max():
   return 64
 
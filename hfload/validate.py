@@ -0,0 +1,202 @@
+import collections
+import multiprocessing
+import queue
+import struct
+import threading
+import time
+
+from .hf import HF_Error
+from .hf import JobVerifier, roll_timestamp, nonce_search_span
+
+# Nonce validation away from the USB loop.
+#
+# submit() collects (job, nonce, die, core, sequence) records into
+# batches of batch_size, or whatever has gathered in batch_age seconds,
+# and hands each batch to a worker.  verdicts() returns the Verdicts
+# which have come back since the last call, in no particular order.
+#
+# Modes:
+#   'process'  a multiprocessing pool of workers processes (default: one
+#              per host core).  Scales with the cores.
+#   'thread'   workers threads.  Batches go through sha256_np when numpy
+#              is there, which does its work outside the GIL; otherwise
+#              through hashlib, which mostly doesn't.
+#   'inline'   no worker, each batch is checked as it is shipped.  Same
+#              results and interface, for comparison and debugging.
+#
+# A nonce from a job with ntime loops comes with its ntime_offset.  One
+# with HF_NONCE_SEARCH set comes with the search difficulty as well, and
+# the worker looks through the next nonce_search_span nonces for one
+# more, which gets a Verdict of its own with found set.
+#
+# generation comes back in the Verdict untouched.  It is the WorkTable
+# generation of the sequence, so the caller can tell whether the slot
+# still holds the job the verdict is about.
+
+Verdict = collections.namedtuple('Verdict', ['die', 'core', 'sequence', 'generation', 'nonce',
+                                             'zerobits', 'hash', 'ntime_offset', 'found'])
+
+# Runs in the worker.  Records sharing a job share the verifier; pickle
+# keeps the sharing, so a job goes to the worker once per batch.
+def validate_batch(records):
+    verifiers = {}
+    verdicts = []
+    for job, nonce, die, core, sequence, generation, ntime_offset, search_difficulty in records:
+        verifier = verifiers.get(id(job))
+        if verifier is None:
+            verifier = JobVerifier(job)
+            verifiers[id(job)] = verifier
+        zerobits, regen_hash = verifier.check(nonce, ntime_offset)
+        verdicts.append(Verdict(die, core, sequence, generation, nonce, zerobits, regen_hash, ntime_offset, False))
+        if search_difficulty is not None:
+            found = verifier.search(nonce, search_difficulty, ntime_offset)
+            if found is not None:
+                verdicts.append(Verdict(die, core, sequence, generation, found[0], found[1], found[2], ntime_offset, True))
+    return verdicts
+
+def header_bytes(job, nonce, ntime_offset):
+    return struct.pack('<I32s32sIII', job['version'],
+                       bytes(job['previous block hash']),
+                       bytes(job['merkle tree root']),
+                       roll_timestamp(job['timestamp'], ntime_offset),
+                       job['bits'], nonce)
+
+def validate_batch_numpy(records):
+    from . import sha256_np
+    # The nonces themselves first, then nonce_search_span more for each
+    # search, all in one go.
+    headers = bytearray()
+    searches = []
+    for job, nonce, die, core, sequence, generation, ntime_offset, search_difficulty in records:
+        headers += header_bytes(job, nonce, ntime_offset)
+    for i in range(len(records)):
+        job, nonce, die, core, sequence, generation, ntime_offset, search_difficulty = records[i]
+        if search_difficulty is not None:
+            searches.append(i)
+            for j in range(1, nonce_search_span + 1):
+                headers += header_bytes(job, (nonce + j) & 0xffffffff, ntime_offset)
+    hashes = sha256_np.regen_hashes(headers)
+    zeros = sha256_np.count_leading_zeros(hashes)
+    verdicts = []
+    for i in range(len(records)):
+        job, nonce, die, core, sequence, generation, ntime_offset, search_difficulty = records[i]
+        verdicts.append(Verdict(die, core, sequence, generation, nonce, int(zeros[i]), hashes[i].tolist(), ntime_offset, False))
+    for k in range(len(searches)):
+        job, nonce, die, core, sequence, generation, ntime_offset, search_difficulty = records[searches[k]]
+        start = len(records) + k * nonce_search_span
+        for j in range(nonce_search_span):
+            if zeros[start + j] >= search_difficulty:
+                verdicts.append(Verdict(die, core, sequence, generation, (nonce + j + 1) & 0xffffffff,
+                                        int(zeros[start + j]), hashes[start + j].tolist(), ntime_offset, True))
+                break
+    return verdicts
+
+def have_numpy():
+    try:
+        import numpy
+        return True
+    except ImportError:
+        return False
+
+class Validator():
+    def __init__(self, mode='process', workers=None, batch_size=32, batch_age=0.01):
+        self.mode = mode
+        self.batch_size = batch_size
+        self.batch_age = batch_age
+        self.batch = []
+        self.batch_since = None
+        # Filled from the pool's result thread or the worker threads.
+        self.done = collections.deque()
+        self.error = None
+        self.submitted = 0
+        self.validated = 0
+        self.batches = 0
+        self.pool = None
+        self.threads = []
+        if mode == 'process':
+            self.pool = multiprocessing.Pool(workers)
+        elif mode == 'thread':
+            if have_numpy():
+                self.batch_function = validate_batch_numpy
+            else:
+                self.batch_function = validate_batch
+            self.work = queue.Queue()
+            for i in range(workers or 1):
+                thread = threading.Thread(target=self.thread_loop, name="hfload validator %d" % (i))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        elif mode != 'inline':
+            raise HF_Error("Unknown validator mode: %s" % (mode))
+
+    def submit(self, job, nonce, die, core, sequence, ntime_offset=0, search_difficulty=None,
+               generation=None):
+        if self.batch_since is None:
+            self.batch_since = time.time()
+        self.batch.append((job, nonce, die, core, sequence, generation, ntime_offset, search_difficulty))
+        self.submitted = self.submitted + 1
+        if len(self.batch) >= self.batch_size:
+            self.ship()
+
+    def service(self):
+        if self.batch_since is not None and \
+                time.time() - self.batch_since >= self.batch_age:
+            self.ship()
+
+    def ship(self):
+        if len(self.batch) == 0:
+            return
+        batch = self.batch
+        self.batch = []
+        self.batch_since = None
+        self.batches = self.batches + 1
+        if self.mode == 'process':
+            self.pool.apply_async(validate_batch, (batch,),
+                                  callback=self.done.extend, error_callback=self.failed)
+        elif self.mode == 'thread':
+            self.work.put(batch)
+        else:
+            self.done.extend(validate_batch(batch))
+
+    def failed(self, error):
+        self.error = error
+
+    def thread_loop(self):
+        while True:
+            batch = self.work.get()
+            if batch is None:
+                return
+            try:
+                self.done.extend(self.batch_function(batch))
+            except Exception as e:
+                self.failed(e)
+
+    # Also ships a batch which has waited long enough.
+    def verdicts(self):
+        self.service()
+        if self.error is not None:
+            raise HF_Error("Nonce validation failed: %s" % (self.error))
+        result = []
+        done = self.done
+        while done:
+            result.append(done.popleft())
+        self.validated = self.validated + len([x for x in result if not x.found])
+        return result
+
+    # Submitted, but no verdict handed out yet.
+    def outstanding(self):
+        return self.submitted - self.validated
+
+    # Ships what is left and waits for the workers, whose verdicts are
+    # still there for verdicts().
+    def close(self):
+        self.ship()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        for thread in self.threads:
+            self.work.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
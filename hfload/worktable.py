@@ -0,0 +1,130 @@
+import array
+import collections
+
+from .hf import sequence_a_leq_b
+
+# Work sent to one die, by 16 bit sequence number.
+#
+# Every field has one fixed array of 65536 entries, indexed by sequence,
+# so inserting and looking up are a couple of array stores and loads,
+# and the table takes the same memory from the first OP_HASH to the
+# last.  A stale entry is not removed, just marked dead, and its job and
+# verifier dropped.
+#
+# Each insert bumps the slot's generation, so something holding on to
+# (sequence, generation), like a nonce waiting in a Validator, can tell
+# whether the slot still holds the same work.
+#
+# A core holds at most two jobs, the active one and the pending one.
+# Once OP_STATUS says the die has taken a core's third newest job, its
+# oldest job can no longer turn up in a nonce: the slot which took the
+# third was freed by a status which came after that job's nonces.  So
+# expire() keeps the last two jobs for each core at or below the die's
+# last sequence, plus anything newer, and kills the rest.  It only looks
+# at the cores of jobs the die has taken since the last call, which are
+# queued in the order they were inserted.
+
+sequence_count = 65536
+
+class WorkTable():
+    def __init__(self):
+        self.jobs = [None] * sequence_count
+        self.verifiers = [None] * sequence_count
+        self.cores = array.array('h', [-1]) * sequence_count
+        self.search_difficulties = array.array('B', [0]) * sequence_count
+        self.times = array.array('d', [0.0]) * sequence_count
+        self.generations = array.array('L', [0]) * sequence_count
+        self.live = bytearray(sequence_count)
+        # core -> sequences still live for it, oldest first.
+        self.core_sequences = collections.defaultdict(collections.deque)
+        # Sequences inserted and not yet taken by the die, oldest first.
+        self.unseen = collections.deque()
+        self.count = 0
+        self.inserted = 0
+        self.expired = 0
+        self.overwritten = 0
+
+    def __contains__(self, sequence):
+        return self.live[sequence] == 1
+
+    def __len__(self):
+        return self.count
+
+    # Returns the slot's new generation.
+    def insert(self, sequence, job, verifier, core, search_difficulty, sent):
+        if self.live[sequence]:
+            # Only if expire() is never called, or the die lost track.
+            self.overwritten = self.overwritten + 1
+            self.kill(sequence)
+        self.jobs[sequence] = job
+        self.verifiers[sequence] = verifier
+        self.cores[sequence] = core
+        self.search_difficulties[sequence] = search_difficulty
+        self.times[sequence] = sent
+        generation = (self.generations[sequence] + 1) & 0xffffffff
+        self.generations[sequence] = generation
+        self.live[sequence] = 1
+        self.core_sequences[core].append(sequence)
+        self.unseen.append(sequence)
+        self.count = self.count + 1
+        self.inserted = self.inserted + 1
+        return generation
+
+    # The job at sequence, if it is still there and, given a generation,
+    # still the same one.
+    def job(self, sequence, generation=None):
+        if not self.live[sequence]:
+            return None
+        if generation is not None and self.generations[sequence] != generation:
+            return None
+        return self.jobs[sequence]
+
+    def kill(self, sequence):
+        if not self.live[sequence]:
+            return
+        self.live[sequence] = 0
+        self.jobs[sequence] = None
+        self.verifiers[sequence] = None
+        self.count = self.count - 1
+        sequences = self.core_sequences[self.cores[sequence]]
+        if sequences and sequences[0] == sequence:
+            sequences.popleft()
+        else:
+            sequences.remove(sequence)
+
+    def expire(self, last_sequence):
+        unseen = self.unseen
+        while unseen and sequence_a_leq_b(unseen[0], last_sequence):
+            sequences = self.core_sequences[self.cores[unseen.popleft()]]
+            while len(sequences) > 2 and sequence_a_leq_b(sequences[2], last_sequence):
+                self.kill(sequences[0])
+                self.expired = self.expired + 1
+
+def self_test():
+    table = WorkTable()
+    for sequence in range(6):
+        table.insert(sequence, {'n': sequence}, None, 0, 0, 0.0)
+    table.insert(6, {'n': 6}, None, 1, 0, 0.0)
+    # Core 0's third newest job at or below 3 is 2, so 0 and 1 go.
+    table.expire(3)
+    assert [x for x in range(7) if x in table] == [2, 3, 4, 5, 6]
+    assert table.expired == 2 and len(table) == 5
+    table.expire(5)
+    assert [x for x in range(7) if x in table] == [4, 5, 6]
+    assert list(table.core_sequences[0]) == [4, 5]
+    # A verdict holding the old generation doesn't match the new job.
+    old = table.generations[5]
+    table.kill(5)
+    assert table.job(5) is None
+    new = table.insert(5, {'n': 'new'}, None, 0, 0, 0.0)
+    assert new != old
+    assert table.job(5, old) is None
+    assert table.job(5, new) == {'n': 'new'} and table.job(5) == {'n': 'new'}
+    # Inserting over a live slot counts, and leaves one entry.
+    table.insert(5, {'n': 'again'}, None, 0, 0, 0.0)
+    assert table.overwritten == 1 and list(table.core_sequences[0]) == [4, 5]
+    return True
+
+if __name__ == '__main__':
+    self_test()
+    print("worktable agrees with itself.")
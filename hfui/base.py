@@ -29,6 +29,8 @@ class DieInfo:
     self.throttle = 0
     self.active   = 0
     self.pending  = 0
+    # hashes a second over the last minute
+    self.hash_rate = 0
     self.temp     = 0
     self.thermal_cutoff = 0
     self.vm       = 0
@@ -283,9 +285,11 @@ class BaseUI(metaclass=ABCMeta):
         wdie.addstr(1, 1,"SQ    {0:02d}%".format(int(di.throttle)))
         wdie.addstr(2, 1,"ACT   {0:03d}".format(di.active))
         wdie.addstr(3, 1,"PEND  {0:03d}".format(di.pending))
+        wdie.addstr(4, 1,"GH {0:6.1f}".format(di.hash_rate / 10**9))
         wdie.addstr(10,1,"VM   {0:.02f}".format(di.vm))
       else:
         wdie.addstr(2, 1,"VM   {0:.02f}".format(di.vm))
+        wdie.addstr(8, 1,"GH {0:6.1f}".format(di.hash_rate / 10**9))
         wdie.addstr(9, 1,"SQ    {0:02d}%".format(int(di.throttle)))
         wdie.addstr(10,1,"ACT   {0:03d}".format(di.active))
         wdie.addstr(11,1,"PEND  {0:03d}".format(di.pending))
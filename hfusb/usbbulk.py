@@ -3,27 +3,33 @@
 # requires pyusb
 #   pip install --pre pyusb
 
+import array
 import usb.core
 import usb.util
 import sys
 import time
 
+from hfload.talkusb import is_timeout
+
 HF_USBBULK_INIT         = 0
 HF_USBBULK_SHUTDOWN     = 1
 HF_USBBULK_SEND         = 2
 HF_USBBULK_RECEIVE      = 3
 HF_USBBULK_SEND_MAX     = 4
 HF_USBBULK_RECEIVE_MAX  = 5
+HF_USBBULK_RECEIVE_INTO = 6
+HF_USBBULK_RECEIVE_TIMEOUT = 7
 
 HF_BULK_DEVICE_NOT_FOUND     = 'HFBulkDevice Not Found'
 HF_BULK_DEVICE_FOUND         = 'HFBulkDevice Found!'
 
-def poll_hf_bulk_device(intv=1, printer=print):
+# selection is passed on to HFBulkDevice(), e.g. bus=1, address=5.
+def poll_hf_bulk_device(intv=1, printer=print, **selection):
   # look for device
   while 1:
     time.sleep(intv)
     try:
-      dev = HFBulkDevice()
+      dev = HFBulkDevice(**selection)
       break
     except:
       printer(HF_BULK_DEVICE_NOT_FOUND)
@@ -31,19 +37,50 @@ def poll_hf_bulk_device(intv=1, printer=print):
   printer(HF_BULK_DEVICE_FOUND)
   return dev
 
+# Interface the bulk endpoints are on, from board_util.h.
+HF_BULK_INTERFACE = 1
+
+# Like hcm.c, a device can be picked by bus, address and port, or any
+# of them.  None matches anything.
+def find_hf_bulk_devices(idVendor=None, idProduct=None, bus=None, address=None, port=None):
+  # HashFast idVendor
+  if idVendor is None:
+    idVendor = 0x297c
+  # HashFast idProduct
+  if idProduct is None:
+    idProduct = 0x0001
+  devices = usb.core.find(find_all=True, idVendor=idVendor, idProduct=idProduct)
+  return [dev for dev in devices
+          if (bus is None or bus == dev.bus) and
+             (address is None or address == dev.address) and
+             (port is None or port == dev.port_number)]
+
+# One board.  Everything is kept in the instance, so a process can
+# drive as many boards as it likes, one HFBulkDevice each.
+#
+# The instance is callable with the same arguments as talkusb(), so it
+# can be handed to hf.Send, hf.Receive and the routines in place of
+# talkusb.talkusb.  Timeouts are in milliseconds, 0 means forever.
+# receive_timeout is for HF_USBBULK_RECEIVE, receive_into_timeout for
+# HF_USBBULK_RECEIVE_INTO, and HF_USBBULK_RECEIVE_TIMEOUT sets the
+# latter, which is what hf.Receive does.
 class HFBulkDevice():
-  def __init__(self, idVendor=None, idProduct=None):
-    # HashFast idVendor
-    if idVendor is None:
-      idVendor = 0x297c
-    # HashFast idProduct
-    if idProduct is None:
-      idProduct = 0x0001
-    # find our device
-    self.dev = usb.core.find(idVendor=idVendor, idProduct=idProduct)
+  def __init__(self, idVendor=None, idProduct=None, bus=None, address=None, port=None,
+               packet_size=64, send_timeout=0, receive_timeout=0, receive_into_timeout=10):
+    devices = find_hf_bulk_devices(idVendor, idProduct, bus, address, port)
     # was it found?
-    if self.dev is None:
+    if len(devices) == 0:
       raise ValueError('Device not found')
+    if len(devices) > 1:
+      raise ValueError('More than one device found, have to specify by address/bus/port')
+    self.dev = devices[0]
+    self.packet_size = packet_size
+    self.send_timeout = send_timeout
+    self.receive_timeout = receive_timeout
+    self.receive_into_timeout = receive_into_timeout
+    self.intf = None
+    self.epw = None
+    self.epr = None
 
   ##
   # information about the connected device
@@ -51,25 +88,28 @@ class HFBulkDevice():
   def info(self):
     # loop through configurations
     #   lsusb -v -d 297C:0001
-    string = ""
+    string = "Bus {0} Address {1} Port {2}\n".format(self.dev.bus, self.dev.address, self.dev.port_number)
     for cfg in self.dev:
       string += "ConfigurationValue {0}\n".format(cfg.bConfigurationValue)
       for intf in cfg:
-        string += "\tInterfaceNumber {0},{0}\n".format(intf.bInterfaceNumber, intf.bAlternateSetting)
+        string += "\tInterfaceNumber {0},{1}\n".format(intf.bInterfaceNumber, intf.bAlternateSetting)
         for ep in intf:
           string += "\t\tEndpointAddress {0}\n".format(ep.bEndpointAddress)
     return string
 
   def init(self):
     # detach kernel driver
-    if self.dev.is_kernel_driver_active(intf):
-      self.dev.detach_kernel_driver(intf)
-    # set the active configuration. With no arguments, the first
-    # configuration will be the active one
-    self.dev.set_configuration()
+    if self.dev.is_kernel_driver_active(HF_BULK_INTERFACE):
+      self.dev.detach_kernel_driver(HF_BULK_INTERFACE)
+    # No set_configuration() here, on purpose.  As hfusb.c notes, it
+    # makes the Atmel USB code resend old data, and the device only has
+    # the one configuration anyway.
     # get an endpoint instance
     self.cfg = self.dev.get_active_configuration()
-    self.intf = self.cfg[(1,1)]
+    # The bulk interface has a single alternate setting, 0, which
+    # board_util.c checks for.  The (1,1) this used to ask for doesn't
+    # exist.
+    self.intf = self.cfg[(HF_BULK_INTERFACE, 0)]
     # write endpoint
     self.epw = usb.util.find_descriptor(self.intf,
         # match the first OUT endpoint
@@ -78,7 +118,7 @@ class HFBulkDevice():
             usb.util.endpoint_direction(e.bEndpointAddress) == \
             usb.util.ENDPOINT_OUT
     )
-    assert epw is not None
+    assert self.epw is not None
     # read endpoint
     self.epr = usb.util.find_descriptor(self.intf,
         # match the first IN endpoint
@@ -87,28 +127,72 @@ class HFBulkDevice():
             usb.util.endpoint_direction(e.bEndpointAddress) == \
             usb.util.ENDPOINT_IN
     )
-    assert epr is not None
+    assert self.epr is not None
     return 0
 
   def shutdown(self):
+    usb.util.dispose_resources(self.dev)
+    self.intf = None
+    self.epw = None
+    self.epr = None
     return 0
 
   def send(self, usbBuffer):
     try:
-      ret = epw.write(usbBuffer, 0)
+      ret = self.epw.write(usbBuffer, self.send_timeout)
       return ret
     except usb.core.USBError:
       return -1
 
-  def recieve(self, bufferLen):
+  # Returns an array, empty if the read timed out, or -1 on error.
+  def receive(self, bufferLen):
     try:
-      ret = epr.read(bufferLen, 0)
+      ret = self.epr.read(bufferLen, self.receive_timeout)
       return ret
-    except usb.core.USBError:
+    except usb.core.USBError as e:
+      if is_timeout(e):
+        return array.array('B')
+      return -1
+
+  # usbBuffer must be an array.array('B').  Returns the number of bytes
+  # read, 0 if the read timed out, or -1 on error.
+  def receive_into(self, usbBuffer):
+    try:
+      return self.epr.read(usbBuffer, self.receive_into_timeout)
+    except usb.core.USBError as e:
+      if is_timeout(e):
+        return 0
       return -1
 
   def send_max(self):
-    return 64
+    return self.packet_size
+
+  def receive_max(self):
+    return self.packet_size
+
+  # The old misspelled names.
+  recieve = receive
+  recieve_max = receive_max
 
-  def recieve_max(self):
-    return 64
+  def __call__(self, action, usbBuffer, usbBufferLen):
+    if action == HF_USBBULK_SEND:
+      return self.send(usbBuffer)
+    if action == HF_USBBULK_RECEIVE:
+      return self.receive(usbBufferLen)
+    if action == HF_USBBULK_RECEIVE_INTO:
+      return self.receive_into(usbBuffer)
+    if action == HF_USBBULK_RECEIVE_TIMEOUT:
+      self.receive_into_timeout = usbBufferLen
+      return 0
+    if action == HF_USBBULK_INIT:
+      try:
+        return self.init()
+      except usb.core.USBError:
+        return -1
+    if action == HF_USBBULK_SHUTDOWN:
+      return self.shutdown()
+    if action == HF_USBBULK_SEND_MAX:
+      return self.send_max()
+    if action == HF_USBBULK_RECEIVE_MAX:
+      return self.receive_max()
+    return None
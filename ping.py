@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+# Sends an OP_PING with quartets of random data and checks that the
+# same frame comes back, like ping.c, but through hfload.aio.
+
+import asyncio
+import os
+import sys
+
+from hfload import hf
+from hfload import talkusb
+from hfload.aio import AsyncLink
+
+def usage():
+    print("usage: %s [number of quartets of data to send]" % (sys.argv[0]), file=sys.stderr)
+    sys.exit(1)
+
+async def ping(quartets):
+    link = AsyncLink(talkusb.talkusb)
+    await link.start()
+    try:
+        data = None
+        if quartets > 0:
+            data = os.urandom(4 * quartets)
+        sent = hf.HF_Frame({'operation_code': hf.opcodes['OP_PING'], 'data': data or b''})
+        reply = await link.request(hf.opcodes['OP_PING'], data=data)
+    finally:
+        await link.close()
+    if reply.buffer != sent.buffer:
+        print("Ping did not get back what it sent: %s" % (reply.framebytes), file=sys.stderr)
+        sys.exit(1)
+    print("Ping!")
+
+if len(sys.argv) > 2:
+    usage()
+quartets = 0
+if len(sys.argv) == 2:
+    try:
+        quartets = int(sys.argv[1])
+    except ValueError:
+        usage()
+# Fix: Packets of 64 bytes exactly seem to mess up the microcontroller!
+if quartets < 0 or quartets * 4 >= 64 - 8:
+    print("%d quartets is too large to send." % (quartets), file=sys.stderr)
+    sys.exit(1)
+
+talkusb.talkusb(hf.INIT, None, 0)
+
+asyncio.run(ping(quartets))
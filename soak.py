@@ -93,6 +93,7 @@ class HFSoakInteractive(HFProfilerBase):
                 dinfo.temp = die['monitor_data'].die_temperature
                 dinfo.vm = die['monitor_data'].core_voltage_main
                 dinfo.throttle = self.throttle
+                dinfo.hash_rate = self.test.estimator.die(dinfo.index).rate
                 if dinfo.temp > 104:
                   self.getting_warm = True
 